@@ -1,8 +1,12 @@
 """Main script for collecting data."""
 import glob
 import json
+import sys
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import region_lengths
+
 import read_biscuitqc
 import samtools_stats
 import preseq_reports
@@ -78,9 +82,15 @@ def raw_bams():
     # Obs/Exp ratios
     obs_exp_files = glob.glob(TOPDIR + '/analyze_the_data/cpg_questions/exp_vs_obs_coverage/pbs_mappability/*.stdout')
 
+    # Region lengths are only needed (and the bismap files only read) if
+    # there are logs to correct
+    lengths = None
+    if len(obs_exp_files) > 0:
+        lengths = region_lengths.lookup(TOPDIR + '/../qc_assets/bismap')
+
     obs_exp_data = {}
     for f in obs_exp_files:
-        samp, data = obs_exp_ratio.process_file(f, prefix='mappy_')
+        samp, data = obs_exp_ratio.process_file(f, prefix='mappy_', lengths=lengths)
         obs_exp_data[samp] = data
 
     # Trinucleotide context (CAH, CAG, CTH, CTG) methylation
@@ -91,6 +101,14 @@ def raw_bams():
         samp, data = trinuc_meth.process_file(f, '_raw.tsv')
         trinuc_results[samp] = data
 
+    # Cytosine context census (all two-, three-, and five-base contexts)
+    census_files = glob.glob(TOPDIR + '/analyze_the_data/cpg_questions/trinuc_methylation/*_raw.census.tsv')
+
+    census_results = {}
+    for f in census_files:
+        samp, data = trinuc_meth.process_census_file(f, '_raw.census.tsv')
+        census_results[samp] = data
+
     collected_data = {}
     dics = [
         raw_quals,
@@ -101,7 +119,8 @@ def raw_bams():
         bisc_qc_data,
         preseq_results,
         obs_exp_data,
-        trinuc_results
+        trinuc_results,
+        census_results
     ]
     for d in dics:
         for key, value in d.items():
@@ -181,6 +200,14 @@ def subsampled_bams():
         samp, data = trinuc_meth.process_file(f, '_sub.tsv')
         trinuc_results[samp] = data
 
+    # Cytosine context census (all two-, three-, and five-base contexts)
+    census_files = glob.glob(TOPDIR + '/analyze_the_data/cpg_questions/trinuc_methylation/*_sub.census.tsv')
+
+    census_results = {}
+    for f in census_files:
+        samp, data = trinuc_meth.process_census_file(f, '_sub.census.tsv')
+        census_results[samp] = data
+
     collected_data = {}
     dics = [
         raw_quals,
@@ -190,7 +217,8 @@ def subsampled_bams():
         stats_results,
         bisc_qc_data,
         preseq_results,
-        trinuc_results
+        trinuc_results,
+        census_results
     ]
     for d in dics:
         for key, value in d.items():
@@ -2,6 +2,11 @@
 import numpy as np
 import glob
 import json
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import region_lengths
 
 SAMPL = 0
 REFLN = 1
@@ -15,14 +20,33 @@ ORDER = {
     'intr_obs_exp_ratio': (7,14)
 }
 
-def process_file(fname, prefix=''):
+# Region length labels from region_lengths matching the columns in ORDER
+LENGTHS = {
+    REFLN: 'REFLEN',
+    2: 'CPGSLEN',
+    3: 'CGISLEN',
+    4: 'RMSKLEN',
+    5: 'EXONLEN',
+    6: 'GENELEN',
+    7: 'INTRLEN'
+}
+
+def process_file(fname, prefix='', lengths=None):
     """Process log file (*.stdout extension) from obs/exp processing.
 
-    Inputs -- fname - filename of log file
+    Inputs -- fname   - filename of log file
+              prefix  - string to add to front of keys
+              lengths - dictionary of cached region lengths from
+                        region_lengths.lookup(), replaces the region lengths
+                        written in the log file when given
 
     Returns -- cleaned dictionary with obs/exp ratios
     """
-    vals = np.genfromtxt(fname, dtype=None, encoding=None)[()]
+    vals = list(np.genfromtxt(fname, dtype=None, encoding=None)[()])
+
+    if lengths is not None:
+        for idx, lab in LENGTHS.items():
+            vals[idx] = lengths[lab]
 
     samp = vals[SAMPL]
     ratios = {}
@@ -38,10 +62,13 @@ def main():
     """Function for reading files and processing them."""
     TOPDIR='2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis'
     obs_exp_mappy_files = glob.glob(TOPDIR + '/analyze_the_data/cpg_questions/exp_vs_obs_coverage/pbs_mappability/*.stdout')
+    lengths = None
+    if len(obs_exp_mappy_files) > 0:
+        lengths = region_lengths.lookup(TOPDIR + '/../qc_assets/bismap')
 
     data_mappy = {}
     for log in obs_exp_mappy_files:
-        samp, ratios = process_file(log, prefix='mappy_')
+        samp, ratios = process_file(log, prefix='mappy_', lengths=lengths)
         data_mappy[samp] = ratios
 
     print(data_mappy)
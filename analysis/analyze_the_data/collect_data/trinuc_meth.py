@@ -1,4 +1,5 @@
 """Read data in trinucleotide context files."""
+import pandas as pd
 import os
 
 def process_file(fname, ext):
@@ -34,6 +35,48 @@ def process_file(fname, ext):
 
     return sample, data
 
+def load_census(fname):
+    """Load cytosine context census table written by trinuc_methylation.py.
+
+    Inputs -- fname - filename of census table
+
+    Returns -- DataFrame with chr, level, context, count, covg, base_avg, and
+               covg_weighted columns
+    """
+    return pd.read_csv(
+        fname,
+        sep='\t',
+        dtype={'chr': 'category', 'level': 'category', 'context': 'str',
+               'count': 'int64', 'covg': 'int64', 'base_avg': 'float64',
+               'covg_weighted': 'float64'}
+    )
+
+def process_census_file(fname, ext, chrom='all'):
+    """Process cytosine context census files.
+
+    Inputs -- fname - filename of census table
+              ext   - tag to remove from end of file
+              chrom - chromosome to retrieve values for [default: all]
+
+    Returns -- tuple (sample, dictionary with context census values)
+    """
+    sample = os.path.basename(fname).replace(ext, '')
+
+    df = load_census(fname)
+    df = df[df.chr == chrom]
+
+    census = {}
+    for row in df.itertuples(index=False):
+        if row.level not in census.keys():
+            census[row.level] = {}
+        census[row.level][row.context] = {
+            'count': int(row.count),
+            'base_avg_methylation_percent': float(row.base_avg),
+            'covg_weighted_methylation_percent': float(row.covg_weighted)
+        }
+
+    return sample, {'context_census': census}
+
 if __name__ == '__main__':
     samp, data = process_file('../cpg_questions/trinuc_methylation/FtubeAkapaBC.tsv')
     print(samp, data)
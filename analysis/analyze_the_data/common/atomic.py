@@ -0,0 +1,25 @@
+"""Write output files atomically."""
+from contextlib import contextmanager
+import os
+
+@contextmanager
+def atomic_output(fname):
+    """Provide temporary filename that replaces fname once writing succeeds.
+
+    Readers (and concurrent jobs) only ever see the old file or the complete
+    new file, never a partially written one. The temporary file is removed if
+    writing fails.
+
+    Inputs -
+        fname - name of final output file
+    Yields -
+        name of temporary file to write to (in the same directory as fname)
+    """
+    base, ext = os.path.splitext(fname)
+    tmp = '{}.{}.tmp{}'.format(base, os.getpid(), ext)
+    try:
+        yield tmp
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
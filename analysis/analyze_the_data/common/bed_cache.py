@@ -0,0 +1,174 @@
+"""Columnar sidecar caches of parsed BED files.
+
+Parsing a large gzipped BED file is far slower than reading the same columns
+back from an uncompressed Arrow (Feather v2) file, which can be memory mapped
+instead of decompressed and parsed. The first read of a BED file with a given
+set of columns, types, and filters writes the resulting DataFrame next to the
+file as <file>.<key>.feather. Later reads with the same arguments load the
+sidecar instead, as long as the fingerprint (path, size, modification time) of
+the BED file stored in the sidecar still matches, so sidecars of changed files
+are rebuilt automatically. Writing a sidecar removes the stale sidecars of the
+same file, so at most one set of sidecars per file is kept on disk.
+"""
+import hashlib
+import glob
+import json
+import os
+import re
+
+from fileinfo import fingerprint
+from atomic import atomic_output
+
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = None
+
+# Ending of sidecar files
+EXT = '.feather'
+
+# Schema metadata field holding fingerprint of BED file
+META_KEY = b'bed_cache_source'
+
+# Schema metadata field holding VERSION the sidecar was written with
+VERSION_KEY = b'bed_cache_version'
+
+# Version of how BED files are parsed, part of every key (and stored in every
+# sidecar) so sidecars written by older versions are not loaded
+VERSION = 3
+
+def available():
+    """Check whether sidecars can be written (pyarrow is installed)."""
+    return pa is not None
+
+def cache_key(**read_args):
+    """Create short key identifying the arguments a BED file was read with.
+
+    Inputs -
+        read_args - arguments of read, made of strings, numbers, lists, and
+                    dictionaries
+    Returns -
+        hex string
+    """
+    text = json.dumps(dict(read_args, version=VERSION), sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+def sidecar_name(fname, key):
+    """Find name of sidecar of fname for cache_key() key."""
+    return '{}.{}{}'.format(fname, key, EXT)
+
+def load(sidecar, fprint):
+    """Load DataFrame from sidecar if it was made from an unchanged file.
+
+    Inputs -
+        sidecar - sidecar file
+        fprint  - current fingerprint of BED file
+    Returns -
+        DataFrame (None if sidecar is missing, stale, or unreadable)
+    """
+    if not os.path.exists(sidecar):
+        return None
+
+    try:
+        with pa.memory_map(sidecar, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    if not current(table.schema, fprint):
+        return None
+
+    return table.to_pandas()
+
+def current(schema, fprint):
+    """Check whether sidecar schema was written by VERSION from file with fprint."""
+    meta = schema.metadata or {}
+
+    return (meta.get(META_KEY) == json.dumps(fprint, sort_keys=True).encode() and
+            meta.get(VERSION_KEY) == str(VERSION).encode())
+
+def prune(fname, fprint, keep):
+    """Remove stale sidecars of fname.
+
+    Sidecars read with other arguments are kept if they are still current.
+    Temporary files of sidecars being written are never matched.
+
+    Inputs -
+        fname  - BED file
+        fprint - current fingerprint of BED file
+        keep   - sidecar to leave in place
+    Returns -
+        list of removed sidecars
+    """
+    pattern = re.compile(re.escape(fname) + r'\.[0-9a-f]{12}' + re.escape(EXT) + '$')
+
+    removed = []
+    for sidecar in glob.glob(glob.escape(fname) + '.*' + EXT):
+        if sidecar == keep or not pattern.match(sidecar):
+            continue
+
+        try:
+            with pa.memory_map(sidecar, 'r') as source:
+                stale = not current(pa.ipc.open_file(source).schema, fprint)
+        except (OSError, pa.ArrowInvalid):
+            stale = True
+
+        if stale:
+            try:
+                os.remove(sidecar)
+                removed.append(sidecar)
+            except OSError:
+                pass
+
+    return removed
+
+def save(sidecar, df, fprint):
+    """Write DataFrame to sidecar, tagged with fingerprint of BED file.
+
+    Sidecars are only an optimization, so failing to write one (e.g., in a
+    read-only directory) is not an error.
+
+    Inputs -
+        sidecar - sidecar file
+        df      - DataFrame read from BED file
+        fprint  - fingerprint of BED file at the time it was read
+    Returns -
+        bool of whether sidecar was written
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    meta = dict(table.schema.metadata or {})
+    meta[META_KEY] = json.dumps(fprint, sort_keys=True).encode()
+    meta[VERSION_KEY] = str(VERSION).encode()
+    table = table.replace_schema_metadata(meta)
+
+    try:
+        with atomic_output(sidecar) as tmp:
+            feather.write_feather(table, tmp, compression='uncompressed')
+    except OSError:
+        return False
+
+    return True
+
+def cached_read(fname, read, **read_args):
+    """Read BED file through its sidecar.
+
+    Inputs -
+        fname     - BED file
+        read      - function with no arguments that parses fname into a
+                    DataFrame
+        read_args - arguments read uses, part of the sidecar key
+    Returns -
+        DataFrame
+    """
+    fprint = fingerprint(fname)
+    sidecar = sidecar_name(fname, cache_key(**read_args))
+
+    df = load(sidecar, fprint)
+    if df is None:
+        df = read()
+        if save(sidecar, df, fprint):
+            prune(fname, fprint, sidecar)
+
+    return df
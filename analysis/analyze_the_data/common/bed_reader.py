@@ -0,0 +1,343 @@
+"""Read BISCUIT mergecg and methylation BED files into DataFrames.
+
+Columns are read with narrow dtypes (categorical chromosome, int32 positions,
+float32 beta values, uint32 coverage), only requested columns are kept, and
+coverage/chromosome filters are applied to each block as it is parsed, so the
+full file is never held in memory (iter_bed() hands the blocks out one at a
+time instead of combining them). The multithreaded pyarrow CSV reader is
+used when pyarrow is installed, otherwise pandas is used, and read_bed() then
+keeps a columnar sidecar cache of each file it parses (see bed_cache.py).
+Single chromosomes of bgzipped, tabix-indexed files are read with
+read_region().
+"""
+from pandas.api.types import union_categoricals
+import pandas as pd
+import io
+
+import bed_cache
+import tabix
+
+try:
+    from pyarrow import csv as pa_csv
+    import pyarrow.compute as pc
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Column names of BISCUIT mergecg BED files
+MERGECG = ['chr', 'start', 'end', 'beta', 'covg', 'context']
+
+# Column names of window averaged (bedtools map) BED files
+WINDOW = ['chr', 'start', 'end', 'beta', 'covg']
+
+# Default data types of columns
+DTYPES = {
+    'chr'      : 'category',
+    'start'    : 'int32',
+    'end'      : 'int32',
+    'beta'     : 'float32',
+    'covg'     : 'uint32',
+    'context'  : 'category',
+    'sea_group': 'category',
+    'beta_avg' : 'float32',
+    'covg_avg' : 'float32'
+}
+
+# Data types for window averaged files, where coverage is an average
+WINDOW_DTYPES = {'covg': 'float32'}
+
+# pyarrow types matching DTYPES (categories are read as strings)
+ARROW_TYPES = {
+    'category': 'string',
+    'int32'   : 'int32',
+    'uint16'  : 'uint16',
+    'uint32'  : 'uint32',
+    'int64'   : 'int64',
+    'float32' : 'float32',
+    'float64' : 'float64'
+}
+
+# Number of rows per block when reading with pandas
+CHUNKSIZE = 5000000
+
+# Whether read_bed() keeps columnar sidecar caches of files it parses (see
+# bed_cache.py)
+CACHE = True
+
+def column_dtypes(names, dtypes=None):
+    """Find data type of each column.
+
+    Inputs -
+        names  - list of column names
+        dtypes - dictionary of {column: dtype} overriding DTYPES [default: None]
+    Returns -
+        dictionary of {column: dtype} for columns in names
+    """
+    out = dict((col, DTYPES.get(col, 'float32')) for col in names)
+    if dtypes is not None:
+        out.update(dtypes)
+
+    return out
+
+def filter_columns(min_covg, chroms):
+    """Find columns needed to apply filters.
+
+    Inputs -
+        min_covg - minimum coverage filter (or None)
+        chroms   - chromosome filter (or None)
+    Returns -
+        set of column names
+    """
+    out = set()
+    if min_covg is not None:
+        out.add('covg')
+    if chroms is not None:
+        out.add('chr')
+
+    return out
+
+def fills_covg(dtypes):
+    """Check whether missing coverage is read as 0 (integer coverage column).
+
+    Coverage of a single CpG is a count, and a CpG with no coverage value was
+    not covered. Averaged coverage (e.g., of windows) stays missing (NaN).
+    """
+    return str(dtypes.get('covg', '')).startswith(('int', 'uint'))
+
+def empty_frame(usecols, dtypes):
+    """Create empty DataFrame with requested columns and data types."""
+    return pd.DataFrame(columns=usecols).astype(dict((c, dtypes[c]) for c in usecols))
+
+def _iter_arrow(fname, names, usecols, dtypes, min_covg, chroms, na_values):
+    """Yield filtered pyarrow record batches of BED file, see read_bed()."""
+    read_opts = pa_csv.ReadOptions(column_names=names, use_threads=True, block_size=1 << 26)
+    parse_opts = pa_csv.ParseOptions(delimiter='\t')
+    conv_opts = pa_csv.ConvertOptions(
+        column_types=dict((col, ARROW_TYPES[dt]) for col, dt in dtypes.items()),
+        include_columns=list(set(usecols) | filter_columns(min_covg, chroms)),
+        null_values=list(na_values),
+        strings_can_be_null=True
+    )
+
+    fill = fills_covg(dtypes) and 'covg' in conv_opts.include_columns
+    with pa_csv.open_csv(fname, read_options=read_opts, parse_options=parse_opts,
+                         convert_options=conv_opts) as reader:
+        for batch in reader:
+            if fill and batch.column('covg').null_count > 0:
+                batch = pa.RecordBatch.from_arrays(
+                    [pc.fill_null(col, 0) if name == 'covg' else col
+                     for name, col in zip(batch.schema.names, batch.columns)],
+                    names=batch.schema.names
+                )
+
+            mask = None
+            if min_covg is not None:
+                mask = pc.greater_equal(batch.column('covg'), min_covg)
+            if chroms is not None:
+                keep = pc.is_in(batch.column('chr'), value_set=pa.array(list(chroms)))
+                mask = keep if mask is None else pc.and_(mask, keep)
+            if mask is not None:
+                batch = batch.filter(mask)
+
+            yield batch.select(usecols)
+
+def _arrow_to_pandas(table, usecols, dtypes):
+    """Convert pyarrow table to DataFrame with categorical string columns."""
+    df = table.to_pandas(strings_to_categorical=True)
+
+    # Empty tables have no dictionary encoded strings to convert
+    for col in usecols:
+        if dtypes[col] == 'category' and df[col].dtype.name != 'category':
+            df[col] = df[col].astype('category')
+
+    return df
+
+def _read_arrow(fname, names, usecols, dtypes, min_covg, chroms, na_values):
+    """Read BED file with pyarrow, see read_bed()."""
+    batches = list(_iter_arrow(fname, names, usecols, dtypes, min_covg, chroms, na_values))
+
+    schema = pa.schema([(col, ARROW_TYPES[dtypes[col]]) for col in usecols])
+    table = pa.Table.from_batches(batches, schema=schema)
+
+    return _arrow_to_pandas(table, usecols, dtypes)
+
+def _iter_pandas(fname, names, usecols, dtypes, min_covg, chroms, na_values):
+    """Yield filtered blocks of BED file read with pandas, see read_bed()."""
+    cols = [c for c in names if c in set(usecols) | filter_columns(min_covg, chroms)]
+
+    for chunk in pd.read_csv(fname, sep='\t', header=None, names=names, usecols=cols,
+                             dtype=dict((c, dtypes[c]) for c in cols if c not in ['covg']),
+                             na_values=list(na_values), chunksize=CHUNKSIZE):
+        # Coverage may be missing in some rows, so it is read as float and
+        # cast once missing values are filled
+        if 'covg' in cols and fills_covg(dtypes):
+            chunk['covg'] = chunk['covg'].fillna(0)
+        if min_covg is not None:
+            chunk = chunk[chunk['covg'] >= min_covg]
+        if chroms is not None:
+            chunk = chunk[chunk['chr'].isin(chroms)]
+
+        chunk = chunk[usecols]
+        if 'covg' in usecols:
+            chunk = chunk.astype({'covg': dtypes['covg']})
+
+        yield chunk
+
+def _read_pandas(fname, names, usecols, dtypes, min_covg, chroms, na_values):
+    """Read BED file with pandas, see read_bed()."""
+    chunks = list(_iter_pandas(fname, names, usecols, dtypes, min_covg, chroms, na_values))
+
+    if len(chunks) == 0:
+        return empty_frame(usecols, dtypes)
+
+    # Give each chunk the same categories so concatenation stays categorical
+    for col in usecols:
+        if dtypes[col] == 'category':
+            cats = union_categoricals([c[col] for c in chunks]).categories
+            for c in chunks:
+                c[col] = c[col].cat.set_categories(cats)
+
+    return pd.concat(chunks, ignore_index=True)
+
+def read_bed(fname, names=MERGECG, usecols=None, dtypes=None, min_covg=None,
+             chroms=None, na_values=('.',), engine=None, cache=None):
+    """Read BED file into DataFrame.
+
+    Inputs -
+        fname     - BED file to read (gzipped or not) or file object of
+                    uncompressed BED lines
+        names     - names of columns in file [default: MERGECG]
+        usecols   - columns to keep [default: all columns in names]
+        dtypes    - dictionary of {column: dtype} overriding DTYPES
+                    [default: None]
+        min_covg  - only keep rows with covg >= min_covg [default: keep all]
+        chroms    - only keep rows on these chromosomes [default: keep all]
+        na_values - strings to treat as missing values, missing values of an
+                    integer covg column are read as 0 [default: ('.',)]
+        engine    - 'pyarrow' or 'pandas' [default: pyarrow if installed]
+        cache     - whether to load from (and write) a sidecar cache of the
+                    parsed columns, only used for file names [default: CACHE]
+    Returns -
+        DataFrame with requested columns
+    """
+    if usecols is None:
+        usecols = list(names)
+    if chroms is not None and isinstance(chroms, str):
+        chroms = [chroms]
+    if engine is None:
+        engine = 'pandas' if pa is None else 'pyarrow'
+    if cache is None:
+        cache = CACHE
+
+    dtypes = column_dtypes(names, dtypes)
+    usecols = list(usecols)
+
+    def read():
+        """Parse fname."""
+        if engine == 'pyarrow':
+            return _read_arrow(fname, names, usecols, dtypes, min_covg, chroms, na_values)
+
+        return _read_pandas(fname, names, usecols, dtypes, min_covg, chroms, na_values)
+
+    if cache and isinstance(fname, str) and bed_cache.available():
+        return bed_cache.cached_read(
+            fname, read, names=list(names), usecols=usecols, dtypes=dtypes, min_covg=min_covg,
+            chroms=None if chroms is None else sorted(chroms), na_values=list(na_values)
+        )
+
+    return read()
+
+def iter_bed(fname, names=MERGECG, usecols=None, dtypes=None, min_covg=None,
+             chroms=None, na_values=('.',), engine=None):
+    """Read BED file as a sequence of DataFrames, one block at a time.
+
+    Blocks follow the order of lines in fname and only one is held in memory
+    at a time. Categorical columns may have different categories in each
+    block.
+
+    Inputs -
+        same as read_bed()
+    Yields -
+        DataFrame with requested columns for each block of lines
+    """
+    if usecols is None:
+        usecols = list(names)
+    if chroms is not None and isinstance(chroms, str):
+        chroms = [chroms]
+    if engine is None:
+        engine = 'pandas' if pa is None else 'pyarrow'
+
+    dtypes = column_dtypes(names, dtypes)
+    usecols = list(usecols)
+
+    if engine == 'pyarrow':
+        for batch in _iter_arrow(fname, names, usecols, dtypes, min_covg, chroms, na_values):
+            if batch.num_rows > 0:
+                yield _arrow_to_pandas(pa.Table.from_batches([batch]), usecols, dtypes)
+        return
+
+    for chunk in _iter_pandas(fname, names, usecols, dtypes, min_covg, chroms, na_values):
+        if len(chunk) > 0:
+            yield chunk
+
+def list_chromosomes(fname):
+    """List chromosomes in BED file.
+
+    Inputs -
+        fname - BED file (bgzipped and tabix-indexed for a fast lookup)
+    Returns -
+        list of chromosome names, in file order if read from tabix index
+    """
+    if tabix.has_index(fname):
+        return tabix.read_index(fname)['names']
+
+    # Without an index the chromosome column has to be read
+    df = read_bed(fname, usecols=['chr'])
+
+    return list(df['chr'].unique())
+
+def read_region(fname, region, **kwargs):
+    """Read one region of tabix-indexed BED file into DataFrame.
+
+    Only the BGZF blocks holding region are decompressed when fname.tbi
+    exists. Otherwise the whole file is streamed and filtered, which needs a
+    whole chromosome as the region.
+
+    Inputs -
+        fname  - bgzipped, tabix-indexed BED file
+        region - chromosome or chr:start-end (1-based, inclusive) to read
+        kwargs - other arguments passed on to read_bed()
+    Returns -
+        DataFrame with requested columns for lines in region
+    """
+    if not tabix.has_index(fname):
+        if ':' in region:
+            raise ValueError(f'[read_region] {fname} needs a tabix index to read {region}')
+        return read_bed(fname, chroms=[region], **kwargs)
+
+    chrom, beg, end = tabix.parse_region(region)
+    lines = tabix.fetch(fname, chrom, beg, end)
+
+    if len(lines) == 0:
+        names = kwargs.get('names', MERGECG)
+        usecols = kwargs.get('usecols', None)
+        return empty_frame(list(names if usecols is None else usecols),
+                           column_dtypes(names, kwargs.get('dtypes', None)))
+
+    return read_bed(io.BytesIO(lines), **kwargs)
+
+def read_manifest(fname):
+    """Read sample manifest.
+
+    Inputs -
+        fname - tab-separated file with tag and file columns (header required,
+                lines starting with # are skipped), where file is a mergecg
+                BED file
+    Returns -
+        list of (tag, file) tuples
+    """
+    df = pd.read_csv(fname, sep='\t', comment='#', dtype=str)
+    if df['tag'].duplicated().any():
+        raise ValueError(f'[read_manifest] duplicate tags in {fname}')
+
+    return list(zip(df['tag'], df['file']))
@@ -0,0 +1,224 @@
+"""Correlation matrices between samples with pairwise-complete NaN handling.
+
+Samples are columns of one (window x sample) matrix. Sums needed for every
+pair are found with matrix products over the values and their non-missing
+masks, so all pairs are computed at once. For Spearman correlations each
+column is ranked once; only pairs whose missing values differ (so that the
+ranks within their shared rows differ from the column ranks) are re-ranked.
+Results match scipy.stats.spearmanr / pearsonr on the NaN-filtered pairs.
+Block bootstrap confidence intervals reuse the same sums, found once per block.
+"""
+from scipy.stats import rankdata
+from scipy.special import stdtr
+import numpy as np
+
+def pairwise_sums(x, y=None):
+    """Find sums over pairwise-complete rows for every pair of columns.
+
+    Inputs -
+        x - np.array (n x k) of values, NaN where missing
+        y - np.array (n x k) of values with the same missing values as x, used
+            in place of x as the second column of each pair [default: x]
+    Returns -
+        dictionary of (k x k) np.arrays, where entry [i, j] is over rows where
+        both columns i and j have values
+            'n'   - number of rows
+            'sx'  - sum of x[:, i]
+            'sy'  - sum of y[:, j]
+            'sxx' - sum of x[:, i]**2
+            'syy' - sum of y[:, j]**2
+            'sxy' - sum of x[:, i] * y[:, j]
+    """
+    if y is None:
+        y = x
+
+    valid = (~np.isnan(x)).astype(np.float64)
+    x0 = np.where(valid > 0, x, 0).astype(np.float64)
+    y0 = np.where(valid > 0, y, 0).astype(np.float64)
+
+    sx = x0.T @ valid
+    sxx = (x0 * x0).T @ valid
+
+    return {
+        'n': valid.T @ valid,
+        'sx': sx,
+        'sy': sx.T if y is x else (valid.T @ y0),
+        'sxx': sxx,
+        'syy': sxx.T if y is x else (valid.T @ (y0 * y0)),
+        'sxy': x0.T @ y0
+    }
+
+def p_values(r, n):
+    """Find two-sided p-values of correlation coefficients (t-test, n-2 df).
+
+    Inputs -
+        r - np.array of correlation coefficients
+        n - np.array of number of observations
+    Returns -
+        np.array of p-values (NaN where n < 3)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df = n - 2
+        t = r * np.sqrt(df / ((1 - r) * (1 + r)))
+        p = 2 * stdtr(df, -np.abs(t))
+
+    p = np.where(np.abs(r) >= 1, 0.0, p)
+
+    return np.where(n < 3, np.nan, p)
+
+def pearson_from_sums(s):
+    """Find Pearson correlation from output of pairwise_sums()."""
+    n = s['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = n * s['sxy'] - s['sx'] * s['sy']
+        r = cov / np.sqrt((n * s['sxx'] - s['sx']**2) * (n * s['syy'] - s['sy']**2))
+
+    return np.clip(r, -1, 1)
+
+def pearson_matrix(x):
+    """Find Pearson correlation between every pair of columns.
+
+    Inputs -
+        x - np.array (n x k) of values, NaN where missing
+    Returns -
+        tuple of (k x k) np.arrays (n, r, p)
+    """
+    s = pairwise_sums(x)
+    r = pearson_from_sums(s)
+
+    return s['n'], r, p_values(r, s['n'])
+
+def rank_columns(x):
+    """Rank non-missing values of each column (ties get the average rank).
+
+    Inputs -
+        x - np.array (n x k) of values, NaN where missing
+    Returns -
+        np.array (n x k) of ranks, NaN where missing
+    """
+    ranks = np.full(x.shape, np.nan)
+    for col in range(x.shape[1]):
+        valid = ~np.isnan(x[:, col])
+        ranks[valid, col] = rankdata(x[valid, col])
+
+    return ranks
+
+def spearman_matrix(x, ranks=None):
+    """Find Spearman correlation between every pair of columns.
+
+    Inputs -
+        x     - np.array (n x k) of values, NaN where missing
+        ranks - output of rank_columns(x) [default: computed from x]
+    Returns -
+        tuple of (k x k) np.arrays (n, r, p)
+    """
+    if ranks is None:
+        ranks = rank_columns(x)
+
+    s = pairwise_sums(ranks)
+    r = pearson_from_sums(s)
+
+    # Column ranks are only the ranks within the shared rows when neither
+    # column is missing a value the other has
+    valid = ~np.isnan(x)
+    n_valid = valid.sum(axis=0)
+    shared = s['n']
+    for i, j in zip(*np.nonzero((shared != n_valid[:, None]) | (shared != n_valid[None, :]))):
+        if j < i:
+            continue
+        both = valid[:, i] & valid[:, j]
+        if both.sum() < 2:
+            r[i, j] = r[j, i] = np.nan
+            continue
+        c = np.corrcoef(rankdata(x[both, i]), rankdata(x[both, j]))[0, 1]
+        r[i, j] = r[j, i] = c
+
+    return shared, r, p_values(r, shared)
+
+def lin_matrix(x):
+    """Find Lin's concordance correlation coefficient between every pair of
+    columns.
+
+    Inputs -
+        x - np.array (n x k) of values, NaN where missing
+    Returns -
+        (k x k) np.array of concordance correlation coefficients
+    """
+    s = pairwise_sums(x)
+    n = s['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mx = s['sx'] / n
+        my = s['sy'] / n
+        vx = s['sxx'] / n - mx**2
+        vy = s['syy'] / n - my**2
+        cov = s['sxy'] / n - mx * my
+
+        return 2 * cov / (vx + vy + (mx - my)**2)
+
+def block_sums(x, blocks):
+    """Find pairwise_sums() separately for each block of rows.
+
+    Inputs -
+        x      - np.array (n x k) of values, NaN where missing
+        blocks - np.array (n) of integer block codes (0 to n_blocks-1)
+    Returns -
+        dictionary of (n_blocks x k x k) np.arrays, keyed as pairwise_sums()
+    """
+    out = None
+    n_blocks = int(blocks.max()) + 1 if len(blocks) > 0 else 0
+    for b in range(n_blocks):
+        s = pairwise_sums(x[blocks == b])
+        if out is None:
+            out = dict((key, np.zeros((n_blocks,) + val.shape)) for key, val in s.items())
+        for key, val in s.items():
+            out[key][b] = val
+
+    return out
+
+def bootstrap_spearman(x, blocks, n_boot, level=0.95, ranks=None, seed=0, batch=1000):
+    """Find block bootstrap confidence intervals of Spearman correlations.
+
+    Whole blocks (e.g., chromosomes) are resampled with replacement. A
+    replicate only changes how many times each block is counted, so its sums
+    are a weighted sum of the per-block sums and each batch of replicates is
+    one matrix product. Columns are ranked once on the full data, and each
+    replicate's correlation is the Pearson correlation of those ranks.
+
+    Inputs -
+        x      - np.array (n x k) of values, NaN where missing
+        blocks - np.array (n) of integer block codes (0 to n_blocks-1)
+        n_boot - number of bootstrap replicates
+        level  - confidence level [default: 0.95]
+        ranks  - output of rank_columns(x) [default: computed from x]
+        seed   - seed of random number generator [default: 0]
+        batch  - number of replicates computed at once [default: 1000]
+    Returns -
+        tuple of (k x k) np.arrays (lower bound, upper bound)
+    """
+    if ranks is None:
+        ranks = rank_columns(x)
+
+    sums = block_sums(ranks, blocks)
+    keys = list(sums.keys())
+    n_blocks, k = sums['n'].shape[:2]
+
+    # (n_blocks x (n_keys * k * k)) matrix of per-block sums
+    flat = np.stack([sums[key].reshape(n_blocks, -1) for key in keys], axis=1).reshape(n_blocks, -1)
+
+    rng = np.random.default_rng(seed)
+    reps = []
+    for start in range(0, n_boot, batch):
+        size = min(batch, n_boot - start)
+        picks = rng.integers(0, n_blocks, size=(size, n_blocks))
+        weights = np.zeros((size, n_blocks))
+        np.add.at(weights, (np.repeat(np.arange(size), n_blocks), picks.ravel()), 1)
+
+        total = (weights @ flat).reshape(size, len(keys), k, k)
+        reps.append(pearson_from_sums(dict((key, total[:, i]) for i, key in enumerate(keys))))
+    reps = np.concatenate(reps)
+
+    alpha = (1 - level) / 2
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanquantile(reps, [alpha, 1 - alpha], axis=0)
+
+    return low, high
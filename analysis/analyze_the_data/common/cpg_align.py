@@ -0,0 +1,113 @@
+"""Align CpG values from several samples on integer genome coordinates.
+
+Each (chr, start) pair is packed into a single int64 coordinate (chromosome
+code in the upper 32 bits, start in the lower 32 bits). Chromosome codes follow
+the lexicographic order of the chromosome names, so sorting by coordinate is
+the same as sorting by chromosome name and then start position (the order used
+by bedtools sort). Samples are aligned into one coordinate x sample matrix per
+value column, replacing repeated pairwise merges on string keys.
+"""
+import pandas as pd
+import numpy as np
+
+# Number of bits used for start position in packed coordinates
+SHIFT = 32
+
+def chromosome_order(frames):
+    """Find sorted list of all chromosomes in frames.
+
+    Inputs -
+        frames - list of DataFrames with chr column
+    Returns -
+        sorted list of chromosome names
+    """
+    chroms = set()
+    for df in frames:
+        if df['chr'].dtype.name == 'category':
+            chroms.update(df['chr'].cat.categories)
+        else:
+            chroms.update(df['chr'].unique())
+
+    return sorted(str(c) for c in chroms)
+
+def pack(chrs, starts, chroms):
+    """Pack chromosome and start position into int64 coordinates.
+
+    Inputs -
+        chrs   - array-like of chromosome names
+        starts - array-like of start positions
+        chroms - sorted list of chromosome names (from chromosome_order)
+    Returns -
+        np.array of int64 coordinates
+    """
+    codes = pd.Categorical(chrs, categories=chroms).codes.astype(np.int64)
+    if (codes < 0).any():
+        raise ValueError('[pack] chromosome missing from chromosome order')
+
+    return (codes << SHIFT) | np.asarray(starts, dtype=np.int64)
+
+def unpack(coords, chroms):
+    """Unpack int64 coordinates into chromosome and start position.
+
+    Inputs -
+        coords - np.array of int64 coordinates
+        chroms - sorted list of chromosome names used to pack coords
+    Returns -
+        tuple (pd.Categorical of chromosome names, np.array of int64 starts)
+    """
+    codes = (coords >> SHIFT).astype(np.int32)
+    starts = coords & ((1 << SHIFT) - 1)
+
+    return pd.Categorical.from_codes(codes, categories=chroms), starts
+
+def align(frames, values=('beta',), how='outer', chroms=None):
+    """Align values from several samples into coordinate x sample matrices.
+
+    Inputs -
+        frames - list of DataFrames with chr, start, end, and value columns
+                 (one per sample, each CpG appearing at most once)
+        values - value columns to align [default: ('beta',)]
+        how    - 'outer' keeps CpGs found in any sample, 'inner' only CpGs
+                 found in every sample [default: 'outer']
+        chroms - sorted list of chromosome names [default: from frames]
+    Returns -
+        dictionary with
+            'chroms' - sorted list of chromosome names
+            'coords' - sorted np.array of int64 coordinates (n CpGs)
+            'chr'    - pd.Categorical of chromosome names (n CpGs)
+            'start'  - np.array of start positions (n CpGs)
+            'end'    - np.array of end positions (n CpGs)
+            value    - np.array (n CpGs x n samples) of float values, NaN
+                       where a sample has no value, for each value column
+    """
+    if chroms is None:
+        chroms = chromosome_order(frames)
+
+    keys = [pack(df['chr'], df['start'], chroms) for df in frames]
+
+    # Merge all sorted coordinate lists into one index
+    if how == 'inner':
+        coords = keys[0]
+        for k in keys[1:]:
+            coords = np.intersect1d(coords, k, assume_unique=True)
+        coords = np.sort(coords)
+    else:
+        coords = np.unique(np.concatenate(keys))
+
+    out = {'chroms': chroms, 'coords': coords}
+    out['chr'], out['start'] = unpack(coords, chroms)
+
+    out['end'] = np.zeros(len(coords), dtype=np.int64)
+    for v in values:
+        out[v] = np.full((len(coords), len(frames)), np.nan, dtype=np.float32)
+
+    for idx, (df, k) in enumerate(zip(frames, keys)):
+        pos = np.searchsorted(coords, k)
+        found = pos < len(coords)
+        found[found] = coords[pos[found]] == k[found]
+
+        out['end'][pos[found]] = np.asarray(df['end'])[found]
+        for v in values:
+            out[v][pos[found], idx] = np.asarray(df[v], dtype=np.float32)[found]
+
+    return out
@@ -0,0 +1,18 @@
+"""Describe files so cached results derived from them can be checked."""
+import os
+
+def fingerprint(fname):
+    """Create fingerprint of file used to decide if a cached value is stale.
+
+    Inputs -
+        fname - file to fingerprint
+    Returns -
+        dictionary with absolute path, size, and modification time of file
+    """
+    stat = os.stat(fname)
+
+    return {
+        'path': os.path.abspath(fname),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns
+    }
@@ -0,0 +1,154 @@
+"""Join coordinate-sorted CpG files by walking them in lockstep.
+
+mergecg files are sorted by chromosome name and start position (bedtools
+sort), so several of them can be aligned with a merge join instead of loading
+every file and joining on hash keys. Each file is read one block at a time.
+The CpGs of the current chromosome are emitted up to the smallest start
+position reached by the files whose block ended partway through that
+chromosome, since no later line of those files can come before it. Memory use
+depends on the block size and number of files, not on the size of the files.
+"""
+import numpy as np
+
+import bed_reader
+
+def segments(fname, min_covg=None):
+    """Read BED file as pieces holding one chromosome each.
+
+    Inputs -
+        fname    - coordinate-sorted mergecg BED file
+        min_covg - only keep CpGs with covg >= min_covg [default: keep all]
+    Yields -
+        tuple (chromosome, starts, ends, betas, covgs) of np.arrays, where a
+        chromosome split between blocks of the file comes as several pieces
+    """
+    cols = ['chr', 'start', 'end', 'beta', 'covg']
+    for df in bed_reader.iter_bed(fname, usecols=cols, min_covg=min_covg):
+        chrs = df['chr'].astype(str).to_numpy()
+        starts = df['start'].to_numpy(dtype=np.int64)
+        ends = df['end'].to_numpy(dtype=np.int64)
+        betas = df['beta'].to_numpy(dtype=np.float32)
+        covgs = df['covg'].to_numpy(dtype=np.uint32)
+
+        bounds = np.concatenate([[0], np.flatnonzero(chrs[1:] != chrs[:-1]) + 1, [len(chrs)]])
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if np.any(np.diff(starts[lo:hi]) < 0):
+                raise ValueError(f'[segments] {fname} is not sorted by start position')
+            yield chrs[lo], starts[lo:hi], ends[lo:hi], betas[lo:hi], covgs[lo:hi]
+
+def open_stream(fname, min_covg=None):
+    """Start reading file, keeping the current and the next piece."""
+    pieces = segments(fname, min_covg)
+    stream = {'fname': fname, 'pieces': pieces, 'head': next(pieces, None)}
+    stream['next'] = next(pieces, None)
+
+    return stream
+
+def advance(stream):
+    """Move stream on to its next piece."""
+    stream['head'] = stream['next']
+    stream['next'] = next(stream['pieces'], None)
+
+def combine(chrom, pieces, how):
+    """Align pieces of several files on the same chromosome.
+
+    Inputs -
+        chrom  - chromosome of pieces
+        pieces - list with (starts, ends, betas, covgs) tuple for each file
+                 (None for files with no CpGs in this range)
+        how    - 'outer' or 'inner'
+    Returns -
+        dictionary from merge_join() (None if no CpGs are kept)
+    """
+    present = [p for p in pieces if p is not None]
+    if len(present) == 0 or (how == 'inner' and len(present) < len(pieces)):
+        return None
+
+    starts, counts = np.unique(np.concatenate([p[0] for p in present]), return_counts=True)
+    if how == 'inner':
+        starts = starts[counts == len(pieces)]
+    if len(starts) == 0:
+        return None
+
+    out = {
+        'chr': chrom,
+        'start': starts,
+        'end': np.zeros(len(starts), dtype=np.int64),
+        'beta': np.full((len(starts), len(pieces)), np.nan, dtype=np.float32),
+        'covg': np.zeros((len(starts), len(pieces)), dtype=np.uint32)
+    }
+    for idx, p in enumerate(pieces):
+        if p is None:
+            continue
+        pos = np.searchsorted(starts, p[0])
+        found = pos < len(starts)
+        found[found] = starts[pos[found]] == p[0][found]
+
+        out['end'][pos[found]] = p[1][found]
+        out['beta'][pos[found], idx] = p[2][found]
+        out['covg'][pos[found], idx] = p[3][found]
+
+    return out
+
+def merge_join(fnames, how='outer', min_covg=None):
+    """Align CpGs of coordinate-sorted files, one block at a time.
+
+    Inputs -
+        fnames   - list of mergecg BED files sorted by chromosome name and
+                   start position (as by bedtools sort)
+        how      - 'outer' keeps CpGs found in any file, 'inner' only CpGs
+                   found in every file [default: 'outer']
+        min_covg - minimum coverage of CpGs kept, one value for all files or a
+                   list with one value per file [default: keep all]
+    Yields -
+        dictionary for each block of CpGs on one chromosome, in sorted order
+            'chr'   - chromosome name
+            'start' - np.array of start positions (n CpGs)
+            'end'   - np.array of end positions (n CpGs)
+            'beta'  - np.array (n CpGs x n files) of float32 beta values, NaN
+                      where a file has no value
+            'covg'  - np.array (n CpGs x n files) of uint32 coverage, 0 where a
+                      file has no value
+    """
+    if how not in ['outer', 'inner']:
+        raise ValueError(f'[merge_join] unknown join: {how}')
+    if min_covg is None or np.isscalar(min_covg):
+        min_covg = [min_covg] * len(fnames)
+
+    streams = [open_stream(f, c) for f, c in zip(fnames, min_covg)]
+    last = None
+    while True:
+        live = [s for s in streams if s['head'] is not None]
+        if len(live) == 0:
+            return
+
+        chrom = min(s['head'][0] for s in live)
+        if last is not None and chrom < last:
+            bad = [s['fname'] for s in live if s['head'][0] == chrom]
+            raise ValueError(f'[merge_join] {bad[0]} is not sorted by chromosome')
+        last = chrom
+
+        # Files whose next piece continues this chromosome may still hold
+        # CpGs past the end of their current piece
+        limits = [s['head'][1][-1] for s in live
+                  if s['head'][0] == chrom and s['next'] is not None and s['next'][0] == chrom]
+        limit = min(limits) if len(limits) > 0 else None
+
+        pieces = []
+        for s in streams:
+            if s['head'] is None or s['head'][0] != chrom:
+                pieces.append(None)
+                continue
+
+            c, starts, ends, betas, covgs = s['head']
+            k = len(starts) if limit is None else np.searchsorted(starts, limit, side='right')
+            pieces.append((starts[:k], ends[:k], betas[:k], covgs[:k]) if k > 0 else None)
+
+            if k == len(starts):
+                advance(s)
+            else:
+                s['head'] = (c, starts[k:], ends[k:], betas[k:], covgs[k:])
+
+        block = combine(chrom, pieces, how)
+        if block is not None:
+            yield block
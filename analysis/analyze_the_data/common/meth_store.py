@@ -0,0 +1,275 @@
+"""On-disk store of CpG beta values and coverage for a cohort of samples.
+
+Analyses of several samples otherwise parse and align the same gzipped mergecg
+files on every run. The store is built once per cohort and holds
+    - coords.npy        - sorted int64 coordinates of every CpG found in any
+                          sample (packed as in cpg_align)
+    - end.npy           - int32 end position of each CpG
+    - <tag>.beta.npy    - float32 beta value of each CpG (NaN if not covered)
+    - <tag>.covg.npy    - uint16 coverage of each CpG (0 if not covered,
+                          capped at MAX_COVG)
+    - meta.json         - samples, chromosomes and the row range of each
+                          chromosome, and the fingerprint of each source file
+All arrays are row aligned and are opened as memory maps, so loading a
+cohort costs nothing up front and a query only reads the rows of the samples
+it asks for.
+"""
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import sys
+import os
+
+from fileinfo import fingerprint
+from atomic import atomic_output
+import bed_reader
+import cpg_align
+import tabix
+
+# Name of store metadata file
+META = 'meta.json'
+
+# Largest coverage stored (uint16)
+MAX_COVG = np.iinfo(np.uint16).max
+
+def column_name(store_dir, tag, kind):
+    """Find name of beta ('beta') or coverage ('covg') column of sample."""
+    return os.path.join(store_dir, '{}.{}.npy'.format(tag, kind))
+
+def collect_coords(samples):
+    """Find every CpG found in any sample.
+
+    Inputs -
+        samples - list of (tag, file) tuples
+    Returns -
+        tuple (sorted list of chromosome names, sorted np.array of int64
+        coordinates)
+    """
+    starts = {}
+    for tag, fname in samples:
+        for chunk in bed_reader.iter_bed(fname, usecols=['chr', 'start']):
+            codes, names = pd.factorize(chunk['chr'].astype(str))
+            pos = chunk['start'].to_numpy(dtype=np.int64)
+            for idx, chrom in enumerate(names):
+                starts.setdefault(chrom, []).append(pos[codes == idx])
+
+        # Keep only distinct positions between samples to bound memory
+        for chrom in starts:
+            starts[chrom] = [np.unique(np.concatenate(starts[chrom]))]
+
+    chroms = sorted(starts)
+    coords = [cpg_align.pack(np.repeat(chrom, len(starts[chrom][0])), starts[chrom][0], chroms)
+              for chrom in chroms]
+
+    return chroms, np.concatenate(coords) if len(coords) > 0 else np.zeros(0, dtype=np.int64)
+
+def ingest(samples, store_dir):
+    """Build store from mergecg files.
+
+    Each file is read twice, once to collect CpG coordinates and once to fill
+    its columns, and is never held in memory as a whole.
+
+    Inputs -
+        samples   - list of (tag, file) tuples
+        store_dir - directory to write store to
+    Returns -
+        Nothing, store written to store_dir (meta.json is written last)
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    # Store is incomplete until meta.json is written again
+    if os.path.exists(os.path.join(store_dir, META)):
+        os.remove(os.path.join(store_dir, META))
+
+    chroms, coords = collect_coords(samples)
+    np.save(os.path.join(store_dir, 'coords.npy'), coords)
+
+    end = np.lib.format.open_memmap(os.path.join(store_dir, 'end.npy'), mode='w+',
+                                    dtype=np.int32, shape=(len(coords),))
+    for tag, fname in samples:
+        beta = np.lib.format.open_memmap(column_name(store_dir, tag, 'beta'), mode='w+',
+                                         dtype=np.float32, shape=(len(coords),))
+        covg = np.lib.format.open_memmap(column_name(store_dir, tag, 'covg'), mode='w+',
+                                         dtype=np.uint16, shape=(len(coords),))
+        beta[:] = np.nan
+
+        for chunk in bed_reader.iter_bed(fname, usecols=['chr', 'start', 'end', 'beta', 'covg']):
+            pos = np.searchsorted(coords, cpg_align.pack(chunk['chr'].astype(str), chunk['start'], chroms))
+            end[pos] = chunk['end'].to_numpy()
+            beta[pos] = chunk['beta'].to_numpy()
+            covg[pos] = np.minimum(chunk['covg'].to_numpy(), MAX_COVG)
+
+        beta.flush()
+        covg.flush()
+        del beta, covg
+    end.flush()
+    del end
+
+    # Chromosomes are contiguous blocks of rows
+    codes = coords >> cpg_align.SHIFT
+    bounds = np.searchsorted(codes, np.arange(len(chroms) + 1))
+    meta = {
+        'samples': [tag for tag, fname in samples],
+        'chroms': chroms,
+        'rows': dict((chrom, [int(bounds[i]), int(bounds[i+1])]) for i, chrom in enumerate(chroms)),
+        'sources': dict((tag, fingerprint(fname)) for tag, fname in samples)
+    }
+    with atomic_output(os.path.join(store_dir, META)) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=4)
+
+def up_to_date(samples, store_dir):
+    """Check whether store holds exactly samples, built from unchanged files.
+
+    Inputs -
+        samples   - list of (tag, file) tuples
+        store_dir - directory of store
+    Returns -
+        bool
+    """
+    if not os.path.exists(os.path.join(store_dir, META)):
+        return False
+
+    with open(os.path.join(store_dir, META), 'r') as f:
+        meta = json.load(f)
+
+    return meta['sources'] == dict((tag, fingerprint(fname)) for tag, fname in samples)
+
+def open_store(store_dir):
+    """Open store for queries.
+
+    Inputs -
+        store_dir - directory of store
+    Returns -
+        dictionary with store metadata, memory-mapped coords and end arrays,
+        and the directory of the store ('dir')
+    """
+    with open(os.path.join(store_dir, META), 'r') as f:
+        store = json.load(f)
+
+    store['dir'] = store_dir
+    store['coords'] = np.load(os.path.join(store_dir, 'coords.npy'), mmap_mode='r')
+    store['end'] = np.load(os.path.join(store_dir, 'end.npy'), mmap_mode='r')
+
+    return store
+
+def column(store, tag, kind):
+    """Memory map beta ('beta') or coverage ('covg') column of sample."""
+    if tag not in store['samples']:
+        raise ValueError(f'[column] sample {tag} is not in store {store["dir"]}')
+
+    return np.load(column_name(store['dir'], tag, kind), mmap_mode='r')
+
+def region_rows(store, region):
+    """Find rows of CpGs overlapping region.
+
+    Inputs -
+        store  - output of open_store()
+        region - chromosome or chr:start-end (1-based, inclusive)
+    Returns -
+        slice of rows
+    """
+    chrom, beg, end = tabix.parse_region(region)
+    if chrom not in store['rows']:
+        return slice(0, 0)
+
+    lo, hi = store['rows'][chrom]
+    if beg <= 0 and end >= tabix.MAX_POS:
+        return slice(lo, hi)
+
+    # Coordinates on one chromosome sort by start position
+    coords = store['coords']
+    code = store['chroms'].index(chrom) << cpg_align.SHIFT
+    first = lo + np.searchsorted(coords[lo:hi], code | beg, side='left')
+    last = lo + np.searchsorted(coords[lo:hi], code | end, side='left')
+
+    # A CpG starting before beg can still overlap it
+    while first > lo and store['end'][first-1] > beg:
+        first -= 1
+
+    return slice(int(first), int(last))
+
+def query(store, region=None, samples=None, min_covg=None, how='outer'):
+    """Find aligned beta values and coverage of samples in a region.
+
+    Inputs -
+        store    - output of open_store()
+        region   - chromosome or chr:start-end (1-based, inclusive)
+                   [default: whole genome]
+        samples  - list of sample tags, in column order [default: all]
+        min_covg - beta values of CpGs with covg < min_covg are set to NaN
+                   [default: keep all]
+        how      - 'outer' keeps CpGs with a beta value in any sample, 'inner'
+                   only CpGs with a beta value in every sample
+                   [default: 'outer']
+    Returns -
+        dictionary in the same form as cpg_align.align(), with 'beta' and
+        'covg' (n CpGs x n samples) values
+    """
+    if samples is None:
+        samples = store['samples']
+    rows = slice(0, len(store['coords'])) if region is None else region_rows(store, region)
+
+    n_rows = rows.stop - rows.start
+    beta = np.empty((n_rows, len(samples)), dtype=np.float32)
+    covg = np.empty((n_rows, len(samples)), dtype=np.uint16)
+    for idx, tag in enumerate(samples):
+        beta[:, idx] = column(store, tag, 'beta')[rows]
+        covg[:, idx] = column(store, tag, 'covg')[rows]
+
+    if min_covg is not None:
+        beta[covg < min_covg] = np.nan
+
+    # Drop CpGs only found in samples not asked for (or filtered out)
+    valid = ~np.isnan(beta)
+    keep = valid.all(axis=1) if how == 'inner' else valid.any(axis=1)
+
+    coords = np.asarray(store['coords'][rows])[keep]
+    out = {'chroms': store['chroms'], 'coords': coords}
+    out['chr'], out['start'] = cpg_align.unpack(coords, store['chroms'])
+    out['end'] = np.asarray(store['end'][rows])[keep].astype(np.int64)
+    out['beta'] = beta[keep]
+    out['covg'] = covg[keep]
+
+    return out
+
+def main():
+    """Build methylation store from a manifest of mergecg files."""
+    parser = argparse.ArgumentParser(
+        description = 'meth_store.py builds a memory-mapped store of CpG beta values and coverage'
+    )
+
+    parser.add_argument(
+        '-o', '--outdir',
+        default = 'meth_store',
+        help = 'Directory to write store to [default: meth_store]'
+    )
+
+    parser.add_argument(
+        '-f', '--force',
+        action = 'store_true',
+        help = 'Rebuild store even if it is up to date'
+    )
+
+    parser.add_argument(
+        'manifest',
+        help = 'Manifest of samples (tag and file columns) to store'
+    )
+
+    args = parser.parse_args()
+
+    samples = bed_reader.read_manifest(args.manifest)
+    if not args.force and up_to_date(samples, args.outdir):
+        print(f'{args.outdir} is up to date')
+        return 0
+
+    ingest(samples, args.outdir)
+
+    store = open_store(args.outdir)
+    print('{}: {:,} CpGs in {} samples'.format(args.outdir, len(store['coords']), len(samples)))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
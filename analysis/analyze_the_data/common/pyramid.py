@@ -0,0 +1,243 @@
+"""Multi-resolution window averages of CpG methylation (window pyramids).
+
+Window averaged files (bedtools map of a mergecg file onto fixed windows) have
+to be remade from the mergecg files for every window size. Instead, each
+mergecg file is read once and reduced to per-window sums (number of CpGs, sum
+of beta values, sum of coverage) at the finest window size. Each coarser level
+is found by adding up the windows of the level below, so every level comes
+from the same pass over the file. Sums, unlike averages, can be combined
+again, so any multiple of a stored window size can also be found on request.
+
+Pyramids are stored as one uncompressed .npz file per sample. Only windows
+holding at least one CpG are stored, and a level's arrays are only read from
+disk when that level is queried.
+"""
+import pandas as pd
+import numpy as np
+import argparse
+import sys
+
+from atomic import atomic_output
+import bed_reader
+
+# Window sizes stored in each pyramid (each divides the next)
+LEVELS = [1000, 10000, 100000, 1000000]
+
+# Ending of pyramid files
+EXT = '.pyramid.npz'
+
+# Arrays stored for each level
+FIELDS = ['chr', 'window', 'n', 'beta_sum', 'covg_sum']
+
+def pyramid_name(fname):
+    """Find name of pyramid file for mergecg file fname."""
+    for ext in ['.bed.gz', '.bed']:
+        if fname.endswith(ext):
+            return fname[:-len(ext)] + EXT
+
+    return fname + EXT
+
+def aggregate(chr_codes, windows, n, beta_sum, covg_sum):
+    """Add up sums of rows falling in the same window.
+
+    Inputs -
+        chr_codes - np.array of chromosome codes
+        windows   - np.array of window numbers (position // window size)
+        n         - np.array of number of CpGs in each row
+        beta_sum  - np.array of sum of beta values in each row
+        covg_sum  - np.array of sum of coverage in each row
+    Returns -
+        dictionary of np.arrays keyed by FIELDS, sorted by chromosome code and
+        window
+    """
+    keys = (chr_codes.astype(np.int64) << 32) | windows.astype(np.int64)
+    uniq, inverse = np.unique(keys, return_inverse=True)
+
+    return {
+        'chr': (uniq >> 32).astype(np.int16),
+        'window': (uniq & 0xffffffff).astype(np.int32),
+        'n': np.bincount(inverse, weights=n, minlength=len(uniq)).astype(np.uint32),
+        'beta_sum': np.bincount(inverse, weights=beta_sum, minlength=len(uniq)),
+        'covg_sum': np.bincount(inverse, weights=covg_sum, minlength=len(uniq)).astype(np.int64)
+    }
+
+def coarsen(level, factor):
+    """Combine every factor neighboring windows of a level into one.
+
+    Inputs -
+        level  - dictionary of np.arrays keyed by FIELDS
+        factor - number of windows combined
+    Returns -
+        dictionary of np.arrays keyed by FIELDS
+    """
+    return aggregate(level['chr'], level['window'] // factor,
+                     level['n'], level['beta_sum'], level['covg_sum'])
+
+def build(fname, levels=LEVELS, min_covg=None):
+    """Reduce mergecg file to window sums at several window sizes.
+
+    A CpG is counted in the window holding its start position.
+
+    Inputs -
+        fname    - mergecg BED file
+        levels   - sorted list of window sizes, each dividing the next
+                   [default: LEVELS]
+        min_covg - only count CpGs with covg >= min_covg [default: all CpGs]
+    Returns -
+        tuple (list of chromosome names, dictionary of {window size: level})
+    """
+    for small, big in zip(levels[:-1], levels[1:]):
+        if big % small != 0:
+            raise ValueError(f'[build] window size {small} does not divide {big}')
+
+    chroms = []
+    parts = []
+    for chunk in bed_reader.iter_bed(fname, usecols=['chr', 'start', 'beta', 'covg'],
+                                     min_covg=min_covg):
+        chunk = chunk[chunk['beta'].notna()]
+
+        # Chromosomes are numbered in order of first appearance in the file
+        names = chunk['chr'].astype(str).to_numpy()
+        for c in pd.unique(names):
+            if c not in chroms:
+                chroms.append(c)
+        codes = pd.Index(chroms).get_indexer(names)
+
+        beta = chunk['beta'].to_numpy(dtype=np.float64)
+        parts.append(aggregate(codes, chunk['start'].to_numpy() // levels[0],
+                               np.ones(len(beta)), beta, chunk['covg'].to_numpy(dtype=np.float64)))
+
+    if len(parts) == 0:
+        finest = dict((f, np.zeros(0, dtype=np.int64)) for f in FIELDS)
+    else:
+        # Windows split across blocks are combined here
+        finest = aggregate(*[np.concatenate([p[f] for p in parts]) for f in FIELDS])
+
+    out = {levels[0]: finest}
+    for small, big in zip(levels[:-1], levels[1:]):
+        out[big] = coarsen(out[small], big // small)
+
+    return chroms, out
+
+def save(fname, chroms, pyramid):
+    """Write pyramid to .npz file.
+
+    Inputs -
+        fname   - output file
+        chroms  - list of chromosome names
+        pyramid - dictionary of {window size: level} from build()
+    Returns -
+        Nothing, pyramid written to fname
+    """
+    arrays = {'chroms': np.array(chroms, dtype=str), 'levels': np.array(sorted(pyramid), dtype=np.int64)}
+    for size, level in pyramid.items():
+        for f in FIELDS:
+            arrays['{}_{}'.format(f, size)] = level[f]
+
+    with atomic_output(fname) as tmp:
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+
+def load(fname):
+    """Open pyramid file (levels are read when queried).
+
+    Inputs -
+        fname - .npz file written by save()
+    Returns -
+        np.lib.npyio.NpzFile
+    """
+    return np.load(fname)
+
+def query(pyramid, size, chroms=None):
+    """Find window averages at one window size.
+
+    Inputs -
+        pyramid - output of load()
+        size    - window size, a stored level or a multiple of one
+        chroms  - only return windows on these chromosomes [default: all]
+    Returns -
+        DataFrame with chr, start, end, beta (mean beta value), covg (mean
+        coverage, as in bedtools map files), n_cpg, and covg_total columns for
+        windows holding at least one CpG, in file order
+    """
+    levels = [int(s) for s in pyramid['levels']]
+    stored = [s for s in levels if s <= size and size % s == 0]
+    if len(stored) == 0:
+        raise ValueError(f'[query] window size {size} is not a multiple of a stored level {levels}')
+
+    base = max(stored)
+    level = dict((f, pyramid['{}_{}'.format(f, base)]) for f in FIELDS)
+    if base != size:
+        level = coarsen(level, size // base)
+
+    names = pyramid['chroms']
+    if chroms is not None:
+        keep = np.isin(names[level['chr']], list(chroms))
+        level = dict((f, v[keep]) for f, v in level.items())
+
+    start = level['window'].astype(np.int64) * size
+    n = level['n'].astype(np.float64)
+
+    return pd.DataFrame({
+        'chr': pd.Categorical.from_codes(level['chr'], categories=list(names)),
+        'start': start,
+        'end': start + size,
+        'beta': (level['beta_sum'] / n).astype(np.float32),
+        'covg': (level['covg_sum'] / n).astype(np.float32),
+        'n_cpg': level['n'],
+        'covg_total': level['covg_sum']
+    })
+
+def read_windows(fname, size, chroms=None):
+    """Read window averages of one window size from a pyramid file.
+
+    Inputs -
+        fname  - .npz file written by save()
+        size   - window size, a stored level or a multiple of one
+        chroms - only return windows on these chromosomes [default: all]
+    Returns -
+        DataFrame from query()
+    """
+    with load(fname) as pyramid:
+        return query(pyramid, size, chroms)
+
+def main():
+    """Build pyramids of window averages for mergecg files."""
+    parser = argparse.ArgumentParser(
+        description = 'pyramid.py finds window averages of mergecg files at several window sizes'
+    )
+
+    parser.add_argument(
+        '-l', '--levels',
+        default = ','.join(str(s) for s in LEVELS),
+        help = 'Comma separated window sizes, each dividing the next ' +
+               '[default: {}]'.format(','.join(str(s) for s in LEVELS))
+    )
+
+    parser.add_argument(
+        '-m', '--min-covg',
+        type = int,
+        default = None,
+        help = 'Only count CpGs with at least this coverage [default: all CpGs]'
+    )
+
+    parser.add_argument(
+        'files',
+        nargs = '+',
+        help = 'mergecg BED files, pyramids are written next to them (<name>' + EXT + ')'
+    )
+
+    args = parser.parse_args()
+
+    levels = sorted(int(s) for s in args.levels.split(','))
+    for fname in args.files:
+        chroms, pyramid = build(fname, levels, args.min_covg)
+        save(pyramid_name(fname), chroms, pyramid)
+        print('{}\t{}'.format(pyramid_name(fname), '\t'.join(
+            '{}={:,}'.format(size, len(pyramid[size]['n'])) for size in levels
+        )))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""Cache mappability-weighted region lengths from the bismap BED files.
+
+The expected coverage used in the observed/expected ratios only depends on the
+reference assets, so the sums are computed once and stored next to the bismap
+files. Each entry is keyed by the fingerprint (path, size, mtime) of the BED
+file it came from and is recomputed automatically when that file changes.
+"""
+import argparse
+import json
+import sys
+import os
+
+import pandas as pd
+
+from fileinfo import fingerprint
+from atomic import atomic_output
+
+# Labels (matching the variable names in the obs/exp PBS scripts) and the
+# default file name of the BED file each length is computed from
+REGIONS = {
+    'REFLEN' : 'k100.bismap.bedgraph.gz',
+    'CPGSLEN': 'cpg_bismap.bed.gz',
+    'CGISLEN': 'cgi_bismap.bed.gz',
+    'RMSKLEN': 'rmsk_bismap.bed.gz',
+    'EXONLEN': 'exon_bismap.bed.gz',
+    'GENELEN': 'genic_regions_bismap.bed.gz',
+    'INTRLEN': 'intergenic_regions_bismap.bed.gz'
+}
+CACHE_NAME = 'region_lengths.json'
+
+def weighted_length(fname):
+    """Find sum of mappability weight times element length for BED file.
+
+    Inputs -
+        fname - bismap BED file (column 4 is the mappability score)
+    Returns -
+        float of the weighted number of bases in file
+    """
+    total = 0.0
+    for chunk in pd.read_csv(fname, sep='\t', header=None, usecols=[1, 2, 3],
+                             dtype={1: 'int64', 2: 'int64', 3: 'float64'},
+                             chunksize=1e7):
+        total += (chunk[3] * (chunk[2] - chunk[1])).sum()
+
+    return float(total)
+
+def region_files(bismap_dir, ref_bed=None):
+    """Collect files each region length is computed from.
+
+    Inputs -
+        bismap_dir - directory with bismap BED files
+        ref_bed    - bismap bedgraph for whole genome [default: in bismap_dir]
+    Returns -
+        dictionary of {label: filename}
+    """
+    files = dict((lab, os.path.join(bismap_dir, f)) for lab, f in REGIONS.items())
+    if ref_bed is not None:
+        files['REFLEN'] = ref_bed
+
+    return files
+
+def lookup(bismap_dir, ref_bed=None, cache=None, rebuild=False):
+    """Retrieve region lengths, only recomputing those that are stale.
+
+    Inputs -
+        bismap_dir - directory with bismap BED files
+        ref_bed    - bismap bedgraph for whole genome [default: in bismap_dir]
+        cache      - JSON file to store lengths in [default: in bismap_dir]
+        rebuild    - whether to ignore cached values [default: False]
+    Returns -
+        dictionary of {label: weighted region length}
+    """
+    if cache is None:
+        cache = os.path.join(bismap_dir, CACHE_NAME)
+
+    stored = {}
+    if os.path.exists(cache) and not rebuild:
+        with open(cache, 'r') as f:
+            stored = json.load(f)
+
+    updated = False
+    lengths = {}
+    for lab, fname in region_files(bismap_dir, ref_bed).items():
+        fprint = fingerprint(fname)
+        entry = stored.get(lab)
+        if entry is None or entry['fingerprint'] != fprint:
+            entry = {'fingerprint': fprint, 'length': weighted_length(fname)}
+            stored[lab] = entry
+            updated = True
+
+        lengths[lab] = entry['length']
+
+    # Write to temporary file first so concurrent jobs never see partial JSON
+    if updated:
+        with atomic_output(cache) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(stored, f, indent=4)
+
+    return lengths
+
+def main():
+    """Print cached region lengths in the order used by the obs/exp scripts."""
+    parser = argparse.ArgumentParser(
+        description = 'region_lengths.py caches mappability-weighted region lengths'
+    )
+
+    parser.add_argument(
+        '-r', '--ref-bed',
+        default = None,
+        help = 'bismap bedgraph for whole genome [default: in bismap_dir]'
+    )
+
+    parser.add_argument(
+        '-c', '--cache',
+        default = None,
+        help = 'JSON file to store lengths in [default: in bismap_dir]'
+    )
+
+    parser.add_argument(
+        '-f', '--force',
+        action = 'store_true',
+        help = 'Recompute all lengths even if cached values are current'
+    )
+
+    parser.add_argument(
+        'bismap_dir',
+        metavar = 'bismap_dir',
+        type = str,
+        help = 'Directory with bismap BED files'
+    )
+
+    args = parser.parse_args()
+
+    lengths = lookup(args.bismap_dir, args.ref_bed, args.cache, args.force)
+
+    # Use %f so values are never written in scientific notation for the shell
+    print('\t'.join('{:f}'.format(lengths[lab]) for lab in REGIONS.keys()))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
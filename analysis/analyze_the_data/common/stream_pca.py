@@ -0,0 +1,78 @@
+"""Principal component analysis of samples from chunks of features read in turn.
+
+PCA of a few samples over millions of CpGs does not need the full sample x CpG
+matrix in memory. Each CpG is standardized across samples on its own (as
+StandardScaler does for each feature), so every chunk of CpGs can be
+standardized as it is read. The sample x sample Gram matrix of the
+standardized values is the sum of the Gram matrices of the chunks, and its
+eigenvectors and eigenvalues give the principal component scores and the
+explained variance exactly. Memory use only depends on the chunk size and the
+number of samples.
+"""
+import numpy as np
+
+def standardize(x):
+    """Center and scale each feature (row) across samples.
+
+    Inputs -
+        x - np.array (n features x n samples)
+    Returns -
+        np.array (n features x n samples), features with no variance are 0
+        (as with sklearn.preprocessing.StandardScaler)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    centered = x - x.mean(axis=1, keepdims=True)
+    scale = centered.std(axis=1, keepdims=True)
+    scale[scale == 0] = 1
+
+    return centered / scale
+
+def components(gram, n_components=2):
+    """Find principal component scores from Gram matrix of centered data.
+
+    Signs follow sklearn.decomposition.PCA (0.24): the largest entry (in
+    absolute value) of each component's scores is positive.
+
+    Inputs -
+        gram         - np.array (n samples x n samples) of x @ x.T, where x
+                       (n samples x n features) has centered features
+        n_components - number of components [default: 2]
+    Returns -
+        tuple (np.array (n samples x n components) of scores, np.array of
+        explained variance ratio of each component)
+    """
+    vals, vecs = np.linalg.eigh(gram)
+    order = np.argsort(vals)[::-1][:n_components]
+    vals = np.clip(vals[order], 0, None)
+    vecs = vecs[:, order]
+
+    signs = np.sign(vecs[np.argmax(np.abs(vecs), axis=0), range(vecs.shape[1])])
+    vecs = vecs * signs
+
+    # Total variance is the trace, summed over all components
+    return vecs * np.sqrt(vals), vals / np.trace(gram)
+
+def gram_pca(chunks, n_components=2):
+    """Standardize features and run PCA of samples over chunks of features.
+
+    Inputs -
+        chunks       - iterable of np.arrays (n features x n samples), the
+                       same samples in every chunk
+        n_components - number of components [default: 2]
+    Returns -
+        tuple (np.array (n samples x n components) of scores, np.array of
+        explained variance ratio of each component, number of features)
+    """
+    gram = None
+    n_features = 0
+    for x in chunks:
+        x = standardize(x)
+        gram = x.T @ x if gram is None else gram + x.T @ x
+        n_features += x.shape[0]
+
+    if gram is None or n_features == 0:
+        raise ValueError('[gram_pca] no features to run PCA on')
+
+    scores, ratio = components(gram, n_components)
+
+    return scores, ratio, n_features
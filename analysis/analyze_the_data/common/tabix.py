@@ -0,0 +1,234 @@
+"""Random access to regions of bgzipped, tabix-indexed files.
+
+The .tbi index maps each chromosome to the BGZF blocks holding its lines, so a
+region query only decompresses those blocks instead of the whole file. The
+index and BGZF formats are described in the SAMtools specifications
+(https://samtools.github.io/hts-specs/tabix.pdf, SAMv1.pdf section 4.1).
+"""
+import struct
+import gzip
+import zlib
+import os
+
+# Largest position covered by the binning scheme
+MAX_POS = 1 << 29
+
+# Size of linear index windows (16 kb)
+LINEAR_SHIFT = 14
+
+def index_name(fname):
+    """Find name of tabix index of fname."""
+    return fname + '.tbi'
+
+def has_index(fname):
+    """Check whether fname has a tabix index."""
+    return isinstance(fname, str) and os.path.exists(index_name(fname))
+
+def read_index(fname):
+    """Read tabix index of file.
+
+    Inputs -
+        fname - bgzipped file (index is read from fname.tbi)
+    Returns -
+        dictionary with
+            'names' - list of chromosome names in file order
+            'refs'  - dictionary of {chromosome: (bins, linear)}, where bins is
+                      a dictionary of {bin: list of (start, end) virtual
+                      offsets} and linear is a list of virtual offsets of the
+                      first line in each 16 kb window
+    """
+    with gzip.open(index_name(fname), 'rb') as f:
+        data = f.read()
+
+    if data[:4] != b'TBI\x01':
+        raise ValueError(f'[read_index] not a tabix index: {index_name(fname)}')
+
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<8i', data, 4)
+    pos = 36
+    names = [n.decode() for n in data[pos:pos+l_nm].split(b'\x00')[:n_ref]]
+    pos += l_nm
+
+    refs = {}
+    for name in names:
+        n_bin, = struct.unpack_from('<i', data, pos)
+        pos += 4
+
+        bins = {}
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+            pos += 8
+            offs = struct.unpack_from('<{}Q'.format(2*n_chunk), data, pos)
+            pos += 16 * n_chunk
+            bins[bin_id] = list(zip(offs[0::2], offs[1::2]))
+
+        n_intv, = struct.unpack_from('<i', data, pos)
+        pos += 4
+        linear = list(struct.unpack_from('<{}Q'.format(n_intv), data, pos))
+        pos += 8 * n_intv
+
+        refs[name] = (bins, linear)
+
+    return {'names': names, 'refs': refs}
+
+def region_to_bins(beg, end):
+    """List bins that may hold lines overlapping [beg, end).
+
+    Inputs -
+        beg - 0-based start of region
+        end - 0-based, exclusive end of region
+    Returns -
+        list of bin numbers
+    """
+    end -= 1
+    bins = [0]
+    for shift, first in [(26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)]:
+        bins.extend(range(first + (beg >> shift), first + (end >> shift) + 1))
+
+    return bins
+
+def region_chunks(index, chrom, beg=0, end=MAX_POS):
+    """Find merged file chunks (pairs of virtual offsets) covering region.
+
+    Inputs -
+        index - output of read_index()
+        chrom - chromosome of region
+        beg   - 0-based start of region [default: 0]
+        end   - 0-based, exclusive end of region [default: end of chromosome]
+    Returns -
+        sorted list of non-overlapping (start, end) virtual offsets
+    """
+    if chrom not in index['refs']:
+        return []
+
+    bins, linear = index['refs'][chrom]
+
+    # Chunks ending before the first line of the window holding beg are skipped
+    min_off = 0
+    if len(linear) > 0:
+        min_off = linear[min(beg >> LINEAR_SHIFT, len(linear)-1)]
+
+    chunks = []
+    for b in region_to_bins(beg, min(end, MAX_POS)):
+        chunks.extend(c for c in bins.get(b, []) if c[1] > min_off)
+    chunks.sort()
+
+    merged = []
+    for start, stop in chunks:
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+
+    return merged
+
+def read_block(f):
+    """Read and decompress next BGZF block.
+
+    Inputs -
+        f - binary file object positioned at the start of a block
+    Returns -
+        decompressed bytes (None at end of file)
+    """
+    header = f.read(12)
+    if len(header) < 12:
+        return None
+
+    xlen, = struct.unpack_from('<H', header, 10)
+    extra = f.read(xlen)
+
+    # Total block size is stored in the BC extra subfield
+    bsize = None
+    pos = 0
+    while pos < xlen:
+        si1, si2, slen = struct.unpack_from('<BBH', extra, pos)
+        if si1 == 66 and si2 == 67:
+            bsize, = struct.unpack_from('<H', extra, pos+4)
+        pos += 4 + slen
+    if bsize is None:
+        raise ValueError('[read_block] not a BGZF block')
+
+    rest = f.read(bsize + 1 - 12 - xlen)
+
+    return zlib.decompress(rest[:-8], -15)
+
+def read_chunk(f, start, stop):
+    """Read uncompressed bytes between two virtual offsets.
+
+    Inputs -
+        f     - binary file object of bgzipped file
+        start - virtual offset of first byte
+        stop  - virtual offset one past the last byte
+    Returns -
+        bytes
+    """
+    out = []
+    f.seek(start >> 16)
+    first = True
+    while True:
+        coff = f.tell()
+        data = read_block(f)
+        if data is None or coff > stop >> 16:
+            break
+
+        if coff == stop >> 16:
+            data = data[:stop & 0xffff]
+        if first:
+            data = data[start & 0xffff:]
+            first = False
+        out.append(data)
+
+        if coff == stop >> 16:
+            break
+
+    return b''.join(out)
+
+def fetch(fname, chrom, beg=0, end=MAX_POS, index=None):
+    """Fetch lines of bgzipped BED file on chrom overlapping [beg, end).
+
+    Inputs -
+        fname - bgzipped, tabix-indexed BED file
+        chrom - chromosome to fetch
+        beg   - 0-based start of region [default: 0]
+        end   - 0-based, exclusive end of region [default: end of chromosome]
+        index - output of read_index() [default: read from fname.tbi]
+    Returns -
+        bytes of matching lines (each ending in a newline)
+    """
+    if index is None:
+        index = read_index(fname)
+
+    prefix = chrom.encode() + b'\t'
+    whole = beg <= 0 and end >= MAX_POS
+    lines = []
+    with open(fname, 'rb') as f:
+        for start, stop in region_chunks(index, chrom, beg, end):
+            for line in read_chunk(f, start, stop).splitlines():
+                if not line.startswith(prefix):
+                    continue
+                if whole:
+                    lines.append(line)
+                    continue
+                fields = line.split(b'\t', 3)
+                if int(fields[1]) < end and int(fields[2]) > beg:
+                    lines.append(line)
+
+    if len(lines) == 0:
+        return b''
+
+    return b'\n'.join(lines) + b'\n'
+
+def parse_region(region):
+    """Split region string into (chrom, beg, end).
+
+    Inputs -
+        region - chromosome or chr:start-end (1-based, inclusive, as in tabix)
+    Returns -
+        tuple (chrom, 0-based start, 0-based exclusive end)
+    """
+    if ':' not in region:
+        return region, 0, MAX_POS
+
+    chrom, interval = region.rsplit(':', 1)
+    beg, end = interval.replace(',', '').split('-')
+
+    return chrom, int(beg) - 1, int(end)
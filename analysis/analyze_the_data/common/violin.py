@@ -0,0 +1,239 @@
+"""Summarize beta value distributions and draw violin plots from summaries.
+
+Drawing violins straight from millions of CpGs means holding every value in
+memory and running a KDE over each group. Instead, each group is reduced once
+to a fixed-bin histogram plus exact quartiles and moments, the summaries are
+cached next to the figures (keyed by the fingerprint of the files they came
+from), and violins are drawn by smoothing the histograms. Re-rendering a
+figure only reads the cache.
+"""
+from scipy.ndimage import gaussian_filter1d
+from matplotlib import colors
+import numpy as np
+import colorsys
+import json
+import os
+
+from fileinfo import fingerprint
+from atomic import atomic_output
+
+# Number of histogram bins between 0 and 1
+NBINS = 200
+
+# Version of how summaries are made, stored with every cached entry (along with
+# NBINS) so entries made by older code are recomputed
+VERSION = 1
+
+def value_counts(vals):
+    """Count occurrences of each distinct (non-missing) value.
+
+    Inputs -
+        vals - array-like of values
+    Returns -
+        tuple (np.array of sorted distinct values, np.array of counts)
+    """
+    vals = np.asarray(vals, dtype=np.float64)
+
+    return np.unique(vals[~np.isnan(vals)], return_counts=True)
+
+def merge_counts(counts):
+    """Merge several value counts into one.
+
+    Inputs -
+        counts - list of (values, counts) tuples from value_counts()
+    Returns -
+        tuple (np.array of sorted distinct values, np.array of counts)
+    """
+    vals = np.concatenate([c[0] for c in counts])
+    cnts = np.concatenate([c[1] for c in counts])
+    uniq, inverse = np.unique(vals, return_inverse=True)
+
+    return uniq, np.bincount(inverse, weights=cnts, minlength=len(uniq)).astype(np.int64)
+
+def quantile(vals, cnts, q):
+    """Find exact quantile (linear interpolation, as in np.percentile).
+
+    Inputs -
+        vals - sorted distinct values
+        cnts - count of each value
+        q    - quantile between 0 and 1
+    Returns -
+        float of quantile
+    """
+    cum = np.cumsum(cnts)
+    pos = q * (cum[-1] - 1)
+    lo = int(np.floor(pos))
+    v_lo = vals[np.searchsorted(cum, lo, side='right')]
+    v_hi = vals[np.searchsorted(cum, min(lo+1, cum[-1]-1), side='right')]
+
+    return float(v_lo + (pos - lo) * (v_hi - v_lo))
+
+def summarize(vals, cnts, nbins=NBINS):
+    """Summarize distribution of values between 0 and 1.
+
+    Inputs -
+        vals  - sorted distinct values
+        cnts  - count of each value
+        nbins - number of histogram bins [default: NBINS]
+    Returns -
+        dictionary with n, min, max, mean, std, q1, median, q3, and hist
+        (list of counts in nbins equal bins between 0 and 1)
+    """
+    n = int(cnts.sum())
+    if n == 0:
+        return {'n': 0, 'hist': [0] * nbins}
+
+    mean = float((vals * cnts).sum() / n)
+    var = float((cnts * (vals - mean)**2).sum() / max(n - 1, 1))
+    hist = np.histogram(vals, bins=np.linspace(0, 1, nbins+1), weights=cnts)[0]
+
+    return {
+        'n': n,
+        'min': float(vals[0]),
+        'max': float(vals[-1]),
+        'mean': mean,
+        'std': float(np.sqrt(var)),
+        'q1': quantile(vals, cnts, 0.25),
+        'median': quantile(vals, cnts, 0.50),
+        'q3': quantile(vals, cnts, 0.75),
+        'hist': [int(h) for h in hist]
+    }
+
+def lookup(cache, sources, summarize_source, rebuild=False):
+    """Retrieve summaries of each source, only recomputing those that are stale.
+
+    A cached entry is stale when its files have changed or it was made with a
+    different VERSION or NBINS.
+
+    Inputs -
+        cache            - JSON file to store summaries in
+        sources          - dictionary of {key: list of files summarized together}
+        summarize_source - function taking (key, files) and returning a
+                           dictionary of {group: summary}
+        rebuild          - whether to ignore cached summaries [default: False]
+    Returns -
+        dictionary of {key: {group: summary}}
+    """
+    stored = {}
+    if os.path.exists(cache) and not rebuild:
+        with open(cache, 'r') as f:
+            stored = json.load(f)
+
+    updated = False
+    out = {}
+    for key, files in sources.items():
+        fprint = [fingerprint(f) for f in files]
+        entry = stored.get(key)
+        if (entry is None or entry['fingerprint'] != fprint or
+            entry.get('version') != VERSION or entry.get('nbins') != NBINS):
+            entry = {
+                'fingerprint': fprint,
+                'version': VERSION,
+                'nbins': NBINS,
+                'summaries': summarize_source(key, files)
+            }
+            stored[key] = entry
+            updated = True
+
+        out[key] = entry['summaries']
+
+    if updated:
+        with atomic_output(cache) as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(stored, f)
+
+    return out
+
+def density(summary):
+    """Smooth histogram into density, as a KDE with Scott's bandwidth would.
+
+    Inputs -
+        summary - output of summarize()
+    Returns -
+        tuple (np.array of support, np.array of density), support limited to
+        the range of the data (like cut=0 in seaborn)
+    """
+    hist = np.asarray(summary['hist'], dtype=np.float64)
+    nbins = len(hist)
+    width = 1. / nbins
+    centers = (np.arange(nbins) + 0.5) * width
+
+    bw = summary['std'] * summary['n'] ** (-1. / 5)
+    if bw > 0:
+        hist = gaussian_filter1d(hist, bw / width, mode='constant', truncate=4.0)
+    dens = hist / (hist.sum() * width)
+
+    # Keep support within observed values, including the end points
+    keep = (centers >= summary['min'] - width/2) & (centers <= summary['max'] + width/2)
+    support = np.clip(centers[keep], summary['min'], summary['max'])
+
+    return support, dens[keep]
+
+def desaturate(color, saturation):
+    """Reduce saturation of color (as seaborn does to violin colors).
+
+    Inputs -
+        color      - matplotlib color
+        saturation - fraction of original saturation to keep
+    Returns -
+        RGB tuple
+    """
+    h, l, s = colorsys.rgb_to_hls(*colors.to_rgb(color))
+
+    return colorsys.hls_to_rgb(h, l, s * saturation)
+
+def draw_split_violins(ax, rows, palette, width=0.8, linewidth=1, saturation=0.75):
+    """Draw horizontal split violins with quartile lines from summaries.
+
+    Categories are placed top to bottom in order of first appearance, with the
+    first hue level above the center line and the second below it (as in
+    seaborn.violinplot(split=True, orient='h')). All violins have the same
+    area.
+
+    Inputs -
+        ax         - matplotlib axis to draw on
+        rows       - list of (category, hue, summary) tuples
+        palette    - dictionary of {hue: color}, in hue order
+        width      - full width of each violin [default: 0.8]
+        linewidth  - width of outline and quartile lines [default: 1]
+        saturation - fraction of saturation of palette colors to keep
+                     [default: 0.75]
+    Returns -
+        list of category labels, in order drawn
+    """
+    cats = []
+    for cat, hue, summary in rows:
+        if cat not in cats:
+            cats.append(cat)
+    hues = list(palette.keys())
+
+    curves = []
+    for cat, hue, summary in rows:
+        if summary['n'] == 0:
+            continue
+        support, dens = density(summary)
+        curves.append((cats.index(cat), hues.index(hue), hue, summary, support, dens))
+
+    # Scale so the widest half violin fills half of width
+    scale = (width / 2) / max([c[5].max() for c in curves] + [1e-12])
+
+    labelled = set()
+    for pos, side, hue, summary, support, dens in curves:
+        # Categories run down the y-axis, so the first hue level is drawn above
+        sign = -1 if side == 0 else 1
+        edge = pos + sign * dens * scale
+        ax.fill_between(support, pos, edge, facecolor=desaturate(palette[hue], saturation),
+                        edgecolor='0.25', linewidth=linewidth,
+                        label=None if hue in labelled else hue)
+        labelled.add(hue)
+
+        for q, dash in [('q1', 1.5), ('median', 3), ('q3', 1.5)]:
+            d = np.interp(summary[q], support, dens) * scale
+            ax.plot([summary[q], summary[q]], [pos, pos + sign * d], color='0.25',
+                    linewidth=linewidth, dashes=[linewidth * dash] * 2)
+
+    ax.set_yticks(range(len(cats)))
+    ax.set_yticklabels(cats)
+    ax.set_ylim(len(cats) - 0.5, -0.5)
+
+    return cats
@@ -1,10 +1,13 @@
 """Create plots to show methylation for mitochondrial and control vector DNA."""
 import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
 import numpy as np
+import sys
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import bed_reader
+import violin
+
 # Colors to use for each sample
 COLOR = {
     10: '#D81B60', # Ftube{A,B}kapaBC
@@ -20,6 +23,19 @@ COLOR = {
      0: '#004D40', # Ftube{A,B}swift10ngRep2
 }
 
+# Samples in plotting order
+SAMPLES = [
+    'FtubeAkapaBC', 'FtubeAkapaBCrep2', 'FtubeBkapaBC', 'FtubeBkapaBCrep2',
+    'FtubeAneb', 'FtubeAnebRep2', 'FtubeBneb', 'FtubeBnebRep2',
+    'FtubeApbat', 'FtubeBpbat',
+    'FtubeAswift', 'FtubeAswiftRep2', 'FtubeBswift', 'FtubeBswiftRep2',
+    'FtubeAneb10ng', 'FtubeAneb10ngRep2', 'FtubeBneb10ng', 'FtubeBneb10ngRep2',
+    'FtubeAswift10ng', 'FtubeAswift10ngRep2', 'FtubeBswift10ng', 'FtubeBswift10ngRep2'
+]
+
+# File to cache beta value summaries in
+SUMMARY_CACHE = 'control_summaries.json'
+
 def extract_sample_info(sample_str):
     """Extract kit, sample, and technical replicate from sample_str.
 
@@ -66,16 +82,16 @@ def import_file(fname, control=True, select_chr=None):
         fname      - filename to process
         control    - whether file is for control vectors (True) or
                      human (False) [default: True]
-        select_chr - select out chromosome from DataFrame
+        select_chr - select out chromosome (or chr:start-end region) from
+                     DataFrame
     Returns -
         DataFrame of data from file with some added columns
     """
-    df = pd.read_csv(
-        fname,
-        sep='\t',
-        header=None,
-        names=['chr','start','end','beta','covg','context']
-    )
+    # Only blocks holding select_chr are decompressed if file is tabix-indexed
+    if select_chr is not None:
+        df = bed_reader.read_region(fname, select_chr)
+    else:
+        df = bed_reader.read_bed(fname)
 
     # Add sample column
     samp = os.path.basename(fname)
@@ -90,13 +106,7 @@ def import_file(fname, control=True, select_chr=None):
     if (control == True):
         df['vector'] = np.where(df['chr'] == 'J02459.1', 'lambda', 'pUC19')
 
-    # Select only CpGs that occur on select_chr chromosome
-    if select_chr != None:
-        out = df[df.chr == select_chr]
-    else:
-        out = df
-
-    return out
+    return df
 
 def create_plot_matplotlib(data, title, xlab, ylab, ynames, figname):
     """Create violin plot of methylation data.
@@ -139,11 +149,12 @@ def create_plot_matplotlib(data, title, xlab, ylab, ynames, figname):
     plt.savefig(figname, bbox_inches='tight')
     plt.close('all')
 
-def create_plot(data, title, xlab, ylab, figname):
+def create_plot(rows, title, xlab, ylab, figname):
     """Create split violin plot of methylation data.
 
     Inputs -
-        data    - list of data to include in violinplot
+        rows    - list of (sample, replicate, summary) tuples to include in
+                  violinplot
         title   - title of plot
         xlab    - x-axis label of plot
         ylab    - y-axis label of plot
@@ -154,9 +165,7 @@ def create_plot(data, title, xlab, ylab, figname):
     fig, ax = plt.subplots(figsize=(10,5))
     plt.tight_layout()
 
-    sns.violinplot(data=data, x='beta', y='sample', hue='Replicate', cut=0,
-                   split=True, inner='quartile', linewidth=1, orient='h',
-                   palette={'Rep. 1': '#005596', 'Rep. 2': '#3fa294'})
+    violin.draw_split_violins(ax, rows, palette={'Rep. 1': '#005596', 'Rep. 2': '#3fa294'})
 
     ax.legend(title='', ncol=2, bbox_to_anchor=(0.5,0.96), frameon=False,
               loc='lower center', fontsize=20)
@@ -176,91 +185,63 @@ def create_plot(data, title, xlab, ylab, figname):
     plt.savefig(figname, bbox_inches='tight')
     plt.close('all')
 
+def summarize_file(fname, control=True, select_chr=None):
+    """Summarize beta values of each control vector (or of select_chr).
+
+    Inputs -
+        fname      - filename to process
+        control    - whether file is for control vectors (True) or
+                     human (False) [default: True]
+        select_chr - select out chromosome from file
+    Returns -
+        dictionary of {vector (or select_chr): summary} (see violin.summarize)
+    """
+    df = import_file(fname, control, select_chr)
+
+    if control == False:
+        return {select_chr: violin.summarize(*violin.value_counts(df['beta']))}
+
+    out = {}
+    for vec in ['lambda', 'pUC19']:
+        out[vec] = violin.summarize(*violin.value_counts(df.loc[df['vector'] == vec, 'beta']))
+
+    return out
+
+def summary_rows(summaries, group):
+    """Collect (sample, replicate, summary) of group in plotting order.
+
+    Inputs -
+        summaries - dictionary of {filename: {group: summary}}
+        group     - control vector or chromosome to collect
+    Returns -
+        list of (sample, replicate, summary) tuples
+    """
+    rows = []
+    for fname, summ in summaries.items():
+        samp = os.path.basename(fname)
+        samp = samp.replace('.cg.sorted.mergecg.bed.gz', '')
+        samp = samp.replace('.controls', '')
+        kit, bio, rep = extract_sample_info(samp)
+        rows.append((kit + ' Samp. ' + bio, 'Rep. ' + rep, summ[group]))
+
+    return rows
+
 def lambda_puc_plots():
     """Process control vector data into violin plots. """
     # Useful variables
     path = '2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/control_vectors/'
     appd = '.controls.cg.sorted.mergecg.bed.gz'
 
-    # Load data into DataFrames
-    ak1_hi = import_file(path+'FtubeAkapaBC'+appd)
-    ak2_hi = import_file(path+'FtubeAkapaBCrep2'+appd)
-    an1_hi = import_file(path+'FtubeAneb'+appd)
-    an1_lo = import_file(path+'FtubeAneb10ng'+appd)
-    an2_lo = import_file(path+'FtubeAneb10ngRep2'+appd)
-    an2_hi = import_file(path+'FtubeAnebRep2'+appd)
-    ap1_hi = import_file(path+'FtubeApbat'+appd)
-    as1_hi = import_file(path+'FtubeAswift'+appd)
-    as1_lo = import_file(path+'FtubeAswift10ng'+appd)
-    as2_lo = import_file(path+'FtubeAswift10ngRep2'+appd)
-    as2_hi = import_file(path+'FtubeAswiftRep2'+appd)
-
-    bk1_hi = import_file(path+'FtubeBkapaBC'+appd)
-    bk2_hi = import_file(path+'FtubeBkapaBCrep2'+appd)
-    bn1_hi = import_file(path+'FtubeBneb'+appd)
-    bn1_lo = import_file(path+'FtubeBneb10ng'+appd)
-    bn2_lo = import_file(path+'FtubeBneb10ngRep2'+appd)
-    bn2_hi = import_file(path+'FtubeBnebRep2'+appd)
-    bp1_hi = import_file(path+'FtubeBpbat'+appd)
-    bs1_hi = import_file(path+'FtubeBswift'+appd)
-    bs1_lo = import_file(path+'FtubeBswift10ng'+appd)
-    bs2_lo = import_file(path+'FtubeBswift10ngRep2'+appd)
-    bs2_hi = import_file(path+'FtubeBswiftRep2'+appd)
-
-    # Pull out lambdaphage data from files
-    lamb = pd.concat(
-        [ak1_hi[(ak1_hi.vector == 'lambda')],
-         ak2_hi[(ak2_hi.vector == 'lambda')],
-         bk1_hi[(bk1_hi.vector == 'lambda')],
-         bk2_hi[(bk2_hi.vector == 'lambda')],
-         an1_hi[(an1_hi.vector == 'lambda')],
-         an2_hi[(an2_hi.vector == 'lambda')],
-         bn1_hi[(bn1_hi.vector == 'lambda')],
-         bn2_hi[(bn2_hi.vector == 'lambda')],
-         ap1_hi[(ap1_hi.vector == 'lambda')],
-         bp1_hi[(bp1_hi.vector == 'lambda')],
-         as1_hi[(as1_hi.vector == 'lambda')],
-         as2_hi[(as2_hi.vector == 'lambda')],
-         bs1_hi[(bs1_hi.vector == 'lambda')],
-         bs2_hi[(bs2_hi.vector == 'lambda')],
-         an1_lo[(an1_lo.vector == 'lambda')],
-         an2_lo[(an2_lo.vector == 'lambda')],
-         bn1_lo[(bn1_lo.vector == 'lambda')],
-         bn2_lo[(bn2_lo.vector == 'lambda')],
-         as1_lo[(as1_lo.vector == 'lambda')],
-         as2_lo[(as2_lo.vector == 'lambda')],
-         bs1_lo[(bs1_lo.vector == 'lambda')],
-         bs2_lo[(bs2_lo.vector == 'lambda')]]
-    )
-
-    # Pull out pUC19 data from files
-    puck = pd.concat(
-        [ak1_hi[(ak1_hi.vector == 'pUC19')],
-         ak2_hi[(ak2_hi.vector == 'pUC19')],
-         bk1_hi[(bk1_hi.vector == 'pUC19')],
-         bk2_hi[(bk2_hi.vector == 'pUC19')],
-         an1_hi[(an1_hi.vector == 'pUC19')],
-         an2_hi[(an2_hi.vector == 'pUC19')],
-         bn1_hi[(bn1_hi.vector == 'pUC19')],
-         bn2_hi[(bn2_hi.vector == 'pUC19')],
-         ap1_hi[(ap1_hi.vector == 'pUC19')],
-         bp1_hi[(bp1_hi.vector == 'pUC19')],
-         as1_hi[(as1_hi.vector == 'pUC19')],
-         as2_hi[(as2_hi.vector == 'pUC19')],
-         bs1_hi[(bs1_hi.vector == 'pUC19')],
-         bs2_hi[(bs2_hi.vector == 'pUC19')],
-         an1_lo[(an1_lo.vector == 'pUC19')],
-         an2_lo[(an2_lo.vector == 'pUC19')],
-         bn1_lo[(bn1_lo.vector == 'pUC19')],
-         bn2_lo[(bn2_lo.vector == 'pUC19')],
-         as1_lo[(as1_lo.vector == 'pUC19')],
-         as2_lo[(as2_lo.vector == 'pUC19')],
-         bs1_lo[(bs1_lo.vector == 'pUC19')],
-         bs2_lo[(bs2_lo.vector == 'pUC19')]]
+    # Summarize files, only reading those that changed since the last run
+    files = [path+samp+appd for samp in SAMPLES]
+    summaries = violin.lookup(
+        SUMMARY_CACHE,
+        dict((f, [f]) for f in files),
+        lambda key, fnames: summarize_file(fnames[0])
     )
 
     create_plot(
-        lamb,
+        summary_rows(summaries, 'lambda'),
         'Lambda Phage Control Retention',
         'Percent Retained',
         '',
@@ -268,7 +249,7 @@ def lambda_puc_plots():
     )
 
     create_plot(
-        puck,
+        summary_rows(summaries, 'pUC19'),
         'pUC19 Control Retention',
         'Percent Retained',
         '',
@@ -281,59 +262,16 @@ def mitochondria_plots():
     path = '2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/align/'
     appd = '.cg.sorted.mergecg.bed.gz'
 
-    # Load files into DataFrames
-    ak1_hi = import_file(path+'FtubeAkapaBC'+appd, control=False, select_chr='chrM')
-    ak2_hi = import_file(path+'FtubeAkapaBCrep2'+appd, control=False, select_chr='chrM')
-    an1_hi = import_file(path+'FtubeAneb'+appd, control=False, select_chr='chrM')
-    an1_lo = import_file(path+'FtubeAneb10ng'+appd, control=False, select_chr='chrM')
-    an2_lo = import_file(path+'FtubeAneb10ngRep2'+appd, control=False, select_chr='chrM')
-    an2_hi = import_file(path+'FtubeAnebRep2'+appd, control=False, select_chr='chrM')
-    ap1_hi = import_file(path+'FtubeApbat'+appd, control=False, select_chr='chrM')
-    as1_hi = import_file(path+'FtubeAswift'+appd, control=False, select_chr='chrM')
-    as1_lo = import_file(path+'FtubeAswift10ng'+appd, control=False, select_chr='chrM')
-    as2_lo = import_file(path+'FtubeAswift10ngRep2'+appd, control=False, select_chr='chrM')
-    as2_hi = import_file(path+'FtubeAswiftRep2'+appd, control=False, select_chr='chrM')
-
-    bk1_hi = import_file(path+'FtubeBkapaBC'+appd, control=False, select_chr='chrM')
-    bk2_hi = import_file(path+'FtubeBkapaBCrep2'+appd, control=False, select_chr='chrM')
-    bn1_hi = import_file(path+'FtubeBneb'+appd, control=False, select_chr='chrM')
-    bn1_lo = import_file(path+'FtubeBneb10ng'+appd, control=False, select_chr='chrM')
-    bn2_lo = import_file(path+'FtubeBneb10ngRep2'+appd, control=False, select_chr='chrM')
-    bn2_hi = import_file(path+'FtubeBnebRep2'+appd, control=False, select_chr='chrM')
-    bp1_hi = import_file(path+'FtubeBpbat'+appd, control=False, select_chr='chrM')
-    bs1_hi = import_file(path+'FtubeBswift'+appd, control=False, select_chr='chrM')
-    bs1_lo = import_file(path+'FtubeBswift10ng'+appd, control=False, select_chr='chrM')
-    bs2_lo = import_file(path+'FtubeBswift10ngRep2'+appd, control=False, select_chr='chrM')
-    bs2_hi = import_file(path+'FtubeBswiftRep2'+appd, control=False, select_chr='chrM')
-
-    # Mitochondrial beta values
-    chrm = pd.concat(
-        [ak1_hi,
-         ak2_hi,
-         bk1_hi,
-         bk2_hi,
-         an1_hi,
-         an2_hi,
-         bn1_hi,
-         bn2_hi,
-         ap1_hi,
-         bp1_hi,
-         as1_hi,
-         as2_hi,
-         bs1_hi,
-         bs2_hi,
-         an1_lo,
-         an2_lo,
-         bn1_lo,
-         bn2_lo,
-         as1_lo,
-         as2_lo,
-         bs1_lo,
-         bs2_lo]
+    # Summarize mitochondrial beta values, only reading files that changed
+    files = [path+samp+appd for samp in SAMPLES]
+    summaries = violin.lookup(
+        SUMMARY_CACHE,
+        dict((f, [f]) for f in files),
+        lambda key, fnames: summarize_file(fnames[0], control=False, select_chr='chrM')
     )
 
     create_plot(
-        chrm,
+        summary_rows(summaries, 'chrM'),
         'Mitochondrial Retention',
         'Percent Retained',
         '',
@@ -0,0 +1,183 @@
+"""Annotate CpGs with their seascape region (island, shore, shelf, open sea).
+
+Replaces intersecting each mergecg file with the four seascape BED files. The
+seascape regions (from create_cpg_seascape_bed.sh) do not overlap, so they are
+combined into one sorted interval index per chromosome, and each mergecg file
+is read once, with every CpG looked up in the index. Only what the plots use is
+written: the beta value (float32) and region code (int8) of each CpG, as arrays
+in a .npz file.
+"""
+import pandas as pd
+import numpy as np
+import argparse
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from atomic import atomic_output
+import bed_reader
+
+# Seascape regions, in order of priority for CpGs on a region boundary, with
+# the name of the BED file from create_cpg_seascape_bed.sh holding each region
+REGIONS = {
+    'islands'  : 'cpg_islands.bed',
+    'shores'   : 'cpg_shores.bed',
+    'shelves'  : 'cpg_shelves.bed',
+    'open_seas': 'cpg_open_seas.bed'
+}
+
+# Ending of annotated files
+EXT = '.seascape.npz'
+
+def build_index(beddir):
+    """Build sorted interval index of seascape regions for each chromosome.
+
+    Inputs -
+        beddir - directory with seascape BED files
+    Returns -
+        dictionary of {chromosome: (starts, ends, region codes)}, where region
+        codes index into list(REGIONS)
+    """
+    frames = []
+    for code, fname in enumerate(REGIONS.values()):
+        df = pd.read_csv(os.path.join(beddir, fname), sep='\t', header=None,
+                         usecols=[0, 1, 2], names=['chr', 'start', 'end'],
+                         dtype={'chr': str, 'start': np.int64, 'end': np.int64})
+        df['code'] = np.int8(code)
+        frames.append(df)
+
+    regions = pd.concat(frames, ignore_index=True).sort_values(['chr', 'start'])
+
+    index = {}
+    for chrom, df in regions.groupby('chr', sort=False):
+        index[chrom] = (df['start'].to_numpy(), df['end'].to_numpy(), df['code'].to_numpy())
+
+    return index
+
+def lookup(index, chrom, pos):
+    """Find region code of each position on a chromosome.
+
+    Inputs -
+        index - output of build_index()
+        chrom - chromosome of positions
+        pos   - np.array of 0-based positions
+    Returns -
+        np.array of region codes (-1 where position is in no region)
+    """
+    out = np.full(len(pos), -1, dtype=np.int8)
+    if chrom not in index:
+        return out
+
+    starts, ends, codes = index[chrom]
+    idx = np.searchsorted(starts, pos, side='right') - 1
+    hit = idx >= 0
+    hit[hit] = pos[hit] < ends[idx[hit]]
+    out[hit] = codes[idx[hit]]
+
+    return out
+
+def annotate(index, chrs, starts, ends):
+    """Assign seascape region code to CpGs.
+
+    A CpG overlapping two regions gets the one listed first in REGIONS.
+
+    Inputs -
+        index  - output of build_index()
+        chrs   - np.array of chromosome names
+        starts - np.array of 0-based CpG starts
+        ends   - np.array of CpG ends
+    Returns -
+        np.array of region codes (-1 where CpG is in no region)
+    """
+    out = np.full(len(chrs), -1, dtype=np.int8)
+    chr_codes, chroms = pd.factorize(chrs)
+    for idx, chrom in enumerate(chroms):
+        rows = np.flatnonzero(chr_codes == idx)
+        first = lookup(index, chrom, starts[rows])
+        last = lookup(index, chrom, ends[rows] - 1)
+
+        # Missing regions (-1) lose to any region found
+        first = np.where(first < 0, len(REGIONS), first)
+        last = np.where(last < 0, len(REGIONS), last)
+        code = np.minimum(first, last)
+        out[rows] = np.where(code == len(REGIONS), -1, code)
+
+    return out
+
+def annotate_file(index, fname, out_name):
+    """Find beta value and seascape region code of each CpG in mergecg file.
+
+    CpGs outside every seascape region (e.g., on non-canonical chromosomes)
+    are dropped.
+
+    Inputs -
+        index    - output of build_index()
+        fname    - mergecg BED file
+        out_name - output .npz file
+    Returns -
+        dictionary of {region: number of CpGs}, arrays written to out_name
+            'beta'    - float32 beta value of each CpG
+            'region'  - int8 region code of each CpG (index into 'regions')
+            'regions' - region names
+    """
+    names = list(REGIONS.keys())
+
+    betas = []
+    codes = []
+    for chunk in bed_reader.iter_bed(fname, usecols=['chr', 'start', 'end', 'beta']):
+        code = annotate(index, chunk['chr'].astype(str).to_numpy(),
+                        chunk['start'].to_numpy(dtype=np.int64),
+                        chunk['end'].to_numpy(dtype=np.int64))
+
+        keep = code >= 0
+        betas.append(chunk['beta'].to_numpy(dtype=np.float32)[keep])
+        codes.append(code[keep])
+
+    beta = np.concatenate(betas) if len(betas) > 0 else np.zeros(0, dtype=np.float32)
+    region = np.concatenate(codes) if len(codes) > 0 else np.zeros(0, dtype=np.int8)
+
+    with atomic_output(out_name) as tmp:
+        with open(tmp, 'wb') as f:
+            np.savez(f, beta=beta, region=region, regions=np.array(names, dtype=str))
+
+    counts = np.bincount(region, minlength=len(names))
+
+    return dict((name, int(n)) for name, n in zip(names, counts))
+
+def main():
+    """Annotate mergecg files with seascape regions."""
+    parser = argparse.ArgumentParser(
+        description = 'annotate_seascape.py finds the seascape region of each CpG in mergecg files'
+    )
+
+    parser.add_argument(
+        '-o', '--outdir',
+        default = 'seashore_bed_files',
+        help = 'Directory to write annotated files to [default: seashore_bed_files]'
+    )
+
+    parser.add_argument(
+        'beddir',
+        help = 'Directory with seascape BED files from create_cpg_seascape_bed.sh'
+    )
+
+    parser.add_argument(
+        'files',
+        nargs = '+',
+        help = 'mergecg BED files (<sample>.cg.sorted.mergecg.bed.gz)'
+    )
+
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    index = build_index(args.beddir)
+
+    for fname in args.files:
+        samp = os.path.basename(fname).replace('.cg.sorted.mergecg.bed.gz', '')
+        counts = annotate_file(index, fname, os.path.join(args.outdir, samp + EXT))
+        print(samp + '\t' + '\t'.join('{}={:,}'.format(k, v) for k, v in counts.items()))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,8 +3,15 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 import numpy as np
+import argparse
+import sys
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import violin
+
+import annotate_seascape
+
 def extract_sample_info(sample_str):
     """Extract kit, sample, and technical replicate from sample_str.
 
@@ -44,55 +51,149 @@ def extract_sample_info(sample_str):
 
     return (kit, bio, rep)
 
-def import_files(tag, samp):
-    """Import CpG islands, shores, shelves, and open seas BED files into a 
-       DataFrame
+# File to cache beta value summaries in
+SUMMARY_CACHE = 'seascape_summaries.json'
+
+def load_sample(fname):
+    """Load beta values of sample sorted by seascape region.
 
     Inputs -
-        tag  - sample name to load (include any paths needed)
-        samp - only sample name (no paths)
+        fname - seascape annotated file (from annotate_seascape.py)
     Returns -
-        DataFrame with beta values, sea_group, sample, and replicate columns
+        tuple (np.array of float32 beta values, dictionary of {region: slice}),
+        where beta[slices[region]] holds the beta values in region
     """
-    names = ['chr','start','end','beta','covg']
-    cols = [3]
+    with np.load(fname) as npz:
+        beta = npz['beta']
+        codes = npz['region']
+        regions = [str(r) for r in npz['regions']]
 
-    isld = pd.read_csv(
-        tag+'.island.bed.gz', sep='\t', header=None, usecols=cols
-    )
-    isld.rename(columns={3: 'beta'}, inplace=True)
-    isld['sea_group'] = 'islands'
+    order = np.argsort(codes, kind='stable')
+    beta = beta[order]
 
-    shor = pd.read_csv(
-        tag+'.shores.bed.gz', sep='\t', header=None, usecols=cols
-    )
-    shor.rename(columns={3: 'beta'}, inplace=True)
-    shor['sea_group'] = 'shores'
+    bounds = np.searchsorted(codes[order], np.arange(len(regions)+1))
+    slices = dict((r, slice(bounds[i], bounds[i+1])) for i, r in enumerate(regions))
 
-    shlv = pd.read_csv(
-        tag+'.shelves.bed.gz', sep='\t', header=None, usecols=cols
-    )
-    shlv.rename(columns={3: 'beta'}, inplace=True)
-    shlv['sea_group'] = 'shelves'
+    return beta, slices
 
-    seas = pd.read_csv(
-        tag+'.open_seas.bed.gz', sep='\t', header=None, usecols=cols
-    )
-    seas.rename(columns={3: 'beta'}, inplace=True)
-    seas['sea_group'] = 'open_seas'
+def summarize_sample(samp, files):
+    """Summarize beta values in each region, and all regions combined.
 
-    comb = pd.concat([isld, shor, shlv, seas])
-    kit, bio, rep = extract_sample_info(samp)
-    comb['sample'] = kit + ' Samp. ' + bio
-    comb['Replicate'] = 'Rep. ' + rep
+    Inputs -
+        samp  - only sample name (no paths)
+        files - list with seascape annotated file of sample (from
+                annotate_seascape.py)
+    Returns -
+        dictionary of {region: summary} (see violin.summarize), including 'all'
+    """
+    beta, slices = load_sample(files[0])
+
+    counts = dict((region, violin.value_counts(beta[sl])) for region, sl in slices.items())
+
+    out = dict((region, violin.summarize(*c)) for region, c in counts.items())
+    out['all'] = violin.summarize(*violin.merge_counts(list(counts.values())))
+
+    return out
 
-    return comb
+def load_seascape(tags, samps):
+    """Load beta values of every sample into one compact DataFrame.
 
-def create_plot(data, title, xlab, ylab, figname):
+    Rows are sorted by seascape region, so each region is a contiguous block
+    that can be viewed with iloc instead of copied out with a boolean filter.
+    Group columns are categorical (1 byte per CpG) and beta values are
+    float32.
+
+    Inputs -
+        tags  - list of sample names to load (include any paths needed)
+        samps - list of only sample names (no paths), in plotting order
+    Returns -
+        tuple (DataFrame with beta, sea_group, sample, and Replicate columns,
+               dictionary of {region: slice of rows in region})
+    """
+    regions = list(annotate_seascape.REGIONS.keys())
+
+    labels = []
+    reps = []
+    for samp in samps:
+        kit, bio, rep = extract_sample_info(samp)
+        labels.append(kit + ' Samp. ' + bio)
+        reps.append('Rep. ' + rep)
+    sample_cats = list(dict.fromkeys(labels))
+    rep_cats = sorted(set(reps))
+
+    # Pieces of each region from each sample, in output order
+    pieces = dict((r, []) for r in regions)
+    for tag, label, rep in zip(tags, labels, reps):
+        beta, slices = load_sample(tag)
+        for r in regions:
+            pieces[r].append((beta[slices[r]], sample_cats.index(label), rep_cats.index(rep)))
+
+    beta = []
+    sea_codes = []
+    samp_codes = []
+    rep_codes = []
+    bounds = [0]
+    for code, r in enumerate(regions):
+        for vals, samp_code, rep_code in pieces[r]:
+            beta.append(vals)
+            sea_codes.append(np.full(len(vals), code, dtype=np.int8))
+            samp_codes.append(np.full(len(vals), samp_code, dtype=np.int8))
+            rep_codes.append(np.full(len(vals), rep_code, dtype=np.int8))
+            bounds.append(bounds[-1] + len(vals))
+        pieces[r] = None
+    region_bounds = np.array(bounds)[np.cumsum([0] + [len(samps)] * len(regions))]
+
+    comb = pd.DataFrame({
+        'beta': np.concatenate(beta),
+        'sea_group': pd.Categorical.from_codes(np.concatenate(sea_codes), categories=regions),
+        'sample': pd.Categorical.from_codes(np.concatenate(samp_codes), categories=sample_cats),
+        'Replicate': pd.Categorical.from_codes(np.concatenate(rep_codes), categories=rep_cats)
+    })
+    slices = dict((r, slice(region_bounds[i], region_bounds[i+1])) for i, r in enumerate(regions))
+
+    return comb, slices
+
+def create_plot(rows, title, xlab, ylab, figname):
     """Create split violin plot of methylation data.
 
     Inputs -
-        data    - list of data to include in violinplot
+        rows    - list of (sample, replicate, summary) tuples to include in
+                  violinplot
+        title   - title of plot
+        xlab    - x-axis label of plot
+        ylab    - y-axis label of plot
+        figname - name of output file for plot
+    Returns -
+        Nothing, plot saved to disk
+    """
+    fig, ax = plt.subplots(figsize=(10,5))
+    plt.tight_layout()
+
+    violin.draw_split_violins(ax, rows, palette={'Rep. 1': '#005596', 'Rep. 2': '#3fa294'})
+
+    ax.legend(title='', ncol=2, bbox_to_anchor=(0.5,0.96), frameon=False,
+              loc='lower center', fontsize=20)
+    plt.xlim(-0.05, 1.05)
+
+    plt.xticks(
+        [i for i in np.arange(0, 1.2, 0.2)],
+        ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)],
+        fontsize=18
+    )
+    plt.yticks(fontsize=18)
+
+    plt.title(title, pad=40, fontsize=24)
+    plt.xlabel(xlab, fontsize=20)
+    plt.ylabel(ylab, fontsize=20)
+
+    plt.savefig(figname, bbox_inches='tight')
+    plt.close('all')
+
+def create_plot_exact(data, title, xlab, ylab, figname):
+    """Create split violin plot of methylation data from every CpG.
+
+    Inputs -
+        data    - DataFrame (from load_seascape) to include in violinplot
         title   - title of plot
         xlab    - x-axis label of plot
         ylab    - y-axis label of plot
@@ -125,8 +226,30 @@ def create_plot(data, title, xlab, ylab, figname):
     plt.savefig(figname, bbox_inches='tight')
     plt.close('all')
 
+# Region, title, and file name of each figure
+FIGURES = [
+    ('islands'  , 'CpG Island Methylation Distribution'  , 'islands.pdf'),
+    ('shores'   , 'CpG Shore Methylation Distribution'   , 'shores.pdf'),
+    ('shelves'  , 'CpG Shelve Methylation Distribution'  , 'shelves.pdf'),
+    ('open_seas', 'CpG Open Sea Methylation Distribution', 'opensea.pdf'),
+    ('all'      , 'All CpG Methylation Distribution'     , 'all.pdf')
+]
+
 def main():
     """Main function."""
+    parser = argparse.ArgumentParser(
+        description = 'make_plots.py creates violin plots of CpG methylation in seascape regions'
+    )
+
+    parser.add_argument(
+        '-e', '--exact',
+        action = 'store_true',
+        help = 'Draw violins with a KDE over every CpG, loaded into one compact ' +
+               'table (slow) [default: draw from cached summaries]'
+    )
+
+    args = parser.parse_args()
+
     samps = [
         'FtubeAkapaBC', 'FtubeAkapaBCrep2',
         'FtubeAneb', 'FtubeAnebRep2',
@@ -136,61 +259,39 @@ def main():
         'FtubeAswift10ng', 'FtubeAswift10ngRep2'
     ]
 
-    data = []
+    # Sample A and B of each library, in plotting order
+    order = []
     for samp in samps:
-        c_a = import_files('seashore_bed_files/' + samp, samp)
-        c_b = import_files(
-            'seashore_bed_files/' + samp.replace('FtubeA', 'FtubeB'),
-            samp.replace('FtubeA', 'FtubeB')
-        )
-        data.append(c_a)
-        data.append(c_b)
-
-    comb = pd.concat(data)
-    isld = comb[comb.sea_group == 'islands']
-    shor = comb[comb.sea_group == 'shores']
-    shlv = comb[comb.sea_group == 'shelves']
-    seas = comb[comb.sea_group == 'open_seas']
-
-    create_plot(
-        isld,
-        'CpG Island Methylation Distribution',
-        'Methylation Level',
-        '',
-        'islands.pdf'
-    )
+        order.append(samp)
+        order.append(samp.replace('FtubeA', 'FtubeB'))
 
-    create_plot(
-        shor,
-        'CpG Shore Methylation Distribution',
-        'Methylation Level',
-        '',
-        'shores.pdf'
-    )
+    tags = ['seashore_bed_files/' + samp + annotate_seascape.EXT for samp in order]
 
-    create_plot(
-        shlv,
-        'CpG Shelve Methylation Distribution',
-        'Methylation Level',
-        '',
-        'shelves.pdf'
-    )
+    if args.exact:
+        comb, slices = load_seascape(tags, order)
+        for region, title, figname in FIGURES:
+            data = comb if region == 'all' else comb.iloc[slices[region]]
+            create_plot_exact(data, title, 'Methylation Level', '', figname)
 
-    create_plot(
-        seas,
-        'CpG Open Sea Methylation Distribution',
-        'Methylation Level',
-        '',
-        'opensea.pdf'
-    )
+        return 0
 
-    create_plot(
-        comb,
-        'All CpG Methylation Distribution',
-        'Methylation Level',
-        '',
-        'all.pdf'
-    )
+    # Summaries are only recomputed when a BED file changes
+    summaries = violin.lookup(SUMMARY_CACHE, dict((samp, [tag]) for samp, tag in zip(order, tags)),
+                              summarize_sample)
+
+    def rows(region):
+        """Collect (sample, replicate, summary) of region for every sample."""
+        out = []
+        for samp in order:
+            kit, bio, rep = extract_sample_info(samp)
+            out.append((kit + ' Samp. ' + bio, 'Rep. ' + rep, summaries[samp][region]))
+
+        return out
+
+    for region, title, figname in FIGURES:
+        create_plot(rows(region), title, 'Methylation Level', '', figname)
+
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
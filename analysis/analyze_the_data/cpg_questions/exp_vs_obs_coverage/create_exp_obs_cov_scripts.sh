@@ -16,6 +16,7 @@ EOF
 
 DIRLOC=2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/analyze_the_data/cpg_questions/exp_vs_obs_coverage
 BAMLOC=2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/align
+COMMDIR=2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/analyze_the_data/common
 
 for BAM in `ls ${BAMLOC}/*.sorted.markdup.bam`; do
     base="$(basename -- $BAM)"
@@ -38,19 +39,13 @@ EXONBED=2019_11_07_FallopianTube_WGBS_Kit_Comparison/qc_assets/bismap/exon_bisma
 GENEBED=2019_11_07_FallopianTube_WGBS_Kit_Comparison/qc_assets/bismap/genic_regions_bismap.bed.gz
 INTRBED=2019_11_07_FallopianTube_WGBS_Kit_Comparison/qc_assets/bismap/intergenic_regions_bismap.bed.gz
 BISMBED=2019_11_07_FallopianTube_WGBS_Kit_Comparison/qc_assets/bismap/k100.bismap.bedgraph.gz
+BISMDIR=2019_11_07_FallopianTube_WGBS_Kit_Comparison/qc_assets/bismap
 
 # (# bases in feature) [i.e. sum of weights times element length, for specific regions]
-# column 2: start of element; column 3: end of element; column 4: element mappability score
-CPGSLEN=\$(zcat \${CPGSBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
-CGISLEN=\$(zcat \${CGISBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
-RMSKLEN=\$(zcat \${RMSKBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
-EXONLEN=\$(zcat \${EXONBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
-GENELEN=\$(zcat \${GENEBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
-INTRLEN=\$(zcat \${INTRBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
-
 # (# bases in genome) [i.e. sum of weights times element length, for all available elements]
-# column 2: start of element; column 3: end of element; column 4: element mappability score
-REFLEN=\$(zcat \${BISMBED} | awk '{ sum += \$4*(\$3-\$2) } END { print sum }')
+# These only depend on the bismap files, so they are read from a cache that is
+# (re)computed by region_lengths.py whenever the bismap files change
+read -r REFLEN CPGSLEN CGISLEN RMSKLEN EXONLEN GENELEN INTRLEN < <(python ${COMMDIR}/region_lengths.py \${BISMDIR})
 
 # Find genomic coverage
 samtools view -hb -F 0x4 -q 40 ${BAM} | \\
@@ -2,10 +2,22 @@ import matplotlib.pyplot as plt
 from matplotlib import colors
 import pandas as pd
 import numpy as np
-from scipy.stats import spearmanr, gaussian_kde
+from scipy.stats import spearmanr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import argparse
+import time
 import sys
+import os
 
-def make_diff_avg_plot(x_vals, y_vals, title, xlab, ylab, figname):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import cpg_align
+import density
+import bed_reader
+import meth_store
+import merge_join
+
+def make_diff_avg_plot(x_vals, y_vals, title, xlab, ylab, figname, mode='raster', npix=500):
     """Find the Spearman R correlation value and create scatter plot of beta
        values.
 
@@ -15,13 +27,37 @@ def make_diff_avg_plot(x_vals, y_vals, title, xlab, ylab, figname):
             xlab          - name of values on x-axis
             ylab          - name of values on y-axis
             figname       - name of file to save figure as
+            mode          - 'raster' draws a rasterized image of point counts
+                            per pixel with only outliers (|x| and |y| > 0.5)
+                            drawn as markers, 'points' draws every point
+                            [default: 'raster']
+            npix          - pixels on each axis of count image [default: 500]
 
     Returns: 
     """
     fig, ax = plt.subplots(figsize=(5,5))
     plt.tight_layout()
 
-    ax.plot(x_vals, y_vals, 'k.')
+    if mode == 'points':
+        ax.plot(x_vals, y_vals, 'k.')
+    elif mode == 'raster':
+        # Image size does not depend on the number of points plotted
+        xs = np.asarray(x_vals, dtype=np.float64)
+        ys = np.asarray(y_vals, dtype=np.float64)
+        extent = (-1.05, 1.05, -1.05, 1.05)
+
+        counts = density.pixel_counts(xs, ys, extent, npix)
+        vmax = np.nanmax(counts) if np.isfinite(counts).any() else 1
+        im = ax.imshow(counts, origin='lower', extent=extent, aspect='auto',
+                       interpolation='nearest', cmap=plt.cm.Greys,
+                       norm=colors.LogNorm(vmin=1, vmax=max(vmax, 1)), rasterized=True)
+
+        out = (np.abs(xs) > 0.5) & (np.abs(ys) > 0.5)
+        ax.plot(xs[out], ys[out], 'k.')
+
+        plt.colorbar(im, ax=ax, label='CpGs per pixel')
+    else:
+        raise ValueError(f'[make_diff_avg_plot] unknown plot mode: {mode}')
 
     tick_loc = [i for i in np.arange(-1, 1.2, 0.2)]
     tick_lab = []
@@ -43,16 +79,18 @@ def make_diff_avg_plot(x_vals, y_vals, title, xlab, ylab, figname):
     plt.savefig(figname, bbox_inches='tight')
     plt.close('all')
 
-def make_diff_avg_pt_density_plot(x_vals, y_vals, title, xlab, ylab, figname):
+def make_diff_avg_pt_density_plot(x_vals, y_vals, title, xlab, ylab, figname, density_method='binned'):
     """Find the Spearman R correlation value and create scatter plot of beta
        values.
 
-    Inputs: x_vals        - list of values on x-axis
-            y_vals        - list of values on y-axis
-            title         - title of figure
-            xlab          - name of values on x-axis
-            ylab          - name of values on y-axis
-            figname       - name of file to save figure as
+    Inputs: x_vals         - list of values on x-axis
+            y_vals         - list of values on y-axis
+            title          - title of figure
+            xlab           - name of values on x-axis
+            ylab           - name of values on y-axis
+            figname        - name of file to save figure as
+            density_method - density estimator, 'binned' or 'gaussian_kde'
+                             (see density.grid_density) [default: 'binned']
 
     Returns: 
     """
@@ -69,13 +107,7 @@ def make_diff_avg_pt_density_plot(x_vals, y_vals, title, xlab, ylab, figname):
     fig, ax = plt.subplots(figsize=(5,5))
     plt.tight_layout()
 
-    try:
-        k = gaussian_kde(np.vstack([xs, ys]))
-    except np.linalg.LinAlgError:
-        xs[0] = xs[0] + 0.0000001
-        k = gaussian_kde(np.vstack([xs, ys]))
-    xi, yi = np.mgrid[xs.min():xs.max():nbins*1j, ys.min():ys.max():nbins*1j]
-    zi = k(np.vstack([xi.flatten(), yi.flatten()]))
+    xi, yi, zi = density.grid_density(xs, ys, nbins, method=density_method)
 
     #im = ax.pcolormesh(xi, yi, zi.reshape(xi.shape), shading='gouraud', cmap=plt.cm.PuBu_r)
     im = ax.pcolormesh(xi, yi, zi.reshape(xi.shape), shading='gouraud', cmap=plt.cm.PuBu_r,
@@ -105,9 +137,63 @@ def make_diff_avg_pt_density_plot(x_vals, y_vals, title, xlab, ylab, figname):
     plt.savefig(figname, bbox_inches='tight')
     plt.close('all')
 
+# Every beta value column in the large difference BED file
+POSSIBLE_TAGS = [
+    'an1_hi', 'an2_hi', 'an1_lo', 'an2_lo',
+    'bn1_hi', 'bn2_hi', 'bn1_lo', 'bn2_lo',
+    'as1_hi', 'as2_hi', 'as1_lo', 'as2_lo',
+    'bs1_hi', 'bs2_hi', 'bs1_lo', 'bs2_lo'
+]
+
+def pair_frame(aligned, idx, n_tag, s_tag, beta_n, beta_s):
+    """Create DataFrame of beta values and differences for NEB/Swift pair.
+
+    Inputs: aligned - output of cpg_align.align()
+            idx     - row indices of aligned CpGs to include
+            n_tag   - tag of NEB sample
+            s_tag   - tag of Swift sample
+            beta_n  - NEB beta values for all aligned CpGs
+            beta_s  - Swift beta values for all aligned CpGs
+
+    Returns: DataFrame with chr, start, end, beta_<n_tag>, beta_<s_tag>, diff,
+             and avg columns
+    """
+    df = pd.DataFrame({
+        'chr': aligned['chr'][idx],
+        'start': aligned['start'][idx],
+        'end': aligned['end'][idx],
+        'beta_'+n_tag: beta_n[idx],
+        'beta_'+s_tag: beta_s[idx]
+    })
+    df['diff'] = df['beta_'+n_tag] - df['beta_'+s_tag]
+    df['avg'] = (df['beta_'+n_tag] + df['beta_'+s_tag]) / 2
+
+    return df
+
+def pair_of_pairs_tags(pair1, pair2):
+    """Find beta value tags, in output order, shared by two NEB/Swift pairs.
+
+    Inputs: pair1 - tuple (NEB tag, Swift tag)
+            pair2 - tuple (NEB tag, Swift tag)
+
+    Returns: list of tags (shared tag first when the pairs share a sample)
+    """
+    if pair1[0] == pair2[0]:
+        return [pair1[0], pair1[1], pair2[1]]
+    elif pair1[1] == pair2[1]:
+        return [pair1[1], pair1[0], pair2[0]]
+
+    return [pair1[0], pair2[0], pair1[1], pair2[1]]
+
 def find_big_diff_cpgs(neb_dic, swi_dic, outfile):
     """Find CpGs that have a large difference between NEB and Swift kits.
 
+    All replicates are aligned into a single CpG x sample matrix keyed by
+    integer genome coordinates, and large differences are found with masks
+    over that matrix. A CpG is written once for each distinct set of samples
+    where it has a large difference in two different NEB/Swift pairs, with NA
+    for samples not in that set.
+
     Inputs: neb_dic - dictionary of NEB CpG beta values
             swi_dic - dictionary of Swift CpG beta values
             outfile - name of output file for large beta value difference CpGs
@@ -121,98 +207,430 @@ def find_big_diff_cpgs(neb_dic, swi_dic, outfile):
              df        - data frame containing CpGs with large beta value
                          differences
     """
+    dics = neb_dic + swi_dic
+    column = dict((dic['tag'], idx) for idx, dic in enumerate(dics))
+
+    aligned = cpg_align.align([dic['data'] for dic in dics], values=['beta', 'covg'])
+    beta = np.where(aligned['covg'] > 20, aligned['beta'], np.nan)
+
     all_diffs = {}
     lrg_diffs = {}
+    large = {}
     for dic_n in neb_dic:
         for dic_s in swi_dic:
             key = dic_n['tag'] + '_' + dic_s['tag']
+            label = ' '.join([dic_n['lib'], dic_n['title']]) + ' - ' + ' '.join([dic_s['lib'], dic_s['title']])
+
+            beta_n = beta[:, column[dic_n['tag']]]
+            beta_s = beta[:, column[dic_s['tag']]]
+
+            both = ~np.isnan(beta_n) & ~np.isnan(beta_s)
+            large[key] = both & (np.abs(beta_n - beta_s) > 0.5)
+
+            all_diffs[key] = {
+                'data': pair_frame(aligned, np.flatnonzero(both), dic_n['tag'], dic_s['tag'], beta_n, beta_s),
+                'tag': key, 'label': label, 'n_tag': dic_n['tag'], 's_tag': dic_s['tag']
+            }
+            lrg_diffs[key] = {
+                'data': pair_frame(aligned, np.flatnonzero(large[key]), dic_n['tag'], dic_s['tag'], beta_n, beta_s),
+                'tag': key, 'label': label, 'n_tag': dic_n['tag'], 's_tag': dic_s['tag']
+            }
+
+    # Combine masks of pairs of NEB/Swift pairs that cover the same samples,
+    # so each (CpG, sample set) only occurs once
+    keys = list(lrg_diffs.keys())
+    tag_sets = {}
+    for i in range(len(keys)):
+        for j in range(i+1, len(keys)):
+            dic1 = lrg_diffs[keys[i]]
+            dic2 = lrg_diffs[keys[j]]
+            tags = pair_of_pairs_tags((dic1['n_tag'], dic1['s_tag']), (dic2['n_tag'], dic2['s_tag']))
+
+            mask = large[keys[i]] & large[keys[j]]
+            tag_set = frozenset(tags)
+            if tag_set in tag_sets:
+                tag_sets[tag_set] = tag_sets[tag_set] | mask
+            else:
+                tag_sets[tag_set] = mask
+
+            # Columns start with the samples of the first pair of pairs
+            if i == 0 and j == 1:
+                first_tags = tags
+
+    out_tags = list(first_tags)
+    out_tags += [t for t in POSSIBLE_TAGS + list(column.keys()) if t not in out_tags]
+
+    # Rows for each (CpG, sample set), sorted by genome coordinate
+    rows = []
+    sets = []
+    for set_idx, (tag_set, mask) in enumerate(tag_sets.items()):
+        idx = np.flatnonzero(mask)
+        rows.append(idx)
+        sets.append(np.full(len(idx), set_idx))
+    rows = np.concatenate(rows)
+    sets = np.concatenate(sets)
+
+    order = np.lexsort((sets, aligned['coords'][rows]))
+    rows = rows[order]
+    sets = sets[order]
+
+    df = pd.DataFrame({
+        'chr': aligned['chr'][rows],
+        'start': aligned['start'][rows],
+        'end': aligned['end'][rows]
+    })
+    for tag in out_tags:
+        in_set = np.array([tag in tag_set for tag_set in tag_sets.keys()])
+        if tag in column:
+            df['beta_'+tag] = np.where(in_set[sets], beta[rows, column[tag]], np.nan)
+        else:
+            df['beta_'+tag] = np.nan
 
-            all_diffs[key] = {}
-            lrg_diffs[key] = {}
+    # Beta values are written with the shortest exact representation
+    out = df[['chr', 'start', 'end']].copy()
+    for tag in out_tags:
+        vals = df['beta_'+tag].to_numpy(dtype=np.float32)
+        out['beta_'+tag] = np.where(np.isnan(vals), 'NA', vals.astype(str))
+    out.to_csv(outfile, sep='\t', index=False)
 
-            neb = dic_n['data']
-            swi = dic_s['data']
+    return all_diffs, lrg_diffs, df
 
-            neb = neb[neb.covg > 20]
-            swi = swi[swi.covg > 20]
+# Edges of bins for genome-wide histograms of beta value differences
+DIFF_BINS = np.linspace(-1, 1, 41)
 
-            merged = pd.merge(neb, swi, on=['chr', 'start', 'end'], suffixes=['_'+dic_n['tag'], '_'+dic_s['tag']])
+# Per pair sums accumulated over shards
+SCAN_SUMS = ['n_cpgs', 'n_large', 'n_large_pos', 'n_large_neg', 'sum_diff', 'sum_sq_diff', 'sum_abs_diff']
 
-            merged['diff'] = merged['beta_'+dic_n['tag']] - merged['beta_'+dic_s['tag']]
-            merged['avg'] = (merged['beta_'+dic_n['tag']] + merged['beta_'+dic_s['tag']]) / 2
-            larged = merged[merged['diff'].abs() > 0.5]
+def scan_shard(samples, chrom, min_covg=21, threshold=0.5, store=None):
+    """Compare beta values of every pair of samples on one chromosome.
 
-            all_diffs[key]['data'] = merged[['chr', 'start', 'end', 'beta_'+dic_n['tag'], 'beta_'+dic_s['tag'], 'diff', 'avg']]
-            all_diffs[key]['tag'] = key
-            all_diffs[key]['label'] = ' '.join([dic_n['lib'], dic_n['title']]) + ' - ' + ' '.join([dic_s['lib'], dic_s['title']])
-            all_diffs[key]['n_tag'] = dic_n['tag']
-            all_diffs[key]['s_tag'] = dic_s['tag']
+    Inputs: samples   - list of (tag, file) tuples
+            chrom     - chromosome to scan
+            min_covg  - minimum coverage of CpGs compared [default: 21]
+            threshold - abs(diff) above which a difference is large
+                        [default: 0.5]
+            store     - directory of methylation store (see meth_store.py) to
+                        read samples from instead of files [default: None]
 
-            lrg_diffs[key]['data'] = larged[['chr', 'start', 'end', 'beta_'+dic_n['tag'], 'beta_'+dic_s['tag'], 'diff', 'avg']]
-            lrg_diffs[key]['tag'] = key
-            lrg_diffs[key]['label'] = ' '.join([dic_n['lib'], dic_n['title']]) + ' - ' + ' '.join([dic_s['lib'], dic_s['title']])
-            lrg_diffs[key]['n_tag'] = dic_n['tag']
-            lrg_diffs[key]['s_tag'] = dic_s['tag']
+    Returns: tuple (chrom, sums, hist, n_cpgs, seconds)
+             sums   - np.array (n pairs x len(SCAN_SUMS)) of per pair sums
+             hist   - np.array (n pairs x n bins) of counts of differences in
+                      DIFF_BINS
+             n_cpgs - number of CpGs covered in any sample
+    """
+    t1 = time.time()
 
-    possible_tags = [
-        'beta_an1_hi', 'beta_an2_hi', 'beta_an1_lo', 'beta_an2_lo',
-        'beta_bn1_hi', 'beta_bn2_hi', 'beta_bn1_lo', 'beta_bn2_lo',
-        'beta_as1_hi', 'beta_as2_hi', 'beta_as1_lo', 'beta_as2_lo',
-        'beta_bs1_hi', 'beta_bs2_hi', 'beta_bs1_lo', 'beta_bs2_lo'
-    ]
-    frames = []
-    for key1, dic1 in lrg_diffs.items():
-        for key2, dic2 in lrg_diffs.items():
-            if key1 == key2:
-                continue
-
-            merged = pd.merge(dic1['data'], dic2['data'], on=['chr', 'start', 'end'], suffixes=['_'+key1, '_'+key2])
-
-            if dic1['n_tag'] == dic2['n_tag']:
-                red = merged[
-                    ['chr', 'start', 'end', 'beta_'+dic1['n_tag']+'_'+key1, 'beta_'+dic1['s_tag'], 'beta_'+dic2['s_tag']]
-                ]
-                red = red.rename(columns={'beta_'+dic1['n_tag']+'_'+key1: 'beta_'+dic1['n_tag']})
-            elif dic1['s_tag'] == dic2['s_tag']:
-                red = merged[
-                    ['chr', 'start', 'end', 'beta_'+dic1['s_tag']+'_'+key1, 'beta_'+dic1['n_tag'], 'beta_'+dic2['n_tag']]
-                ]
-                red = red.rename(columns={'beta_'+dic1['s_tag']+'_'+key1: 'beta_'+dic1['s_tag']})
-            else:
-                red = merged[
-                    ['chr', 'start', 'end', 'beta_'+dic1['n_tag'],  'beta_'+dic2['n_tag'],'beta_'+dic1['s_tag'], 'beta_'+dic2['s_tag']]
-                ]
+    if store is not None:
+        aligned = meth_store.query(meth_store.open_store(store), chrom,
+                                   [tag for tag, fname in samples], min_covg)
+    else:
+        cols = ['chr', 'start', 'end', 'beta', 'covg']
+        frames = [bed_reader.read_region(fname, chrom, usecols=cols, min_covg=min_covg)
+                  for tag, fname in samples]
+        aligned = cpg_align.align(frames, values=['beta'], chroms=[chrom])
+        del frames
 
-            for p_tag in possible_tags:
-                if not p_tag in list(red.columns):
-                    red = red.assign(p_tag = 'NA')
-                    red = red.rename(columns={'p_tag': p_tag})
+    sums, hist = pair_sums(aligned['beta'], threshold)
 
-            frames.append(red)
+    t2 = time.time()
 
-    df = pd.concat(frames, ignore_index=True)
-    df = df.sort_values(by=['chr', 'start'], ignore_index=True)
-    df = df.drop_duplicates(ignore_index=True)
+    return chrom, sums, hist, len(aligned['coords']), t2-t1
 
-    df.to_csv(outfile, sep='\t', index=False, float_format='%.4f')
+def pair_sums(beta, threshold=0.5):
+    """Find sums and histograms of beta value differences of every pair of samples.
 
-    return all_diffs, lrg_diffs, df
+    Inputs: beta      - np.array (n CpGs x n samples) of beta values, NaN where
+                        a sample has no value
+            threshold - abs(diff) above which a difference is large
+                        [default: 0.5]
+
+    Returns: tuple (sums, hist)
+             sums - np.array (n pairs x len(SCAN_SUMS)) of per pair sums
+             hist - np.array (n pairs x n bins) of counts of differences in
+                    DIFF_BINS
+    """
+    pairs = list(itertools.combinations(range(beta.shape[1]), 2))
+
+    sums = np.zeros((len(pairs), len(SCAN_SUMS)))
+    hist = np.zeros((len(pairs), len(DIFF_BINS)-1), dtype=np.int64)
+    for idx, (i, j) in enumerate(pairs):
+        diff = (beta[:, i] - beta[:, j]).astype(np.float64)
+        diff = diff[~np.isnan(diff)]
+
+        sums[idx] = [
+            len(diff),
+            np.count_nonzero(np.abs(diff) > threshold),
+            np.count_nonzero(diff > threshold),
+            np.count_nonzero(diff < -threshold),
+            diff.sum(),
+            np.square(diff).sum(),
+            np.abs(diff).sum()
+        ]
+        hist[idx] = np.histogram(diff, bins=DIFF_BINS)[0]
+
+    return sums, hist
+
+def scan_stream(samples, chroms=None, min_covg=21, threshold=0.5):
+    """Compare beta values of every pair of samples in one pass over the files.
+
+    The sorted files are merge joined block by block (see merge_join.py), so
+    memory use does not depend on the size of the files or chromosomes and no
+    tabix index is needed.
+
+    Inputs: samples   - list of (tag, file) tuples, files sorted by chromosome
+                        and start position
+            chroms    - chromosomes to scan [default: all]
+            min_covg  - minimum coverage of CpGs compared [default: 21]
+            threshold - abs(diff) above which a difference is large
+                        [default: 0.5]
+
+    Yields: tuple (chrom, sums, hist, n_cpgs, seconds) for each chromosome, as
+            from scan_shard()
+    """
+    current = None
+    t1 = time.time()
+    for block in merge_join.merge_join([fname for tag, fname in samples], min_covg=min_covg):
+        if chroms is not None and block['chr'] not in chroms:
+            continue
+
+        if block['chr'] != current:
+            if current is not None:
+                yield current, sums, hist, n_cpgs, time.time()-t1
+            current = block['chr']
+            sums, hist = pair_sums(block['beta'][:0], threshold)
+            n_cpgs = 0
+            t1 = time.time()
+
+        block_sums, block_hist = pair_sums(block['beta'], threshold)
+        sums += block_sums
+        hist += block_hist
+        n_cpgs += len(block['start'])
+
+    if current is not None:
+        yield current, sums, hist, n_cpgs, time.time()-t1
+
+def pair_table(tags, sums):
+    """Create table of pairwise differences from accumulated sums.
+
+    Inputs: tags - list of sample tags
+            sums - np.array (n pairs x len(SCAN_SUMS)) of per pair sums
+
+    Returns: DataFrame with one row per pair of samples
+    """
+    pairs = list(itertools.combinations(tags, 2))
+    df = pd.DataFrame(sums, columns=SCAN_SUMS)
+    df.insert(0, 'tag_2', [p[1] for p in pairs])
+    df.insert(0, 'tag_1', [p[0] for p in pairs])
+
+    n = df['n_cpgs'].where(df['n_cpgs'] > 0)
+    df['frac_large'] = df['n_large'] / n
+    df['mean_diff'] = df['sum_diff'] / n
+    df['sd_diff'] = np.sqrt((df['sum_sq_diff'] - n * df['mean_diff']**2).clip(lower=0) / (n - 1))
+    df['mean_abs_diff'] = df['sum_abs_diff'] / n
+
+    df = df.drop(columns=['sum_diff', 'sum_sq_diff', 'sum_abs_diff'])
+    for col in ['n_cpgs', 'n_large', 'n_large_pos', 'n_large_neg']:
+        df[col] = df[col].astype(np.int64)
+
+    return df
+
+def scan_all_pairs(samples, prefix, chroms=None, jobs=1, min_covg=21, threshold=0.5, store=None,
+                   stream=False):
+    """Scan differences between every pair of samples one chromosome at a time.
+
+    Each chromosome is a separate task (shard), so peak memory per worker is
+    set by the largest chromosome rather than the whole genome. Shard results
+    are reduced into genome-wide tables as they finish.
+
+    Inputs: samples   - list of (tag, file) tuples
+            prefix    - prefix of output files
+            chroms    - chromosomes to scan [default: all in tabix indexes or
+                        store]
+            jobs      - number of worker processes [default: 1]
+            min_covg  - minimum coverage of CpGs compared [default: 21]
+            threshold - abs(diff) above which a difference is large
+                        [default: 0.5]
+            store     - directory of methylation store to read samples from
+                        [default: read files in samples]
+            stream    - merge join files in one pass instead of reading one
+                        chromosome at a time (see scan_stream()) [default: False]
+
+    Returns: list of chromosomes that failed, raises ValueError if store is
+             not up to date with samples (see meth_store.up_to_date())
+    Writes:  <prefix>_pairs.tsv        - genome-wide pairwise differences
+             <prefix>_pairs_by_chr.tsv - pairwise differences per chromosome
+             <prefix>_diff_hist.tsv    - genome-wide difference histograms
+    """
+    tags = [tag for tag, fname in samples]
+
+    # Every shard would otherwise read stale values (or samples missing from
+    # the store)
+    if store is not None and not stream and not meth_store.up_to_date(samples, store):
+        raise ValueError(f'[scan_all_pairs] store {store} does not match the samples or their '
+                         f'files, rebuild it with meth_store.py')
+
+    if stream:
+        scanned = []
+    elif chroms is None and store is not None:
+        chroms = meth_store.open_store(store)['chroms']
+    elif chroms is None:
+        chroms = []
+        for tag, fname in samples:
+            chroms += [c for c in bed_reader.list_chromosomes(fname) if c not in chroms]
+
+    n_pairs = len(tags) * (len(tags)-1) // 2
+    sums = np.zeros((n_pairs, len(SCAN_SUMS)))
+    hist = np.zeros((n_pairs, len(DIFF_BINS)-1), dtype=np.int64)
+    by_chr = {}
+    failed = []
+    start = time.time()
+
+    def reduce(result):
+        """Add shard result to genome-wide totals."""
+        chrom, shard_sums, shard_hist, n_cpgs, secs = result
+        sums[:] += shard_sums
+        hist[:] += shard_hist
+        by_chr[chrom] = shard_sums
+        total = len(chroms) if chroms is not None else '?'
+        print(f'[{len(by_chr)}/{total}] {chrom}: {n_cpgs:,} CpGs in {secs:.1f} seconds ; '
+              f'total {time.time() - start:.1f} seconds', flush=True)
+
+    if stream:
+        # Chromosomes are only known as the files are read
+        try:
+            for result in scan_stream(samples, chroms, min_covg, threshold):
+                scanned.append(result[0])
+                reduce(result)
+        except Exception as e:
+            failed.append('all')
+            print(f'ERROR: {e!r}', flush=True)
+        chroms = scanned
+    elif jobs == 1:
+        for chrom in chroms:
+            try:
+                reduce(scan_shard(samples, chrom, min_covg, threshold, store))
+            except Exception as e:
+                failed.append(chrom)
+                print(f'{chrom}: ERROR: {e!r}', flush=True)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = dict((pool.submit(scan_shard, samples, chrom, min_covg, threshold, store), chrom)
+                           for chrom in chroms)
+            for future in as_completed(futures):
+                try:
+                    reduce(future.result())
+                except Exception as e:
+                    failed.append(futures[future])
+                    print(f'{futures[future]}: ERROR: {e!r}', flush=True)
+
+    pair_table(tags, sums).to_csv(prefix + '_pairs.tsv', sep='\t', index=False)
+
+    tables = []
+    for chrom in chroms:
+        if chrom in by_chr:
+            df = pair_table(tags, by_chr[chrom])
+            df.insert(0, 'chr', chrom)
+            tables.append(df)
+    if len(tables) > 0:
+        pd.concat(tables, ignore_index=True).to_csv(prefix + '_pairs_by_chr.tsv', sep='\t', index=False)
+
+    pairs = list(itertools.combinations(tags, 2))
+    df = pd.DataFrame({
+        'tag_1': np.repeat([p[0] for p in pairs], len(DIFF_BINS)-1),
+        'tag_2': np.repeat([p[1] for p in pairs], len(DIFF_BINS)-1),
+        'bin_low': np.tile(DIFF_BINS[:-1], n_pairs),
+        'bin_high': np.tile(DIFF_BINS[1:], n_pairs),
+        'count': hist.flatten()
+    })
+    df.to_csv(prefix + '_diff_hist.tsv', sep='\t', index=False, float_format='%.2f')
+
+    return failed
 
 def main():
     """Run methylation bias analysis."""
-    col_names = ['chr', 'start', 'end', 'beta', 'covg', 'context']
+    parser = argparse.ArgumentParser(
+        description = 'meth_bias_analysis.py compares CpG beta values between library preps'
+    )
+
+    parser.add_argument(
+        '-s', '--scan',
+        default = None,
+        help = 'Manifest of samples (tag and file columns) to compare in all pairs, '
+               'one chromosome at a time [default: compare NEB and Swift only]'
+    )
+
+    parser.add_argument(
+        '-p', '--prefix',
+        default = 'all_pairs',
+        help = 'Prefix of --scan output files [default: all_pairs]'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type = int,
+        default = 1,
+        help = 'Number of chromosomes to scan in parallel [default: 1]'
+    )
+
+    parser.add_argument(
+        '-c', '--chroms',
+        default = None,
+        help = 'Comma-separated chromosomes to scan [default: all in tabix indexes]'
+    )
+
+    parser.add_argument(
+        '-t', '--threshold',
+        type = float,
+        default = 0.5,
+        help = 'Absolute beta value difference counted as large [default: 0.5]'
+    )
+
+    parser.add_argument(
+        '--store',
+        default = None,
+        help = 'Methylation store (from meth_store.py) to read --scan samples from ' +
+               'instead of their files [default: read files]'
+    )
+
+    parser.add_argument(
+        '--stream',
+        action = 'store_true',
+        help = 'Scan --scan samples in one pass over their sorted files, without ' +
+               'tabix indexes or loading whole chromosomes (ignores --jobs)'
+    )
+
+    args = parser.parse_args()
+
+    if args.scan is not None:
+        samples = bed_reader.read_manifest(args.scan)
+        chroms = args.chroms.split(',') if args.chroms is not None else None
+        try:
+            failed = scan_all_pairs(samples, args.prefix, chroms, args.jobs, threshold=args.threshold,
+                                    store=args.store, stream=args.stream)
+        except ValueError as e:
+            print(e)
+            return 1
+
+        if len(failed) > 0:
+            print('Failed chromosomes: ' + ', '.join(failed))
+            return 1
+
+        return 0
+
+    # Only CpGs with coverage > 20 are compared, so filter them while reading
+    cols = ['chr', 'start', 'end', 'beta', 'covg']
 
     dirloc = '2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/align/'
     filtag = '.cg.sorted.mergecg.bed.gz'
 
-    df_01 = pd.read_csv(dirloc + 'FtubeAneb' + filtag, sep='\t', names=col_names, na_values='.')
-    df_02 = pd.read_csv(dirloc + 'FtubeAswift' + filtag, sep='\t', names=col_names, na_values='.')
-    df_03 = pd.read_csv(dirloc + 'FtubeAnebRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_04 = pd.read_csv(dirloc + 'FtubeAswiftRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_05 = pd.read_csv(dirloc + 'FtubeBneb' + filtag, sep='\t', names=col_names, na_values='.')
-    df_06 = pd.read_csv(dirloc + 'FtubeBswift' + filtag, sep='\t', names=col_names, na_values='.')
-    df_07 = pd.read_csv(dirloc + 'FtubeBnebRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_08 = pd.read_csv(dirloc + 'FtubeBswiftRep2' + filtag, sep='\t', names=col_names, na_values='.')
+    df_01 = bed_reader.read_bed(dirloc + 'FtubeAneb' + filtag, usecols=cols, min_covg=21)
+    df_02 = bed_reader.read_bed(dirloc + 'FtubeAswift' + filtag, usecols=cols, min_covg=21)
+    df_03 = bed_reader.read_bed(dirloc + 'FtubeAnebRep2' + filtag, usecols=cols, min_covg=21)
+    df_04 = bed_reader.read_bed(dirloc + 'FtubeAswiftRep2' + filtag, usecols=cols, min_covg=21)
+    df_05 = bed_reader.read_bed(dirloc + 'FtubeBneb' + filtag, usecols=cols, min_covg=21)
+    df_06 = bed_reader.read_bed(dirloc + 'FtubeBswift' + filtag, usecols=cols, min_covg=21)
+    df_07 = bed_reader.read_bed(dirloc + 'FtubeBnebRep2' + filtag, usecols=cols, min_covg=21)
+    df_08 = bed_reader.read_bed(dirloc + 'FtubeBswiftRep2' + filtag, usecols=cols, min_covg=21)
 
     neb_sets_a = [
         {'data': df_01, 'tag': 'an1_hi', 'title': 'Sample A Rep. 1', 'lib': 'NEB'},
@@ -274,5 +692,7 @@ def main():
         'plots/sample_b_rep1_vs_rep2_diff_density.png'
     )
 
+    return 0
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,64 +1,366 @@
-"""Retrieve CAG, CAH, CTG, CTH trinucleotide methylation values."""
+"""Retrieve CAG, CAH, CTG, CTH trinucleotide methylation values and, optionally,
+   a census of methylation in every cytosine context.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
+import subprocess
+import argparse
+import resource
 import glob
 import time
+import sys
 import os
 
-def read_file(fname, out_name):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from atomic import atomic_output
+
+# Names of columns in file
+COLS = [
+    'chr',       # chromosome
+    'start',     # start location
+    'end',       # end location
+    'ref',       # reference base
+    'group',     # context group (CG, CHG, CHH)
+    'two_base',  # 2-base context
+    'five_base', # 5-base context
+    'beta',      # beta value
+    'covg'       # loci coverage
+]
+
+# Columns to group on when aggregating
+KEYS = ['group', 'two_base']
+
+# Columns to group on when aggregating for the context census, the two- and
+# three-base contexts and the genome-wide values are rolled up from these
+CENSUS_KEYS = ['chr', 'group', 'two_base', 'five_base']
+
+# Context levels reported in the context census
+LEVELS = ['group', 'two_base', 'three_base', 'five_base']
+
+# (group, two_base) pair for each trinucleotide context, in output order
+CONTEXTS = {
+    'cah': ('CHH', 'CA'),
+    'cag': ('CHG', 'CA'),
+    'cth': ('CHH', 'CT'),
+    'ctg': ('CHG', 'CT')
+}
+
+def aggregate(fname, census=False, chunksize=1e6):
+    """Sum and count beta values for each context in file.
+
+    Only the needed columns are parsed (with categorical context columns) and
+    each chunk is reduced with a single groupby, so memory is bounded by the
+    chunk size rather than the file size.
+
+    Inputs -
+        fname     - file (or open binary stream) to retrieve values from
+        census    - group on CENSUS_KEYS and also sum coverage and
+                    methylated reads (beta * covg) [default: False]
+        chunksize - number of rows to read at a time [default: 1e6]
+    Returns -
+        DataFrame indexed by KEYS (or CENSUS_KEYS) with count and beta columns
+        (plus covg and meth columns for the census)
+    """
+    keys = CENSUS_KEYS if census else KEYS
+    vals = ['beta', 'covg', 'meth'] if census else ['beta']
+
+    dtype = dict((key, 'category') for key in keys)
+    dtype.update({'beta': 'float32', 'covg': 'uint32'})
+
+    totals = None
+    for chunk in pd.read_csv(fname, sep='\t', header=None, names=COLS,
+                             usecols=[c for c in COLS if c in keys or c in vals],
+                             dtype=dtype, chunksize=chunksize):
+        if census:
+            chunk['meth'] = chunk['beta'] * chunk['covg']
+
+        grouped = chunk.groupby(keys, observed=True)
+        agg = grouped[vals].sum().astype('float64')
+        agg['count'] = grouped.size()
+
+        totals = agg if totals is None else totals.add(agg, fill_value=0)
+
+    return totals
+
+def census_table(totals):
+    """Roll up census totals into each context level, per chromosome and
+       genome-wide.
+
+    Inputs -
+        totals - DataFrame from aggregate(fname, census=True)
+    Returns -
+        DataFrame with chr ('all' for genome-wide), level, context, count,
+        covg, base-averaged methylation (%), and coverage-weighted
+        methylation (%) columns
+    """
+    df = totals.reset_index()
+    df['five_base'] = df['five_base'].astype(str)
+    df['three_base'] = df['five_base'].str[2:5]
+
+    sums = ['count', 'covg', 'beta', 'meth']
+    frames = []
+    for level in LEVELS:
+        gen = df.groupby(level, observed=True)[sums].sum().reset_index()
+        gen['chr'] = 'all'
+
+        by_chr = df.groupby(['chr', level], observed=True)[sums].sum().reset_index()
+
+        for part in [gen, by_chr]:
+            part = part.rename(columns={level: 'context'})
+            part['level'] = level
+            frames.append(part)
+
+    out = pd.concat(frames, ignore_index=True)
+    out['chr'] = out['chr'].astype(str)
+    out['context'] = out['context'].astype(str)
+    out['count'] = out['count'].astype('int64')
+    out['covg'] = out['covg'].astype('int64')
+    out['base_avg'] = 100 * out['beta'] / out['count']
+    out['covg_weighted'] = 100 * out['meth'] / out['covg']
+
+    return out[['chr', 'level', 'context', 'count', 'covg', 'base_avg', 'covg_weighted']]
+
+class TeeStream:
+    """Binary stream that copies everything read from it into a gzip file.
+
+    Compression is done by a separate gzip process, so keeping a copy of the
+    stream costs little extra time in the aggregating process.
+    """
+    def __init__(self, stream, out_name):
+        """Start gzip process writing to out_name.
+
+        Inputs -
+            stream   - uncompressed binary stream to read from
+            out_name - name of gzipped file to write copy of stream to
+        """
+        self.stream = stream
+        self.out = open(out_name, 'wb')
+        self.proc = subprocess.Popen(['gzip', '-c'], stdin=subprocess.PIPE, stdout=self.out)
+
+    def read(self, size=-1):
+        """Read from stream and copy data to gzip process."""
+        data = self.stream.read(size)
+        self.proc.stdin.write(data)
+
+        return data
+
+    def __iter__(self):
+        """Iterate over lines in stream, copying them to gzip process."""
+        for line in self.stream:
+            self.proc.stdin.write(line)
+            yield line
+
+    def close(self):
+        """Wait for gzip process to finish writing copy of stream."""
+        self.proc.stdin.close()
+        ret = self.proc.wait()
+        self.out.close()
+
+        if ret != 0:
+            raise OSError(f'gzip exited with status {ret}')
+
+def open_input(fname):
+    """Open input file, '-' is standard input.
+
+    Inputs -
+        fname - file name, named pipe, or '-'
+    Returns -
+        binary stream for fname
+    """
+    if fname == '-':
+        return sys.stdin.buffer
+
+    return open(fname, 'rb')
+
+def read_file(fname, out_name, census_name=None, tee_name=None):
     """Read base-averaged trinucleotide methylation values from file.
 
     Inputs -
-        fname    - file to retrieve values from
-        out_name - name of file to write results to
+        fname       - file to retrieve values from, can be '-' (standard input)
+                      or a named pipe so values are aggregated while the file
+                      is still being produced
+        out_name    - name of file to write results to
+        census_name - name of file to write context census to, the census is
+                      collected in the same pass over fname [default: None]
+        tee_name    - name of gzipped file to keep a copy of the (uncompressed)
+                      input in [default: None]
     Returns -
-        Nothing, writes values to file
+        Number of cytosines read from fname, writes values to file
     """
-    # Names of columns in file
-    cols = [
-        'chr',       # chromosome
-        'start',     # start location
-        'end',       # end location
-        'ref',       # reference base
-        'group',     # context group (CG, CHG, CHH)
-        'two_base',  # 2-base context
-        'five_base', # 5-base context
-        'beta',      # beta value
-        'covg'       # loci coverage
-    ]
-    cah_sum = 0 ; cah_len = 0 # Variables for base-averaged CAH methylation
-    cag_sum = 0 ; cag_len = 0 # Variables for base-averaged CAG methylation
-    cth_sum = 0 ; cth_len = 0 # Variables for base-averaged CTH methylation
-    ctg_sum = 0 ; ctg_len = 0 # Variables for base-averaged CTG methylation
-
-    # Read BED file in chunks to ease memory load
-    for chunk in pd.read_csv(fname, sep='\t', header=None, names=cols, chunksize=1e6):
-        cah_sum += chunk[(chunk.group == 'CHH') & (chunk.two_base == 'CA')]['beta'].sum()
-        cah_len += len(chunk[(chunk.group == 'CHH') & (chunk.two_base == 'CA')]['beta'])
-
-        cag_sum += chunk[(chunk.group == 'CHG') & (chunk.two_base == 'CA')]['beta'].sum()
-        cag_len += len(chunk[(chunk.group == 'CHG') & (chunk.two_base == 'CA')]['beta'])
-
-        cth_sum += chunk[(chunk.group == 'CHH') & (chunk.two_base == 'CT')]['beta'].sum()
-        cth_len += len(chunk[(chunk.group == 'CHH') & (chunk.two_base == 'CT')]['beta'])
-
-        ctg_sum += chunk[(chunk.group == 'CHG') & (chunk.two_base == 'CT')]['beta'].sum()
-        ctg_len += len(chunk[(chunk.group == 'CHG') & (chunk.two_base == 'CT')]['beta'])
+    if tee_name is not None:
+        with atomic_output(tee_name) as tmp:
+            stream = TeeStream(open_input(fname), tmp)
+            totals = aggregate(stream, census=census_name is not None)
+            stream.close()
+    elif fname == '-':
+        totals = aggregate(open_input(fname), census=census_name is not None)
+    else:
+        totals = aggregate(fname, census=census_name is not None)
+
+    if census_name is not None:
+        with atomic_output(census_name) as tmp:
+            census_table(totals).to_csv(tmp, sep='\t', index=False, float_format='%.4f')
+
+        totals = totals.groupby(level=KEYS, observed=True).sum()
 
     # Calculate base-averaged methylation value
-    cah_meth = 100 * cah_sum / cah_len
-    cag_meth = 100 * cag_sum / cag_len
-    cth_meth = 100 * cth_sum / cth_len
-    ctg_meth = 100 * ctg_sum / ctg_len
-
-    with open(out_name, 'w') as f:
-        f.write(
-            '{:.2f}\t{:.2f}\t{:.2f}\t{:.2f}'.format(
-                cah_meth, cag_meth, cth_meth, ctg_meth
-            )
+    meth = []
+    for key in CONTEXTS.values():
+        meth.append(100 * totals.loc[key, 'beta'] / totals.loc[key, 'count'])
+
+    with atomic_output(out_name) as tmp:
+        with open(tmp, 'w') as f:
+            f.write('\t'.join('{:.2f}'.format(m) for m in meth))
+
+    return int(totals['count'].sum())
+
+def limit_memory(max_mem):
+    """Cap address space of worker process.
+
+    Inputs -
+        max_mem - maximum memory in GB (None for no limit)
+    Returns -
+        Nothing, sets resource limit for current process
+    """
+    if max_mem is not None:
+        n_bytes = int(max_mem * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (n_bytes, n_bytes))
+
+def run_task(tag, fname, out_name, census_name):
+    """Process one file and time it.
+
+    Inputs -
+        tag         - label for file in progress messages
+        fname       - file to retrieve values from
+        out_name    - name of file to write results to
+        census_name - name of file to write context census to (or None)
+    Returns -
+        tuple (tag, number of cytosines read, seconds taken)
+    """
+    t1 = time.time()
+    n_rows = read_file(fname, out_name, census_name)
+    t2 = time.time()
+
+    return tag, n_rows, t2-t1
+
+def run_tasks(tasks, jobs=1, max_mem=None):
+    """Process files, in a pool of worker processes if jobs > 1.
+
+    Inputs -
+        tasks   - list of (tag, fname, out_name, census_name) tuples
+        jobs    - number of worker processes [default: 1]
+        max_mem - maximum memory per worker in GB [default: no limit]
+    Returns -
+        list of tags that failed
+    """
+    failed = []
+    n_done = 0
+    n_rows = 0
+    start = time.time()
+
+    def report(tag, rows, secs):
+        """Print consolidated progress and throughput for a finished file."""
+        elapsed = time.time() - start
+        print(
+            f'[{n_done}/{len(tasks)}] {tag}: {rows:,} cytosines in {secs:.1f} seconds '
+            f'({rows / max(secs, 1e-9) / 1e6:.2f} M/s) ; '
+            f'total {n_rows:,} cytosines in {elapsed:.1f} seconds '
+            f'({n_rows / max(elapsed, 1e-9) / 1e6:.2f} M/s)',
+            flush=True
         )
 
+    if jobs == 1:
+        limit_memory(max_mem)
+        for task in tasks:
+            n_done += 1
+            try:
+                tag, rows, secs = run_task(*task)
+            except Exception as e:
+                failed.append(task[0])
+                print(f'[{n_done}/{len(tasks)}] {task[0]}: ERROR: {e!r}', flush=True)
+                continue
+
+            n_rows += rows
+            report(tag, rows, secs)
+
+        return failed
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=limit_memory, initargs=(max_mem,)) as pool:
+        futures = dict((pool.submit(run_task, *task), task[0]) for task in tasks)
+        for future in as_completed(futures):
+            n_done += 1
+            try:
+                tag, rows, secs = future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f'[{n_done}/{len(tasks)}] {futures[future]}: ERROR: {e!r}', flush=True)
+                continue
+
+            n_rows += rows
+            report(tag, rows, secs)
+
+    return failed
+
 def main():
     """Process cytosine context files."""
+    parser = argparse.ArgumentParser(
+        description = 'trinuc_methylation.py finds methylation in CAH/CAG/CTH/CTG contexts'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type = int,
+        default = 1,
+        help = 'Number of files to process in parallel [default: 1]'
+    )
+
+    parser.add_argument(
+        '-m', '--max-mem',
+        type = float,
+        default = None,
+        help = 'Maximum memory per worker process in GB [default: no limit]'
+    )
+
+    parser.add_argument(
+        '-i', '--input',
+        default = None,
+        help = 'Only process this file (\'-\' for standard input or a named pipe), '
+               'e.g. piped directly from biscuit vcf2bed -t c -e'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        default = None,
+        help = 'Output file for methylation values of --input'
+    )
+
+    parser.add_argument(
+        '-c', '--census',
+        default = None,
+        help = 'Output file for context census of --input [default: no census]'
+    )
+
+    parser.add_argument(
+        '-t', '--tee',
+        default = None,
+        help = 'Keep a gzipped copy of the uncompressed --input in this file'
+    )
+
+    args = parser.parse_args()
+
+    # Single stream mode
+    if args.input is not None:
+        if args.output is None:
+            parser.error('--output is required with --input')
+
+        limit_memory(args.max_mem)
+        t1 = time.time()
+        n_rows = read_file(args.input, args.output, args.census, args.tee)
+        t2 = time.time()
+        print(f'Processed {n_rows:,} cytosines in {t2-t1:.1f} seconds')
+
+        return 0
+
     raw_path = '2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/align/'
     sub_path = '2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/analyze_the_data/subsampling/'
     raw_ext = '.c.context.sorted.bed.gz'
@@ -66,28 +368,31 @@ def main():
 
     run_raw = True
     run_sub = True
+    run_census = True # Also write full cytosine context census tables
 
+    tasks = []
     if run_raw == True:
         files = glob.glob(raw_path+'*'+raw_ext)
         for f in files:
             samp = os.path.basename(f).replace(raw_ext, '')
-
-            print(f'Processing {samp}_raw', end=' ... ')
-            t1 = time.time()
-            read_file(f, samp+'_raw.tsv')
-            t2 = time.time()
-            print(f'in {t2-t1} seconds')
+            tasks.append(
+                (samp+'_raw', f, samp+'_raw.tsv', samp+'_raw.census.tsv' if run_census else None)
+            )
 
     if run_sub == True:
         files = glob.glob(sub_path+'*'+sub_ext)
         for f in files:
             samp = os.path.basename(f).replace(sub_ext, '')
+            tasks.append(
+                (samp+'_sub', f, samp+'_sub.tsv', samp+'_sub.census.tsv' if run_census else None)
+            )
+
+    failed = run_tasks(tasks, args.jobs, args.max_mem)
+    if len(failed) > 0:
+        print('Failed to process: {}'.format(', '.join(failed)))
+        return 1
 
-            print(f'Processing {samp}_sub', end=' ... ')
-            t1 = time.time()
-            read_file(f, samp+'_sub.tsv')
-            t2 = time.time()
-            print(f'in {t2-t1} seconds')
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,144 +1,227 @@
 import matplotlib.pyplot as plt
 from matplotlib import colors
-import pandas as pd
 import numpy as np
-from scipy.stats import spearmanr, gaussian_kde
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
 import sys
+import os
 
-def find_correlation_and_plot(x_vals, y_vals, title, xlab, ylab, figname, print_message=False, create_plots=True):
-    """Find the Spearman R correlation value and create scatter plot of beta
-       values.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+from atomic import atomic_output
+import correlation
+import bed_reader
+import cpg_align
+import density
+import pyramid
 
-    Inputs: x_vals        - list of values on x-axis
-            y_vals        - list of values on y-axis
-            title         - title of figure
-            xlab          - name of values on x-axis
-            ylab          - name of values on y-axis
-            figname       - name of file to save figure as
-            print_message - whether to print out a nice message about correlation
-            create_plots  - whether to generate the correlation plot
+# Ending of window averaged (bedtools map) files and of window pyramids
+WINDOW_TAG = '.subsampled.cg.sorted.mergecg.100kb_meth_avg.bed.gz'
+PYRAMID_TAG = '.subsampled.cg.sorted.mergecg' + pyramid.EXT
 
-    Returns: tuple (n_cpgs, coef, p)
-    """
-    # Create arrays with NaN values removed
-    xs = []
-    ys = []
-    for i in range(len(x_vals)):
-        if not np.isnan(x_vals[i]) and not np.isnan(y_vals[i]):
-            xs.append(x_vals[i])
-            ys.append(y_vals[i])
-    xs = np.array(xs)
-    ys = np.array(ys)
+def make_plots(xs, ys, n_cpgs, coef, title, xlab, ylab, figname, density_method='binned'):
+    """Create correlation density plot and histograms of beta values.
+
+    Inputs: xs             - np.array of values on x-axis (no NaNs)
+            ys             - np.array of values on y-axis (no NaNs)
+            n_cpgs         - number of CpGs (bins) compared
+            coef           - Spearman correlation coefficient
+            title          - title of figure
+            xlab           - name of values on x-axis
+            ylab           - name of values on y-axis
+            figname        - name of file to save figure as (histograms are
+                             saved as hist_<figname>)
+            density_method - density estimator, 'binned' or 'gaussian_kde'
+                             (see density.grid_density) [default: 'binned']
 
+    Returns: Nothing, plots saved to disk
+    """
     nbins = 100
-    n_cpgs = len(xs)
-    coef, p = spearmanr(xs, ys, nan_policy='omit')
-
-    if print_message:
-        print('The coefficient between {} and {} ='.format(xlab, ylab), end=' ')
-        print('{:0.3f} (with p-value = {:0.3f} and # CpGs = {:,})'.format(coef, p, n_cpgs))
-
-    if create_plots:
-        # Correlation figure
-        fig, ax = plt.subplots(figsize=(5,5))
-        plt.tight_layout()
-
-        try:
-            k = gaussian_kde(np.vstack([xs, ys]))
-        except np.linalg.LinAlgError:
-            xs[0] = xs[0] + 0.000001
-            k = gaussian_kde(np.vstack([xs, ys]))
-        xi, yi = np.mgrid[xs.min():xs.max():nbins*1j, ys.min():ys.max():nbins*1j]
-        zi = k(np.vstack([xi.flatten(), yi.flatten()]))
-        
-        im = ax.pcolormesh(xi, yi, zi.reshape(xi.shape), shading='gouraud', cmap=plt.cm.PuBu_r,
-                          norm=colors.LogNorm(vmin=0.001, vmax=zi.max()))
-        ax.contour(xi, yi, zi.reshape(xi.shape), cmap=plt.cm.viridis)
-
-        plt.text(
-            0.5, 1.075, r'# Bins = {:,} ; $r_s$ = {:.3f}'.format(n_cpgs, coef),
-            ha='center', va='center', size=16
-        )
-
-        plt.xlim(-0.05, 1.05)
-        plt.ylim(-0.05, 1.15)
-
-        plt.xticks([i for i in np.arange(0, 1.2, 0.2)], ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)], fontsize=18)
-        plt.yticks([i for i in np.arange(0, 1.2, 0.2)], ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)], fontsize=18)
-
-        plt.title(title, fontsize=24)
-        plt.xlabel(xlab, fontsize=20)
-        plt.ylabel(ylab, fontsize=20)
-        plt.colorbar(im, ax=ax)
-
-        plt.savefig(figname, bbox_inches='tight')
-        plt.close('all')
-
-        # Collapse correlation plots into histograms
-        fig, ax = plt.subplots(figsize=(5,5))
-        plt.tight_layout()
-
-        n1, b1, p1 = plt.hist(xs, bins=50, range=(0,1), density=True,
-                              color='red', label=xlab, alpha=0.5)
-                              #color='#005596', label=xlab, alpha=0.5)
-        n2, b2, p2 = plt.hist(ys, bins=50, range=(0,1), density=True,
-                              color='blue', label=ylab, alpha=0.5)
-                              #color='#3fa294', label=ylab, alpha=0.5)
-
-        ax.legend(ncol=1, loc='upper left', fontsize=20)
-
-        plt.title(title, fontsize=24)
-        plt.xlabel('Methylation Level', fontsize=20)
-        plt.ylabel('# CpGs / Total # CpGs / 0.02', fontsize=20)
-
-        plt.xlim(-0.05, 1.05)
-        plt.ylim(-0.05, 1.05*max(max(n1), max(n2)))
-        plt.xticks(
-            [i for i in np.arange(0, 1.2, 0.2)],
-            ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)],
-            fontsize=18
-        )
-        plt.yticks(
-            [i for i in np.arange(0, 1.05*max(max(n1),max(n2)), 1)],
-            ['{:.1f}'.format(i) for i in np.arange(0, 1.05*max(max(n1),max(n2)), 1)],
-            fontsize=18
-        )
-
-        plt.savefig('hist_'+figname, bbox_inches='tight')
-        plt.close('all')
-
-    return (n_cpgs, coef, p)
+
+    # Correlation figure
+    fig, ax = plt.subplots(figsize=(5,5))
+    plt.tight_layout()
+
+    xi, yi, zi = density.grid_density(xs, ys, nbins, method=density_method)
+    
+    im = ax.pcolormesh(xi, yi, zi.reshape(xi.shape), shading='gouraud', cmap=plt.cm.PuBu_r,
+                      norm=colors.LogNorm(vmin=0.001, vmax=zi.max()))
+    ax.contour(xi, yi, zi.reshape(xi.shape), cmap=plt.cm.viridis)
+
+    plt.text(
+        0.5, 1.075, r'# Bins = {:,} ; $r_s$ = {:.3f}'.format(n_cpgs, coef),
+        ha='center', va='center', size=16
+    )
+
+    plt.xlim(-0.05, 1.05)
+    plt.ylim(-0.05, 1.15)
+
+    plt.xticks([i for i in np.arange(0, 1.2, 0.2)], ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)], fontsize=18)
+    plt.yticks([i for i in np.arange(0, 1.2, 0.2)], ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)], fontsize=18)
+
+    plt.title(title, fontsize=24)
+    plt.xlabel(xlab, fontsize=20)
+    plt.ylabel(ylab, fontsize=20)
+    plt.colorbar(im, ax=ax)
+
+    with atomic_output(figname) as tmp:
+        plt.savefig(tmp, bbox_inches='tight')
+    plt.close('all')
+
+    # Collapse correlation plots into histograms
+    fig, ax = plt.subplots(figsize=(5,5))
+    plt.tight_layout()
+
+    n1, b1, p1 = plt.hist(xs, bins=50, range=(0,1), density=True,
+                          color='red', label=xlab, alpha=0.5)
+                          #color='#005596', label=xlab, alpha=0.5)
+    n2, b2, p2 = plt.hist(ys, bins=50, range=(0,1), density=True,
+                          color='blue', label=ylab, alpha=0.5)
+                          #color='#3fa294', label=ylab, alpha=0.5)
+
+    ax.legend(ncol=1, loc='upper left', fontsize=20)
+
+    plt.title(title, fontsize=24)
+    plt.xlabel('Methylation Level', fontsize=20)
+    plt.ylabel('# CpGs / Total # CpGs / 0.02', fontsize=20)
+
+    plt.xlim(-0.05, 1.05)
+    plt.ylim(-0.05, 1.05*max(max(n1), max(n2)))
+    plt.xticks(
+        [i for i in np.arange(0, 1.2, 0.2)],
+        ['{:.1f}'.format(i) for i in np.arange(0, 1.2, 0.2)],
+        fontsize=18
+    )
+    plt.yticks(
+        [i for i in np.arange(0, 1.05*max(max(n1),max(n2)), 1)],
+        ['{:.1f}'.format(i) for i in np.arange(0, 1.05*max(max(n1),max(n2)), 1)],
+        fontsize=18
+    )
+
+    with atomic_output('hist_'+figname) as tmp:
+        plt.savefig(tmp, bbox_inches='tight')
+    plt.close('all')
+
+def init_worker():
+    """Use non-interactive backend in plotting worker process."""
+    plt.switch_backend('Agg')
+
+def plot_job(job):
+    """Create plots for one pair of samples.
+
+    Inputs: job - tuple of arguments to make_plots()
+
+    Returns: name of correlation figure
+    """
+    make_plots(*job)
+
+    return job[7]
+
+def run_plot_jobs(jobs, n_workers=1):
+    """Create plots for pairs of samples, in a pool of worker processes if
+       n_workers > 1.
+
+    Inputs: jobs      - list of tuples of arguments to make_plots()
+            n_workers - number of worker processes [default: 1]
+
+    Returns: list of figure names that failed
+    """
+    failed = []
+
+    if n_workers == 1:
+        for idx, job in enumerate(jobs):
+            try:
+                plot_job(job)
+                print('[{}/{}] {}'.format(idx+1, len(jobs), job[7]), flush=True)
+            except Exception as e:
+                failed.append(job[7])
+                print('[{}/{}] {}: ERROR: {!r}'.format(idx+1, len(jobs), job[7], e), flush=True)
+
+        return failed
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker) as pool:
+        futures = dict((pool.submit(plot_job, job), job[7]) for job in jobs)
+        for idx, future in enumerate(as_completed(futures)):
+            try:
+                future.result()
+                print('[{}/{}] {}'.format(idx+1, len(jobs), futures[future]), flush=True)
+            except Exception as e:
+                failed.append(futures[future])
+                print('[{}/{}] {}: ERROR: {!r}'.format(idx+1, len(jobs), futures[future], e), flush=True)
+
+    return failed
+
+def load_sample(prefix, window=None):
+    """Load window averaged beta values of one sample.
+
+    Inputs: prefix - path and name of sample
+            window - window size to read from the sample's pyramid (see
+                     pyramid.py) [default: read 100kb bedtools map file]
+
+    Returns: DataFrame with chr, start, end, beta_avg, and covg_avg columns
+    """
+    if window is None:
+        return bed_reader.read_bed(prefix + WINDOW_TAG, names=['chr', 'start', 'end', 'beta_avg', 'covg_avg'])
+
+    df = pyramid.read_windows(prefix + PYRAMID_TAG, window)
+
+    return df.rename(columns={'beta': 'beta_avg', 'covg': 'covg_avg'})
 
 def main():
     """Do the bulk of the correlations analysis."""
-    col_names = ['chr', 'start', 'end', 'beta_avg', 'covg_avg']
+    parser = argparse.ArgumentParser(
+        description = 'correlation_analysis.py finds correlations between samples and plots them'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type = int,
+        default = 1,
+        help = 'Number of plots to create in parallel [default: 1]'
+    )
+
+    parser.add_argument(
+        '-b', '--bootstrap',
+        type = int,
+        default = 0,
+        help = 'Number of block bootstrap replicates (chromosomes resampled) for 95%% ' +
+               'confidence intervals on Spearman r, 0 to skip [default: 0]'
+    )
+
+    parser.add_argument(
+        '-w', '--window',
+        type = int,
+        default = None,
+        help = 'Window size to read from window pyramids instead of the 100kb ' +
+               'bedtools map files [default: use 100kb files]'
+    )
+
+    args = parser.parse_args()
 
     dirloc = '../../subsampling/'
-    filtag = '.subsampled.cg.sorted.mergecg.100kb_meth_avg.bed.gz'
 
     print('Loading data')
-    df_01 = pd.read_csv(dirloc + 'FtubeAkapaBC' + filtag, sep='\t', names=col_names, na_values='.')
-    df_02 = pd.read_csv(dirloc + 'FtubeAkapaBCrep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_03 = pd.read_csv(dirloc + 'FtubeAneb10ngRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_04 = pd.read_csv(dirloc + 'FtubeAneb10ng' + filtag, sep='\t', names=col_names, na_values='.')
-    df_05 = pd.read_csv(dirloc + 'FtubeAnebRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_06 = pd.read_csv(dirloc + 'FtubeAneb' + filtag, sep='\t', names=col_names, na_values='.')
-    df_07 = pd.read_csv(dirloc + 'FtubeApbat' + filtag, sep='\t', names=col_names, na_values='.')
-    df_08 = pd.read_csv(dirloc + 'FtubeAswift10ngRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_09 = pd.read_csv(dirloc + 'FtubeAswift10ng' + filtag, sep='\t', names=col_names, na_values='.')
-    df_10 = pd.read_csv(dirloc + 'FtubeAswiftRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_11 = pd.read_csv(dirloc + 'FtubeAswift' + filtag, sep='\t', names=col_names, na_values='.')
-    df_12 = pd.read_csv(dirloc + 'FtubeBkapaBC' + filtag, sep='\t', names=col_names, na_values='.')
-    df_13 = pd.read_csv(dirloc + 'FtubeBkapaBCrep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_14 = pd.read_csv(dirloc + 'FtubeBneb10ngRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_15 = pd.read_csv(dirloc + 'FtubeBneb10ng' + filtag, sep='\t', names=col_names, na_values='.')
-    df_16 = pd.read_csv(dirloc + 'FtubeBnebRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_17 = pd.read_csv(dirloc + 'FtubeBneb' + filtag, sep='\t', names=col_names, na_values='.')
-    df_18 = pd.read_csv(dirloc + 'FtubeBpbat' + filtag, sep='\t', names=col_names, na_values='.')
-    df_19 = pd.read_csv(dirloc + 'FtubeBswift10ngRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_20 = pd.read_csv(dirloc + 'FtubeBswift10ng' + filtag, sep='\t', names=col_names, na_values='.')
-    df_21 = pd.read_csv(dirloc + 'FtubeBswiftRep2' + filtag, sep='\t', names=col_names, na_values='.')
-    df_22 = pd.read_csv(dirloc + 'FtubeBswift' + filtag, sep='\t', names=col_names, na_values='.')
+    df_01 = load_sample(dirloc + 'FtubeAkapaBC', args.window)
+    df_02 = load_sample(dirloc + 'FtubeAkapaBCrep2', args.window)
+    df_03 = load_sample(dirloc + 'FtubeAneb10ngRep2', args.window)
+    df_04 = load_sample(dirloc + 'FtubeAneb10ng', args.window)
+    df_05 = load_sample(dirloc + 'FtubeAnebRep2', args.window)
+    df_06 = load_sample(dirloc + 'FtubeAneb', args.window)
+    df_07 = load_sample(dirloc + 'FtubeApbat', args.window)
+    df_08 = load_sample(dirloc + 'FtubeAswift10ngRep2', args.window)
+    df_09 = load_sample(dirloc + 'FtubeAswift10ng', args.window)
+    df_10 = load_sample(dirloc + 'FtubeAswiftRep2', args.window)
+    df_11 = load_sample(dirloc + 'FtubeAswift', args.window)
+    df_12 = load_sample(dirloc + 'FtubeBkapaBC', args.window)
+    df_13 = load_sample(dirloc + 'FtubeBkapaBCrep2', args.window)
+    df_14 = load_sample(dirloc + 'FtubeBneb10ngRep2', args.window)
+    df_15 = load_sample(dirloc + 'FtubeBneb10ng', args.window)
+    df_16 = load_sample(dirloc + 'FtubeBnebRep2', args.window)
+    df_17 = load_sample(dirloc + 'FtubeBneb', args.window)
+    df_18 = load_sample(dirloc + 'FtubeBpbat', args.window)
+    df_19 = load_sample(dirloc + 'FtubeBswift10ngRep2', args.window)
+    df_20 = load_sample(dirloc + 'FtubeBswift10ng', args.window)
+    df_21 = load_sample(dirloc + 'FtubeBswiftRep2', args.window)
+    df_22 = load_sample(dirloc + 'FtubeBswift', args.window)
 
     data_sets = [
         {'data': df_01, 'sample': 'FtubeAkapaBC'       , 'tag': 'ak1_hi', 'title': 'Kapa'       , 'axis_label': 'Replicate 1'},
@@ -165,37 +248,56 @@ def main():
         {'data': df_19, 'sample': 'FtubeBswift10ngRep2', 'tag': 'bs2_lo', 'title': 'Low Swift'  , 'axis_label': 'Replicate 2'}
     ]
 
-    with open('correlation_values.tsv', 'w') as f:
-        for d1 in range(len(data_sets)):
-            for d2 in range(d1, len(data_sets)):
-                n_cpgs = 0
-                coef = 0
-                p = 0
-                print('Processing {} {}'.format(data_sets[d1]['tag'], data_sets[d2]['tag']))
-                if 'FtubeA' in data_sets[d1]['sample'] and 'FtubeA' in data_sets[d2]['sample']:
-                    n_cpgs, coef, p = find_correlation_and_plot(
-                        data_sets[d1]['data']['beta_avg'],
-                        data_sets[d2]['data']['beta_avg'],
-                        data_sets[d1]['title'] + ' Sample A Beta Values',
-                        data_sets[d1]['axis_label'],
-                        data_sets[d2]['axis_label'],
-                        data_sets[d1]['tag'] + '_' + data_sets[d2]['tag'] + '.png',
-                        print_message=False,
-                        create_plots=True
-                    )
-                else:
-                    n_cpgs, coef, p = find_correlation_and_plot(
-                        data_sets[d1]['data']['beta_avg'],
-                        data_sets[d2]['data']['beta_avg'],
-                        data_sets[d1]['title'],
-                        data_sets[d1]['axis_label'],
-                        data_sets[d2]['axis_label'],
-                        data_sets[d1]['tag'] + '_' + data_sets[d2]['tag'] + '.png',
-                        print_message=False,
-                        create_plots=False
-                    )
-
-                f.write('{}\t{}\t{}\t{}\t{}\n'.format(data_sets[d1]['tag'], data_sets[d2]['tag'], n_cpgs, coef, p))
+    # Align all samples into one window x sample matrix and find every
+    # correlation at once
+    aligned = cpg_align.align([d['data'] for d in data_sets], values=['beta_avg'])
+    beta = aligned['beta_avg'].astype(np.float64)
+
+    n_cpgs, coef, p = correlation.spearman_matrix(beta)
+    n_cpgs, pear, pear_p = correlation.pearson_matrix(beta)
+    lin = correlation.lin_matrix(beta)
+
+    if args.bootstrap > 0:
+        print('Bootstrapping {} replicates'.format(args.bootstrap))
+        ci_low, ci_high = correlation.bootstrap_spearman(beta, aligned['chr'].codes, args.bootstrap)
+
+    with atomic_output('correlation_values.tsv') as tmp:
+        with open(tmp, 'w') as f:
+            for d1 in range(len(data_sets)):
+                for d2 in range(d1, len(data_sets)):
+                    vals = [
+                        data_sets[d1]['tag'], data_sets[d2]['tag'], int(n_cpgs[d1, d2]),
+                        coef[d1, d2], p[d1, d2], pear[d1, d2], pear_p[d1, d2], lin[d1, d2]
+                    ]
+                    if args.bootstrap > 0:
+                        vals += [ci_low[d1, d2], ci_high[d1, d2]]
+                    f.write('\t'.join(str(v) for v in vals) + '\n')
+
+    # Only pairs of Sample A libraries are plotted, workers only receive the
+    # values they need
+    jobs = []
+    for d1 in range(len(data_sets)):
+        for d2 in range(d1, len(data_sets)):
+            if 'FtubeA' in data_sets[d1]['sample'] and 'FtubeA' in data_sets[d2]['sample']:
+                keep = ~np.isnan(beta[:, d1]) & ~np.isnan(beta[:, d2])
+                jobs.append((
+                    beta[keep, d1].astype(np.float32),
+                    beta[keep, d2].astype(np.float32),
+                    int(n_cpgs[d1, d2]),
+                    coef[d1, d2],
+                    data_sets[d1]['title'] + ' Sample A Beta Values',
+                    data_sets[d1]['axis_label'],
+                    data_sets[d2]['axis_label'],
+                    data_sets[d1]['tag'] + '_' + data_sets[d2]['tag'] + '.png'
+                ))
+
+    print('Plotting {} pairs'.format(len(jobs)))
+    failed = run_plot_jobs(jobs, args.jobs)
+    if len(failed) > 0:
+        print('Failed plots: ' + ', '.join(failed))
+        return 1
+
+    return 0
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
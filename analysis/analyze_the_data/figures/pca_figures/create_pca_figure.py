@@ -5,7 +5,15 @@ import numpy as np
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from scipy.special import logit
-from functools import reduce
+import argparse
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'common'))
+import bed_reader
+import cpg_align
+import merge_join
+import stream_pca
 
 KIT = {
     'FtubeAkapaBC'       : 'Kapa', 'FtubeAkapaBCrep2'   : 'Kapa',
@@ -56,36 +64,86 @@ def beta_to_m(betas, covgs, k):
     """Transform beta values into m values.
 
     Inputs -
-        betas - pd.Series of beta values
-        covgs - pd.Series of covg values
+        betas - array-like of beta values (any shape)
+        covgs - array-like of covg values (same shape as betas)
         k     - number of pseudoreads for smoothing
     Returns
-        pd.Series of m values
+        np.array of m values (NaN where beta or covg is missing)
     """
-    b = list(betas)
-    c = list(covgs)
+    c = np.asarray(covgs, dtype=np.float64)
+    m = c * np.asarray(betas, dtype=np.float64)
+    u = c - m
+
+    return logit((m+k) / ((m+k) + (u+k)))
 
-    s = []
-    for i in range(len(c)):
-        m = (c[i] * b[i])
-        u = (c[i] - m)
-        s.append((m+k) / ((m+k) + (u+k)))
-    out = logit(s)
+def build_matrix(frames, k=0.1):
+    """Build window x sample matrix of m values from window averaged files.
 
-    return pd.Series(out)
+    Inputs -
+        frames - list of DataFrames with chr, start, end, beta, and covg
+                 columns (one per sample)
+        k      - number of pseudoreads for smoothing [default: 0.1]
+    Returns -
+        np.array (n windows x n samples) of m values for windows with a value
+        in every sample
+    """
+    # Windows found in every sample, aligned in one pass on integer coordinates
+    aligned = cpg_align.align(frames, values=['beta', 'covg'], how='inner')
 
-def make_plot(data, var, keys, cols, title, xlab, ylab, figname):
+    # Transform beta values into m-values uses logit transform
+    # Makes beta distribution of values into a more gaussian distribution
+    m_vals = beta_to_m(aligned['beta'], aligned['covg'], k)
+
+    return m_vals[~np.isnan(m_vals).any(axis=1)]
+
+def cpg_chunks(fnames, chroms=None, k=0.1, min_covg=1):
+    """Read CpG x sample matrices of m values in one pass over sorted files.
+
+    Inputs -
+        fnames   - list of coordinate-sorted mergecg BED files (one per sample)
+        chroms   - chromosomes to read [default: all]
+        k        - number of pseudoreads for smoothing [default: 0.1]
+        min_covg - minimum coverage of CpGs used [default: 1]
+    Yields -
+        np.array (n CpGs x n samples) of m values for a block of CpGs with a
+        value in every sample
+    """
+    current = None
+    n_cpgs = 0
+    for block in merge_join.merge_join(fnames, how='inner', min_covg=min_covg):
+        if chroms is not None and block['chr'] not in chroms:
+            continue
+
+        if block['chr'] != current:
+            if current is not None:
+                print('{}: {:,} CpGs'.format(current, n_cpgs), flush=True)
+            current = block['chr']
+            n_cpgs = 0
+
+        m_vals = beta_to_m(block['beta'], block['covg'], k)
+        m_vals = m_vals[~np.isnan(m_vals).any(axis=1)]
+        n_cpgs += len(m_vals)
+
+        yield m_vals
+
+    if current is not None:
+        print('{}: {:,} CpGs'.format(current, n_cpgs), flush=True)
+
+def make_plot(data, var, keys, cols, title, xlab, ylab, figname, autoscale=False):
     """Create plot for principal components of PCA.
 
     Inputs -
-        data    - DataFrame with columns pc1, pc2, var
-        var     - column name of variable to keep
-        keys    - keys from var column that correspond to colors in cols list
-        cols    - colors to match with keys list
-        title   - title of figure
-        xlab    - x-axis label
-        ylab    - y-axis label
-        figname - name of output file
+        data      - DataFrame with columns pc1, pc2, var
+        var       - column name of variable to keep
+        keys      - keys from var column that correspond to colors in cols
+                    list
+        cols      - colors to match with keys list
+        title     - title of figure
+        xlab      - x-axis label
+        ylab      - y-axis label
+        figname   - name of output file
+        autoscale - whether to fit axes to the data instead of the fixed
+                    limits used for 100kb windows [default: False]
     Returns -
         Nothing, plot is saved to disk
     """
@@ -106,11 +164,19 @@ def make_plot(data, var, keys, cols, title, xlab, ylab, figname):
                    c=col, s=25)
 
     ax.legend(keys, ncol=1, loc='upper right', fontsize=13)
-    plt.xlim(-250, 250)
-    plt.ylim(-175, 175)
+    if autoscale:
+        lim = 1.15 * np.abs(data[['pc1', 'pc2']].to_numpy()).max(axis=0)
+        plt.xlim(-lim[0], lim[0])
+        plt.ylim(-lim[1], lim[1])
+
+        plt.xticks(fontsize=14)
+        plt.yticks(fontsize=14)
+    else:
+        plt.xlim(-250, 250)
+        plt.ylim(-175, 175)
 
-    plt.xticks([i for i in np.arange(-200, 300, 100)], ['{:.0f}'.format(i) for i in np.arange(-200, 300, 100)], fontsize=14)
-    plt.yticks([i for i in np.arange(-150, 200,  50)], ['{:.0f}'.format(i) for i in np.arange(-150, 200,  50)], fontsize=14)
+        plt.xticks([i for i in np.arange(-200, 300, 100)], ['{:.0f}'.format(i) for i in np.arange(-200, 300, 100)], fontsize=14)
+        plt.yticks([i for i in np.arange(-150, 200,  50)], ['{:.0f}'.format(i) for i in np.arange(-150, 200,  50)], fontsize=14)
 
     plt.title(title, fontsize=24)
     plt.xlabel(xlab, fontsize=20)
@@ -119,15 +185,17 @@ def make_plot(data, var, keys, cols, title, xlab, ylab, figname):
     plt.savefig(figname, bbox_inches='tight')
     plt.close('all')
 
-def make_combined_plot(data, title, xlab, ylab, figname):
+def make_combined_plot(data, title, xlab, ylab, figname, autoscale=False):
     """Create plot for principal components of PCA with all variables shown.
 
     Inputs -
-        data    - DataFrame with columns pc1, pc2, kit, sample, and replicate
-        title   - title of figure
-        xlab    - x-axis label
-        ylab    - y-axis label
-        figname - name of output file
+        data      - DataFrame with columns pc1, pc2, kit, sample, and replicate
+        title     - title of figure
+        xlab      - x-axis label
+        ylab      - y-axis label
+        figname   - name of output file
+        autoscale - whether to fit axes to the data instead of the fixed
+                    limits used for 100kb windows [default: False]
     Returns -
         Nothing, plot is saved to disk
     """
@@ -153,14 +221,14 @@ def make_combined_plot(data, title, xlab, ylab, figname):
     plt.tight_layout()
 
     # Create legend
-    plt.plot(-300, 300, 'o', color='black', markersize=8, label='Samp. A')
-    plt.plot(-300, 300, 's', color='black', markersize=8, label='Samp. B')
-    plt.plot(-300, 300, 'D', color='black', fillstyle='none', markersize=8, label='Rep. 1')
-    plt.plot(-300, 300, 'D', color='black', markersize=8, label='Rep. 2')
-    plt.plot(-300, 300, 'D', color='#D81B60', markersize=8, label='Kapa')
-    plt.plot(-300, 300, 'D', color='#1E88E5', markersize=8, label='NEB')
-    plt.plot(-300, 300, 'D', color='#A0522D', markersize=8, label='PBAT')
-    plt.plot(-300, 300, 'D', color='#004D40', markersize=8, label='Swift')
+    plt.plot([], [], 'o', color='black', markersize=8, label='Samp. A')
+    plt.plot([], [], 's', color='black', markersize=8, label='Samp. B')
+    plt.plot([], [], 'D', color='black', fillstyle='none', markersize=8, label='Rep. 1')
+    plt.plot([], [], 'D', color='black', markersize=8, label='Rep. 2')
+    plt.plot([], [], 'D', color='#D81B60', markersize=8, label='Kapa')
+    plt.plot([], [], 'D', color='#1E88E5', markersize=8, label='NEB')
+    plt.plot([], [], 'D', color='#A0522D', markersize=8, label='PBAT')
+    plt.plot([], [], 'D', color='#004D40', markersize=8, label='Swift')
 
     # Add scatter plot to figure for each set of data in keys
     for key, col in zip(keys.values(), cols.values()):
@@ -173,11 +241,19 @@ def make_combined_plot(data, title, xlab, ylab, figname):
 
     ax.legend(ncol=4, bbox_to_anchor=(0.5, 0.98), frameon=False,
               loc='lower center', fontsize=14)
-    plt.xlim(-250, 250)
-    plt.ylim(-175, 175)
+    if autoscale:
+        lim = 1.15 * np.abs(data[['pc1', 'pc2']].to_numpy()).max(axis=0)
+        plt.xlim(-lim[0], lim[0])
+        plt.ylim(-lim[1], lim[1])
 
-    plt.xticks([i for i in np.arange(-200, 300, 100)], ['{:.0f}'.format(i) for i in np.arange(-200, 300, 100)], fontsize=14)
-    plt.yticks([i for i in np.arange(-150, 200,  50)], ['{:.0f}'.format(i) for i in np.arange(-150, 200,  50)], fontsize=14)
+        plt.xticks(fontsize=14)
+        plt.yticks(fontsize=14)
+    else:
+        plt.xlim(-250, 250)
+        plt.ylim(-175, 175)
+
+        plt.xticks([i for i in np.arange(-200, 300, 100)], ['{:.0f}'.format(i) for i in np.arange(-200, 300, 100)], fontsize=14)
+        plt.yticks([i for i in np.arange(-150, 200,  50)], ['{:.0f}'.format(i) for i in np.arange(-150, 200,  50)], fontsize=14)
 
     plt.title(title, pad=50, fontsize=24)
     plt.xlabel(xlab, fontsize=20)
@@ -188,8 +264,35 @@ def make_combined_plot(data, title, xlab, ylab, figname):
 
 def main():
     """Do the bulk of the PCA generation."""
+    parser = argparse.ArgumentParser(
+        description = 'create_pca_figure.py runs a PCA of samples and plots the first two components'
+    )
+
+    parser.add_argument(
+        '--cpg',
+        action = 'store_true',
+        help = 'Use single CpGs (mergecg files, read in one pass) ' +
+               'instead of 100kb windows, figures are named cpg_pca_*.pdf'
+    )
+
+    parser.add_argument(
+        '-c', '--chroms',
+        default = None,
+        help = 'Comma separated chromosomes to use with --cpg [default: all in files]'
+    )
+
+    parser.add_argument(
+        '-m', '--min-covg',
+        type = int,
+        default = 1,
+        help = 'Minimum coverage of CpGs used with --cpg [default: 1]'
+    )
+
+    args = parser.parse_args()
+
     dirloc = '../../subsampling/'
     filtag = '.subsampled.cg.sorted.mergecg.100kb_meth_avg.bed.gz'
+    cpgtag = '.subsampled.cg.sorted.mergecg.bed.gz'
 
     samps = [
         'FtubeAkapaBC'       , 'FtubeAkapaBCrep2'   ,
@@ -205,33 +308,39 @@ def main():
         'FtubeBneb10ng'      , 'FtubeBneb10ngRep2'  ,
         'FtubeBswift10ng'    , 'FtubeBswift10ngRep2'
     ]
-    dfs = []
-    for samp in samps:
-        cols = ['chr', 'start', 'end', 'beta', 'covg']
-
-        df = pd.read_csv(dirloc+samp+filtag, sep='\t', names=cols, na_values='.')
-
-        # Transform beta values into m-values uses logit transform
-        # Makes beta distribution of values into a more gaussian distribution
-        df[samp] = beta_to_m(df['beta'], df['covg'], 0.1)
-        dfs.append(df.drop(['beta', 'covg'], axis=1))
+    if args.cpg:
+        fnames = [dirloc+samp+cpgtag for samp in samps]
+        chroms = args.chroms.split(',') if args.chroms is not None else None
+
+        # Standardize values and create PCA one block of CpGs at a time
+        principals, ratio, n_cpgs = stream_pca.gram_pca(
+            cpg_chunks(fnames, chroms, 0.1, args.min_covg), n_components=2
+        )
+        print('PCA of {:,} CpGs'.format(n_cpgs))
+        print(ratio)
+        prefix = 'cpg_'
+    else:
+        dfs = []
+        for samp in samps:
+            dfs.append(bed_reader.read_bed(
+                dirloc+samp+filtag, names=bed_reader.WINDOW, dtypes=bed_reader.WINDOW_DTYPES
+            ))
+
+        df = pd.DataFrame(build_matrix(dfs, 0.1).T, index=samps)
+
+        # Standardize values
+        x = StandardScaler().fit_transform(df)
+
+        # Create PCA
+        pca = PCA(n_components=2)
+        principals = pca.fit_transform(x)
+        print(pca.explained_variance_ratio_)
+        prefix = ''
+
+    kits = [KIT[i] for i in samps]
+    sams = [SAM[i] for i in samps]
+    reps = [REP[i] for i in samps]
 
-    df_na = reduce(lambda x, y: pd.merge(x, y, on=['chr', 'start', 'end']), dfs)
-    df_al = df_na.dropna(axis=0, how='any')
-
-    df = df_al.drop(['chr', 'start', 'end'], axis=1).transpose()
-    kits = [KIT[i] for i in list(df.index)]
-    sams = [SAM[i] for i in list(df.index)]
-    reps = [REP[i] for i in list(df.index)]
-
-    # Standardize values
-    x = StandardScaler().fit_transform(df)
-    std = pd.DataFrame(data=x, columns=list(df.columns))
-
-    # Create PCA
-    pca = PCA(n_components=2)
-    principals = pca.fit_transform(x)
-    print(pca.explained_variance_ratio_)
     pcs = pd.DataFrame(data=principals, columns=['pc1', 'pc2'])
     pcs['kit'] = kits
     pcs['sample'] = sams
@@ -246,7 +355,8 @@ def main():
         '2-component PCA: Protocol',
         'Principal Component 1',
         'Principal Component 2',
-        'pca_protocol.pdf'
+        prefix + 'pca_protocol.pdf',
+        autoscale=args.cpg
     )
 
     make_plot(
@@ -257,7 +367,8 @@ def main():
         '2-component PCA: Sample',
         'Principal Component 1',
         'Principal Component 2',
-        'pca_sample.pdf'
+        prefix + 'pca_sample.pdf',
+        autoscale=args.cpg
     )
 
     make_plot(
@@ -268,7 +379,8 @@ def main():
         '2-component PCA: Tech. Rep.',
         'Principal Component 1',
         'Principal Component 2',
-        'pca_replicate.pdf'
+        prefix + 'pca_replicate.pdf',
+        autoscale=args.cpg
     )
 
     make_combined_plot(
@@ -276,8 +388,11 @@ def main():
         '2-component PCA',
         'Principal Component 1',
         'Principal Component 2',
-        'pca_combined.pdf'
+        prefix + 'pca_combined.pdf',
+        autoscale=args.cpg
     )
 
+    return 0
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,14 +1,40 @@
 """Main module for making plots regarding statistical measures of kit
    comparison data.
 """
+from matplotlib import pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import numpy as np
+import argparse
+import hashlib
+import inspect
 import json
+import time
+import sys
+import os
 
+import constants
 import tex_tables
 import plotting
 import utils
 
+def uses(*keys):
+    """Declare the metrics (keys of each sample's data) a figure group uses.
+
+    Inputs: keys - metric keys read by the decorated figure group
+
+    Returns: decorator that stores keys as the group's metric_keys
+    """
+    def declare(group):
+        group.metric_keys = keys
+        return group
+
+    return declare
+
+@uses(
+    'r1_read_base_20', 'r1_read_base_30', 'r1_low_base_qual', 'r1_med_base_qual', 'r1_hi_base_qual',
+    'r2_read_base_20', 'r2_read_base_30', 'r2_low_base_qual', 'r2_med_base_qual', 'r2_hi_base_qual'
+)
 def raw_read_base_qual_plots(data, outdir):
     """Make the raw read base quality plots."""
     meta = {
@@ -107,8 +133,12 @@ def raw_read_base_qual_plots(data, outdir):
             vals['figname']
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
 
+@uses(
+    'ExonicCpGs_percent_covered', 'RepeatCpGs_percent_covered', 'GenicCpGs_percent_covered',
+    'CGICpGs_percent_covered', 'TotalCpGs_percent_covered'
+)
 def cpg_region_plots(data, outdir):
     """Make CpG region plots."""
     meta = {
@@ -217,8 +247,9 @@ def cpg_region_plots(data, outdir):
             vals['figname']
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
 
+@uses('r1_trimmed_bp', 'r1_quality_bp', 'r1_adapter_re', 'r2_trimmed_bp', 'r2_quality_bp', 'r2_adapter_re')
 def trimmed_stats_plots(data, outdir):
     """Make plots for post-trimming results."""
     meta = {
@@ -285,8 +316,9 @@ def trimmed_stats_plots(data, outdir):
             vals['figname']
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
 
+@uses('aligned_reads')
 def read_alignment_plot(data, outdir):
     """Make plot with percentage of optimally/sub-optimally/not aligned reads."""
     A, B = utils.retrieve_aligned_reads(data, True)
@@ -343,6 +375,15 @@ def read_alignment_plot(data, outdir):
         outdir+'aligned_reads.pdf'
     )
 
+    return [outdir + name for name in [
+        'read_mapping_sample_A.pdf',
+        'read_mapping_sample_B.pdf',
+        'mapq_dist_sample_A.pdf',
+        'mapq_dist_sample_B.pdf',
+        'aligned_reads.pdf'
+    ]]
+
+@uses('dup_report')
 def duplicate_rate_plots(data, outdir):
     """Make plots with duplicate read rate percentages."""
     meta = {
@@ -379,8 +420,9 @@ def duplicate_rate_plots(data, outdir):
             vals['figname']
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
 
+@uses('read_rtn', 'base_rtn')
 def cpn_retention_plots(data, outdir):
     """Make plots with CpN retention rate percentages."""
     meta = {
@@ -471,8 +513,12 @@ def cpn_retention_plots(data, outdir):
             vals['figname']
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
 
+@uses(
+    'cah_methylation_percent', 'cag_methylation_percent', 'cth_methylation_percent',
+    'ctg_methylation_percent'
+)
 def create_trinucleotide_methylation_plots(data, outdir):
     """Make plots with CpWpN retention rate percentages."""
     meta = {
@@ -523,8 +569,9 @@ def create_trinucleotide_methylation_plots(data, outdir):
             vals['figname']
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
 
+@uses('cpg_rtn_readpos', 'cph_rtn_readpos')
 def mbias_plots(data, outdir):
     """Make M-bias plots."""
     A, B = utils.retrieve_data_points_from_dict_in_dict(
@@ -631,8 +678,18 @@ def mbias_plots(data, outdir):
         outdir+'r2_cph_rtn_readpos_sample_B.pdf'
     )
 
-    return 0
+    return [outdir + name for name in [
+        'r1_cpg_rtn_readpos_sample_A.pdf',
+        'r1_cpg_rtn_readpos_sample_B.pdf',
+        'r2_cpg_rtn_readpos_sample_A.pdf',
+        'r2_cpg_rtn_readpos_sample_B.pdf',
+        'r1_cph_rtn_readpos_sample_A.pdf',
+        'r1_cph_rtn_readpos_sample_B.pdf',
+        'r2_cph_rtn_readpos_sample_A.pdf',
+        'r2_cph_rtn_readpos_sample_B.pdf'
+    ]]
 
+@uses('covdist_all_base', 'covdist_q40_base', 'covdist_all_cpg', 'covdist_q40_cpg')
 def create_covdist_plots(data, outdir):
     """Make coverage vs. depth plots."""
     A, B = utils.retrieve_data_points_from_dict(data, 'covdist_all_base', False)
@@ -731,8 +788,18 @@ def create_covdist_plots(data, outdir):
         outdir+'covdist_q40_cpg_sample_B.pdf'
     )
 
-    return 0
+    return [outdir + name for name in [
+        'covdist_all_base_sample_A.pdf',
+        'covdist_all_base_sample_B.pdf',
+        'covdist_q40_base_sample_A.pdf',
+        'covdist_q40_base_sample_B.pdf',
+        'covdist_all_cpg_sample_A.pdf',
+        'covdist_all_cpg_sample_B.pdf',
+        'covdist_q40_cpg_sample_A.pdf',
+        'covdist_q40_cpg_sample_B.pdf'
+    ]]
 
+@uses('isize_data')
 def create_insert_size_plots(data, outdir):
     """Create plot of insert sizes."""
     A, B = utils.retrieve_data_points_from_dict_in_dict(
@@ -763,8 +830,12 @@ def create_insert_size_plots(data, outdir):
         every=50
     )
 
-    return 0
+    return [outdir + name for name in [
+        'insert_size_sample_A.pdf',
+        'insert_size_sample_B.pdf'
+    ]]
 
+@uses('complexity_curve')
 def create_complexity_curve_plots(data, outdir):
     """Create plot of complexity curves."""
     A, B = utils.retrieve_data_points_from_dict(data, 'complexity_curve', False)
@@ -793,8 +864,15 @@ def create_complexity_curve_plots(data, outdir):
         every=50
     )
 
-    return 0
+    return [outdir + name for name in [
+        'complexity_sample_A.pdf',
+        'complexity_sample_B.pdf'
+    ]]
 
+@uses(
+    'exon_q40_avg_depth', 'gene_q40_avg_depth', 'rmsk_q40_avg_depth', 'cgis_q40_avg_depth',
+    'total_q40_avg_depth', 'uniformity'
+)
 def create_tex_table(data, outdir):
     """Create table with CpG regional coverages."""
     avg_depth = {
@@ -812,8 +890,14 @@ def create_tex_table(data, outdir):
     }
     tex_tables.table_creator(outdir+'kit_comp_tables.tex', avg_depth, uniformity)
 
-    return 0
+    return [outdir + name for name in [
+        'kit_comp_tables.tex'
+    ]]
 
+@uses(
+    'mappy_cpgs_obs_exp_ratio', 'mappy_cpis_obs_exp_ratio', 'mappy_rmsk_obs_exp_ratio',
+    'mappy_exon_obs_exp_ratio', 'mappy_gene_obs_exp_ratio', 'mappy_intr_obs_exp_ratio'
+)
 def create_obs_exp_ratio_plots(data, outdir):
     """Make plots to show the observed/expected ratio."""
     meta = {
@@ -881,11 +965,193 @@ def create_obs_exp_ratio_plots(data, outdir):
             add_line=True
         )
 
-    return 0
+    return [vals['figname'] for vals in meta.values()]
+
+# Groups of figures made from the raw and subsampled BAM metrics
+RAW_GROUPS = [
+    raw_read_base_qual_plots,
+    cpg_region_plots,
+    trimmed_stats_plots,
+    read_alignment_plot,
+    duplicate_rate_plots,
+    cpn_retention_plots,
+    mbias_plots,
+    create_covdist_plots,
+    create_insert_size_plots,
+    create_complexity_curve_plots,
+    create_tex_table,
+    create_obs_exp_ratio_plots,
+    create_trinucleotide_methylation_plots
+]
+SUB_GROUPS = [
+    cpg_region_plots,
+    cpn_retention_plots,
+    mbias_plots,
+    create_covdist_plots,
+    create_tex_table,
+    create_trinucleotide_methylation_plots
+]
+
+# Loaded metrics of each data set ('raw' and 'sub'), set once per process by
+# init_worker() and only read by figure groups
+DATA = {}
+
+def init_worker(data):
+    """Use non-interactive backend and keep loaded metrics in worker process."""
+    plt.switch_backend('Agg')
+    DATA.update(data)
+
+def group_fingerprint(group, data):
+    """Fingerprint the metrics and code a figure group is made from.
+
+    The fingerprint covers the values of the group's metric_keys in every
+    sample, the source of the group, and the modules it plots with, so it
+    changes whenever the group's figures would change.
+
+    Inputs: group - figure group function declared with uses()
+            data  - loaded metrics of data set
+
+    Returns: hex string
+    """
+    values = dict((samp, dict((key, dic.get(key)) for key in group.metric_keys))
+                  for samp, dic in data.items())
+
+    sha = hashlib.sha1()
+    sha.update(json.dumps(values, sort_keys=True).encode())
+    sha.update(inspect.getsource(group).encode())
+    for module in [constants, plotting, tex_tables, utils]:
+        sha.update(Path(module.__file__).read_bytes())
+
+    return sha.hexdigest()
+
+def stamp_name(group, outdir):
+    """Find name of file holding fingerprint and outputs of figure group's last build."""
+    return outdir + group.__name__ + '.fingerprint'
+
+def up_to_date(group, data, outdir):
+    """Check whether figure group was last built from the same metrics and code.
+
+    Inputs: group  - figure group function declared with uses()
+            data   - loaded metrics of data set
+            outdir - directory figures are written to
+
+    Returns: True if the stamp of the group's last build matches its current
+             fingerprint and every file it wrote still exists
+    """
+    stamp = Path(stamp_name(group, outdir))
+    if not stamp.exists():
+        return False
 
+    try:
+        with open(stamp, 'r') as f:
+            last = json.load(f)
+    except ValueError:
+        return False
+
+    if last.get('fingerprint') != group_fingerprint(group, data):
+        return False
+
+    return all(Path(fname).exists() for fname in last.get('outputs', []))
+
+def figure_job(group, tag, outdir):
+    """Create one group of figures and record its fingerprint and outputs.
+
+    Inputs: group  - figure group function, called as group(data, outdir) and
+                     returning the list of files it wrote
+            tag    - data set to make figures from ('raw' or 'sub')
+            outdir - directory to write figures to
+
+    Returns: seconds taken
+    """
+    t1 = time.time()
+
+    # A group interrupted while rewriting its files must not look up to date
+    stamp = Path(stamp_name(group, outdir))
+    if stamp.exists():
+        stamp.unlink()
+
+    outputs = group(DATA[tag], outdir)
+    fprint = group_fingerprint(group, DATA[tag])
+
+    # Only written once all files of the group are, and atomically (as in
+    # common/atomic.py) so a failed write leaves no partial stamp behind
+    tmp = stamp.with_name('{}.{}.tmp'.format(stamp.name, os.getpid()))
+    try:
+        with open(tmp, 'w') as f:
+            json.dump({'fingerprint': fprint, 'outputs': outputs}, f, indent=4)
+        os.replace(tmp, stamp)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+    return time.time() - t1
+
+def run_figure_jobs(jobs, data, n_workers=1):
+    """Create groups of figures, in a pool of worker processes if n_workers > 1.
+
+    The groups are independent, so with enough workers the total time is close
+    to that of the slowest group.
+
+    Inputs: jobs      - list of (group, tag, outdir) tuples for figure_job()
+            data      - dictionary of loaded metrics of each data set tag
+            n_workers - number of worker processes [default: 1]
+
+    Returns: list of names of groups that failed
+    """
+    failed = []
+    start = time.time()
+
+    def report(idx, job, secs=None, error=None):
+        """Print timing (or error) of finished group."""
+        name = job[2] + job[0].__name__
+        if error is None:
+            print('[{}/{}] {}: {:.1f} seconds'.format(idx+1, len(jobs), name, secs), flush=True)
+        else:
+            failed.append(name)
+            print('[{}/{}] {}: ERROR: {!r}'.format(idx+1, len(jobs), name, error), flush=True)
+
+    if n_workers == 1:
+        init_worker(data)
+        for idx, job in enumerate(jobs):
+            try:
+                report(idx, job, figure_job(*job))
+            except Exception as e:
+                report(idx, job, error=e)
+    else:
+        # Metrics are sent to each worker once, not with every job
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker, initargs=(data,)) as pool:
+            futures = dict((pool.submit(figure_job, *job), job) for job in jobs)
+            for idx, future in enumerate(as_completed(futures)):
+                try:
+                    report(idx, futures[future], future.result())
+                except Exception as e:
+                    report(idx, futures[future], error=e)
+
+    print('Total: {:.1f} seconds'.format(time.time() - start), flush=True)
+
+    return failed
 
 def main():
     """Load data and generate plots."""
+    parser = argparse.ArgumentParser(
+        description = 'stats_figures.py makes plots of statistical metrics of the kit comparison'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type = int,
+        default = 1,
+        help = 'Number of figure groups to create in parallel [default: 1]'
+    )
+
+    parser.add_argument(
+        '-f', '--force',
+        action = 'store_true',
+        help = 'Create all figures, even those whose metrics and code are unchanged'
+    )
+
+    args = parser.parse_args()
+
     with open('2019_11_07_FallopianTube_WGBS_Kit_Comparison/analysis/analyze_the_data/collect_data/kit_comp_collected_data.json', 'r') as f:
         kit_comp_data = json.load(f)
 
@@ -896,37 +1162,34 @@ def main():
     do_raw_bams = True
     do_sub_bams = True
 
+    jobs = []
+
     # Raw BAM plots
     if do_raw_bams:
         raw_bam_dir = plot_dir + '/raw_bam_plots/'
         Path(raw_bam_dir).mkdir(parents=True, exist_ok=True)
 
-        raw_read_base_qual_plots(kit_comp_data, raw_bam_dir)
-        cpg_region_plots(kit_comp_data, raw_bam_dir)
-        trimmed_stats_plots(kit_comp_data, raw_bam_dir)
-        read_alignment_plot(kit_comp_data, raw_bam_dir)
-        duplicate_rate_plots(kit_comp_data, raw_bam_dir)
-        cpn_retention_plots(kit_comp_data, raw_bam_dir)
-        mbias_plots(kit_comp_data, raw_bam_dir)
-        create_covdist_plots(kit_comp_data, raw_bam_dir)
-        create_insert_size_plots(kit_comp_data, raw_bam_dir)
-        create_complexity_curve_plots(kit_comp_data, raw_bam_dir)
-        create_tex_table(kit_comp_data, raw_bam_dir)
-        create_obs_exp_ratio_plots(kit_comp_data, raw_bam_dir)
-        create_trinucleotide_methylation_plots(kit_comp_data, raw_bam_dir)
+        jobs += [(group, 'raw', raw_bam_dir) for group in RAW_GROUPS]
 
     # Subsampled BAM plots
     if do_sub_bams:
         sub_bam_dir = plot_dir + '/sub_bam_plots/'
         Path(sub_bam_dir).mkdir(parents=True, exist_ok=True)
 
-        cpg_region_plots(kit_comp_data_sub, sub_bam_dir)
-        cpn_retention_plots(kit_comp_data_sub, sub_bam_dir)
-        mbias_plots(kit_comp_data_sub, sub_bam_dir)
-        create_covdist_plots(kit_comp_data_sub, sub_bam_dir)
-        create_tex_table(kit_comp_data_sub, sub_bam_dir)
-        create_trinucleotide_methylation_plots(kit_comp_data_sub, sub_bam_dir)
+        jobs += [(group, 'sub', sub_bam_dir) for group in SUB_GROUPS]
 
-if __name__ == '__main__':
-    main()
+    data = {'raw': kit_comp_data, 'sub': kit_comp_data_sub}
+    if not args.force:
+        n_jobs = len(jobs)
+        jobs = [job for job in jobs if not up_to_date(job[0], data[job[1]], job[2])]
+        print('{} of {} figure groups are up to date'.format(n_jobs - len(jobs), n_jobs), flush=True)
+
+    failed = run_figure_jobs(jobs, data, args.jobs)
+    if len(failed) > 0:
+        print('Failed figure groups: ' + ', '.join(failed))
+        return 1
 
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
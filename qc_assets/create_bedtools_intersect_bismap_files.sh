@@ -15,3 +15,10 @@ bedtools intersect -a k100.bismap.bedgraph.gz -b hg38/intergenic_regions.bed.gz
 gzip -c > bismap/intergenic_regions_bismap.bed.gz
 bedtools intersect -a k100.bismap.bedgraph.gz -b hg38/rmsk.bed.gz |
 gzip -c > bismap/rmsk_bismap.bed.gz
+
+# The obs/exp jobs expect the whole-genome bismap file alongside the region files
+ln -sf ../k100.bismap.bedgraph.gz bismap/k100.bismap.bedgraph.gz
+
+# Precompute the mappability-weighted region lengths used as the expected
+# coverage denominators (stored in bismap/region_lengths.json)
+python ../analysis/analyze_the_data/common/region_lengths.py bismap